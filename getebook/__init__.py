@@ -28,18 +28,26 @@ Example:
 >>> p.getebook(\'http://www.ebook-site.org\', \'some-book/1\')
 >>> builder.finalize()'''
 
-import html
-import html.parser
+# Only modules that are needed by every program using getebook are
+# imported here. The others (most importantly requests, which takes
+# longer to import than everything else together) are imported when
+# they are first needed.
 import re
-import requests
-import urllib.parse
-import warnings
 
-__all__ = ['EbookParser', 'PageNotFound', 'Quirks']
+__all__ = ['Budget', 'BuildStopped', 'Diagnostics', 'EbookParser',
+           'PageNotFound', 'Quirks']
 
 class PageNotFound(Exception):
     pass
 
+class BuildStopped(Exception):
+    '''Raised by EbookParser.getebook if the build was stopped early and
+    the budget is strict. The reason attribute is the status (see
+    EbookParser.getebook).'''
+    def __init__(self, reason, msg):
+        super().__init__(msg)
+        self.reason = reason
+
 class _TOCEntry:
     'Entry in a table of contents.'
     def __init__(self, parent, text, target, entry_no):
@@ -117,6 +125,15 @@ class Element:
             self._text_len += len(elem)
         self.children.append(elem)
 
+    def add_text(self, text):
+        '''Add a string as a child. If the last child is a string, too,
+        text is appended to it instead.'''
+        self._text_len += len(text)
+        if self.children and isinstance(self.children[-1], str):
+            self.children[-1] += text
+        else:
+            self.children.append(text)
+
     @property
     def text(self):
         'Text inside the element. (read-only attribute)'
@@ -173,6 +190,14 @@ class _Pattern:
             self.txt_re = None
         self.lim = char_lim
 
+    def key(self):
+        'Return the pattern as a list of strings, lists and numbers.'
+        if self.txt_re:
+            text_re = self.txt_re.pattern
+        else:
+            text_re = None
+        return [self.tag, self.cls, self.id, text_re, self.lim]
+
     def match_starttag(self, elem):
         'Check if the tag and attributes match the pattern.'
         if self.tag and not elem.tag in self.tag:
@@ -268,6 +293,13 @@ class Quirks:
         self.skip_elem.append(_Pattern(tag, class_val, id_val, text_re,
                                        char_lim))
 
+    def key(self):
+        '''Return all conditions as a dict of lists of strings, lists and
+        numbers, e.g. for comparing the quirks of two builds.'''
+        return {'false_heading': [p.key() for p in self.false_h],
+                'par_heading': [p.key() for p in self.par_h],
+                'skip': [p.key() for p in getattr(self, 'skip_elem', [])]}
+
     def test_false_heading(self, elem):
         'Check if elem is a false heading.'
         if any([p.match(elem) for p in self.false_h]):
@@ -286,61 +318,305 @@ class Quirks:
             return True
         return False
 
-class EbookParser(html.parser.HTMLParser):
+    def may_skip(self, elem):
+        '''Check if elem might be skipped, judging only by its start tag.
+        If this is False, test_skip(elem) is False, too.'''
+        for p in self.skip_elem:
+            if p.match_starttag(elem):
+                return True
+        return False
+
+class Diagnostics:
+    '''Collects problems found in the html source of a book, such as
+    missing end tags. For every kind of problem, the number of
+    occurrences is counted and the first max_samples occurrences are
+    kept as samples with URL, line number and details.'''
+    def __init__(self, max_samples = 10):
+        'Initialize an empty collection.'
+        self.max_samples = max_samples
+        self.url = None # URL of the page being parsed
+        self.pages = 0
+        self.counts = {}
+        self.samples = {}
+
+    def report(self, kind, detail, getpos):
+        '''Count a problem of the given kind. getpos is a function
+        returning the position in the source; it is only called if a
+        sample is taken.'''
+        try:
+            self.counts[kind] += 1
+        except KeyError:
+            self.counts[kind] = 1
+            self.samples[kind] = []
+        samples = self.samples[kind]
+        if len(samples) < self.max_samples:
+            samples.append({'url': self.url, 'line': getpos()[0],
+                            'detail': detail})
+
+    def merge(self, other):
+        '''Add the pages, counts and samples of the Diagnostics instance
+        other to this one.'''
+        self.pages += other.pages
+        for (kind, count) in other.counts.items():
+            try:
+                self.counts[kind] += count
+            except KeyError:
+                self.counts[kind] = count
+                self.samples[kind] = []
+            samples = self.samples[kind]
+            room = self.max_samples - len(samples)
+            if room > 0:
+                samples.extend(other.samples[kind][:room])
+
+    def summary(self):
+        '''Return a dict with the number of pages and the counts and
+        samples of all problems, e.g. for saving it as JSON.'''
+        return {'pages': self.pages, 'counts': dict(self.counts),
+                'samples': {k: list(v) for (k, v) in self.samples.items()}}
+
+    def __str__(self):
+        'Return a short human-readable summary.'
+        if not self.counts:
+            return 'no problems in %d pages' % self.pages
+        out = 'problems in %d pages:' % self.pages
+        for kind in sorted(self.counts):
+            out += '\n  %s: %d' % (kind, self.counts[kind])
+            for smp in self.samples[kind]:
+                out += '\n    %s, line %d: %s' % (smp['url'], smp['line'],
+                                                  smp['detail'])
+        return out
+
+class Budget:
+    '''Limits for the pages read by EbookParser.getebook: at most
+    max_pages pages, max_bytes bytes of page content and max_time
+    seconds from the start of the build. None means no limit. The
+    limits are checked before every page.
+
+    Independently of the limits, the build is stopped if the link to
+    the next part leads to a page that was already read, or if a page
+    has the same content as an earlier one. If strict is False, the
+    book is built from the pages read up to then and a warning is
+    issued; otherwise, BuildStopped is raised.'''
+    def __init__(self, max_pages = None, max_bytes = None, max_time = None,
+                 strict = False):
+        self.max_pages = max_pages
+        self.max_bytes = max_bytes
+        self.max_time = max_time
+        self.strict = strict
+
+_stop_reasons = {
+    'loop': 'the link to the next part leads to a page that was '
+            'already read',
+    'duplicate': 'the page has the same content as an earlier one',
+    'max_pages': 'page limit reached',
+    'max_bytes': 'size limit reached',
+    'max_time': 'time limit reached',
+}
+
+class _Crawl:
+    '''Keeps track of the pages read for a book, to check them against
+    a Budget.'''
+    def __init__(self, budget):
+        import time
+        self.budget = budget
+        self.start = time.monotonic()
+        self.urls = set()
+        self.hashes = set()
+        self.pages = 0
+        self.bytes = 0
+
+    def key(self, url):
+        'Return the URL without fragment, to compare pages by URL.'
+        import urllib.parse
+        return urllib.parse.urldefrag(url)[0]
+
+    def check_url(self, url, ahead = 0):
+        '''Return the reason to stop before reading the page at url, or
+        None. ahead is the number of pages that will be read before it.'''
+        import time
+        budget = self.budget
+        if self.key(url) in self.urls:
+            return 'loop'
+        if budget.max_pages is not None and \
+           self.pages + ahead >= budget.max_pages:
+            return 'max_pages'
+        if budget.max_time is not None and \
+           time.monotonic() - self.start >= budget.max_time:
+            return 'max_time'
+        return None
+
+    def check_page(self, url, content):
+        '''Record the page at url with content (bytes). Return the
+        reason not to use it, or None.'''
+        import hashlib
+        self.urls.add(self.key(url))
+        digest = hashlib.sha256(content).digest()
+        if digest in self.hashes:
+            return 'duplicate'
+        self.hashes.add(digest)
+        if self.budget.max_bytes is not None and \
+           self.bytes + len(content) > self.budget.max_bytes:
+            return 'max_bytes'
+        self.pages += 1
+        self.bytes += len(content)
+        return None
+
+    def stop(self, builder, url, reason):
+        '''Stop the build before the page at url. Raises BuildStopped if
+        the budget is strict; otherwise, issues a warning and records
+        the reason with the builder.'''
+        import warnings
+        msg = 'stopped at %s after %d pages: %s' % (url, self.pages,
+                                                    _stop_reasons[reason])
+        if self.budget.strict:
+            raise BuildStopped(reason, msg)
+        warnings.warn(msg)
+        try:
+            builder.add_config('stopped', reason)
+        except AttributeError:
+            pass
+        return reason
+
+class EbookParser:
     'Extract ebook content and the URL to the next part.'
     def __init__(self, builder, link_next, root_tag = None, root_class = None,
-                 root_id = None):
+                 root_id = None, backend = None, diagnostics = True,
+                 source = None, budget = None, parse_cache = None):
         '''Initialize the parser. The builder argument should be an
         ebook builder object from a submodule. root_tag, root_class and
         root_id describe the html element that holds ebook content. If
         all of them are None, the whole body is considered to be ebook
         content. link_next is a regular expression to extract the link
-        to the next part of the ebook.'''
-        super().__init__(convert_charrefs = True)
+        to the next part of the ebook. backend is the tokenizer backend
+        (see the backends submodule); by default, html.parser is used.
+        Problems in the html source are collected in a Diagnostics
+        instance, which can be passed as the diagnostics argument; set
+        it to None to skip collecting them. source is where pages are
+        read from (see the sources submodule); by default, they are
+        downloaded. budget is a Budget instance that limits the pages
+        read by getebook; by default, there are no limits. parse_cache
+        is a getebook.parsecache.ParseCache instance that getebook uses
+        to skip parsing pages that were parsed before.'''
         if root_tag or root_class or root_id:
             self.root_check = _Pattern(root_tag, root_class, root_id, None,
                                         None)
         else:
             self.root_check = _Pattern('body', None, None, None, None)
-        in_content = False
         self.builder = builder
         self.quirks = Quirks()
         self.next_re = re.compile(link_next)
-        self.in_anchor = False # Parsing anchor to compare with link_next
-        self.next_part = None
-        self.elem_stack = []
         self.last_void_tag = None
+        if diagnostics is True:
+            diagnostics = Diagnostics()
+        self.diagnostics = diagnostics
+        if not source:
+            import getebook.sources
+            source = getebook.sources.HTTPSource()
+        self.source = source
+        if not budget:
+            budget = Budget()
+        self.budget = budget
+        self.parse_cache = parse_cache
+        if not backend:
+            import getebook.backends
+            backend = getebook.backends.HTMLParserBackend
+        self.backend = backend(self)
+        # See _balanced_endtag.
+        self._balanced = getattr(self.backend, 'balanced', False)
+        # Paragraphs and headings inside other elements are handed to
+        # the builder as soon as they are complete if the builder
+        # supports it (see _stream_block).
+        self._streaming = hasattr(builder, 'start_elem')
+        self.reset()
+
+    def config(self):
+        '''Return the settings that determine the output of the parser
+        (link_next, root element and quirks) as a dict.'''
+        return {'link_next': self.next_re.pattern,
+                'root': self.root_check.key(),
+                'quirks': self.quirks.key()}
+
+    def feed(self, data):
+        'Feed html source to the parser.'
+        self.backend.feed(data)
+
+    def close(self):
+        'Process any data that the backend has buffered.'
+        self.backend.close()
+        if self._data:
+            self._flush_data()
+        # Elements whose start tag was written must be closed.
+        while self._opened:
+            self._close_elem()
+
+    def getpos(self):
+        'Return the current line number and offset.'
+        return self.backend.getpos()
 
     def reset(self):
         'Reset this instance.'
         self.next_part = None
-        self.in_anchor = False
+        self.in_anchor = False # Parsing anchor to compare with link_next
         self.in_content = False
         self.elem_stack = []
+        # The first _opened elements of elem_stack have been passed to
+        # the builder with start_elem.
+        self._opened = 0
+        # Position in elem_stack of the outermost element that may be
+        # skipped, if any. Nothing inside it can be streamed.
+        self._skip_pos = None
+        # Position in elem_stack of the open paragraph or heading, if
+        # any. Since a new one closes the previous one, there is at most
+        # one.
+        self._block_pos = None
+        self._data = []
+        # For balanced backends: the element on elem_stack that every
+        # open start tag added, or None (see _balanced_endtag)
+        self._open = []
         try:
             del self.block
         except AttributeError:
             pass
-        super().reset()
+        self.backend.reset()
 
     def handle_starttag(self, tag, attrs):
         '''Handle a start tag. This method is supposed to only be used
         internally.'''
+        if self._data:
+            self._flush_data()
+        if self._balanced:
+            stack = self.elem_stack
+            top = stack[-1] if stack else None
+            self.last_void_tag = None
+            self._start_elem(tag, attrs)
+            if stack and stack[-1] is not top:
+                self._open.append(stack[-1])
+            elif self.last_void_tag:
+                # Already closed, the end tag must be ignored.
+                self._open.append(False)
+            else:
+                self._open.append(None)
+        else:
+            self._start_elem(tag, attrs)
+
+    def _start_elem(self, tag, attrs):
+        'Open a new element for handle_starttag.'
         if self.in_content or self.in_anchor:
             if tag in _headings_and_p:
-                # We add a new heading or paragraph tag. Check if there
-                # is a previous unclosed heading or paragraph tag.
-                for i in range(len(self.elem_stack)-1, -1, -1):
-                    if self.elem_stack[i].tag in _headings_and_p:
-                        # The ith-to-last element in the stack is an
-                        # unclosed paragraph or heading, so we call
-                        # _close_elem() i+1 times.
-                        for j in range(i+1):
-                            unclosed = self._close_elem()
-                            warnings.warn('missing </%s> tag in line %d' % \
-                                                  (unclosed, self.getpos()[0]))
-                        break
-            self.elem_stack.append(Element(tag, attrs))
+                # We add a new heading or paragraph tag. If there is a
+                # previous unclosed heading or paragraph tag, it is
+                # closed together with everything inside it.
+                if self._block_pos is not None:
+                    for i in range(len(self.elem_stack) - self._block_pos):
+                        unclosed = self._close_elem()
+                        if self.diagnostics:
+                            self.diagnostics.report('missing-end-tag',
+                                                    unclosed, self.getpos)
+                self._block_pos = len(self.elem_stack)
+            elem = Element(tag, attrs)
+            if self._skip_pos is None and self.quirks.may_skip(elem):
+                self._skip_pos = len(self.elem_stack)
+            self.elem_stack.append(elem)
             if tag in _void_elems:
                 # Since the new element can't contain any children, we
                 # call _close_elem() immediately. We save the starttag
@@ -362,16 +638,55 @@ class EbookParser(html.parser.HTMLParser):
     def handle_endtag(self, tag):
         '''Handle an end tag. This method is supposed to only be used
         internally.'''
+        if self._data:
+            self._flush_data()
+        if self._balanced:
+            self._balanced_endtag(tag)
+            return
         # If this tag closes a void element, we don't need to do
         # anything here (other than set last_void_tag to None).
         if not tag == self.last_void_tag:
             prev_tag = self._close_elem()
             while (self.in_content or self.in_anchor) and prev_tag != tag:
-                warnings.warn('missing </%s> tag in line %d' % \
-                                                  (prev_tag, self.getpos()[0]))
+                if self.diagnostics:
+                    self.diagnostics.report('missing-end-tag', prev_tag,
+                                            self.getpos)
                 prev_tag = self._close_elem()
         self.last_void_tag = None
 
+    def _balanced_endtag(self, tag):
+        '''Handle an end tag from a balanced backend, which reports an end
+        tag for every start tag, adding the missing ones itself. It may
+        do so at a different place than the parser, which closes an open
+        paragraph when a new one starts: e.g., lxml nests the second
+        paragraph in "<p>a <span>b<p>c" inside the span and closes the
+        span after it. Such end tags of elements that are closed already
+        are ignored, so they don't close the elements around them.'''
+        self.last_void_tag = None
+        try:
+            elem = self._open.pop()
+        except IndexError:
+            elem = None
+        if elem is False:
+            return
+        if elem is None:
+            # The element is not on elem_stack, e.g. the root element.
+            if not self.elem_stack:
+                self._close_elem()
+            return
+        stack = self.elem_stack
+        for i in range(len(stack) - 1, -1, -1):
+            if stack[i] is elem:
+                break
+        else:
+            return
+        while len(stack) > i + 1:
+            unclosed = self._close_elem()
+            if self.diagnostics:
+                self.diagnostics.report('missing-end-tag', unclosed,
+                                        self.getpos)
+        self._close_elem()
+
     def _close_elem(self):
         'Closes the last element on elem_stack and returns its tag.'
         try:
@@ -383,53 +698,242 @@ class EbookParser(html.parser.HTMLParser):
             self.in_content = False
             self.in_anchor = False
             return None
-        if self.in_anchor and elem.tag == 'a':
+        # The builder may change elem.tag (see EpubBuilder.false_heading),
+        # but handle_endtag needs the tag of the start tag.
+        tag = elem.tag
+        if self.in_anchor and tag == 'a':
             if self.next_re.match(elem.text):
                 try:
                     self.next_part = elem.attrs['href']
                 except KeyError:
-                    warnings.warn(('The anchor matching link_next has no href '
-                                   'attribute.'))
+                    if self.diagnostics:
+                        self.diagnostics.report('next-link-without-href',
+                                                elem.text, self.getpos)
                 self.in_anchor = False
+        if len(self.elem_stack) == self._skip_pos:
+            self._skip_pos = None
+        if len(self.elem_stack) == self._block_pos:
+            self._block_pos = None
         if self.in_content and not self.quirks.test_skip(elem):
-            try:
-                self.elem_stack[-1].add_child(elem)
-            except IndexError:
+            if len(self.elem_stack) < self._opened:
+                # The start tag has been written already; write the
+                # rest of the element.
+                self._opened -= 1
+                for child in elem.children:
+                    self.builder.handle_elem(child)
+                self.builder.end_elem(elem)
+            elif not self.elem_stack:
                 # We closed the last element on the stack, now we hand
                 # it to the ebook builder.
-                if elem.tag == 'p' and self.quirks.test_par_heading(elem):
-                    self.builder.par_heading(elem)
-                elif elem.tag == 'h' and self.quirks.test_false_h(elem):
-                    self.builder.false_heading(elem)
-                else:
-                    self.builder.handle_elem(elem)
-        return elem.tag
-
+                self._hand_over(elem)
+            elif elem.tag in _headings_and_p and self._streaming and \
+                 self._skip_pos is None and not self.in_anchor:
+                self._stream_block(elem)
+            else:
+                self.elem_stack[-1].add_child(elem)
+        return tag
+
+    def _hand_over(self, elem):
+        '''Hand a complete element to the builder. Only top-level elements
+        can be paragraph headings or false headings.'''
+        if elem.tag == 'p' and self.quirks.test_par_heading(elem):
+            self.builder.par_heading(elem)
+        elif elem.tag in _headings and self.quirks.test_false_heading(elem):
+            self.builder.false_heading(elem)
+        else:
+            self.builder.handle_elem(elem)
+
+    def _stream_block(self, elem):
+        '''Hand the paragraph or heading elem, which is inside other
+        elements, to the builder right away instead of keeping it until
+        the outermost element is complete. Start tags of the elements
+        around it are passed to builder.start_elem, together with the
+        children they have so far, and their end tags to
+        builder.end_elem when they are closed. That way, only the
+        current paragraph is kept in memory, even if a whole chapter is
+        wrapped in a <div>.'''
+        stack = self.elem_stack
+        # Only the innermost of the opened elements can have children
+        # that are not written yet.
+        for i in range(max(0, self._opened - 1), len(stack)):
+            parent = stack[i]
+            if i >= self._opened:
+                self.builder.start_elem(parent)
+            for child in parent.children:
+                self.builder.handle_elem(child)
+            parent.children = []
+        self._opened = len(stack)
+        # Without start_elem, elem would be a child of its parent, so
+        # the quirks for headings don't apply to it (see _hand_over).
+        self.builder.handle_elem(elem)
 
     def handle_data(self, data):
         '''Handle data. This method is supposed to only be used internally.'''
-        strp_lines = [l.strip() for l in data.splitlines() if len(l) > 0 \
-                                                           and not l.isspace()]
-        text = '\n'.join(strp_lines)
+        # Data is collected until the next tag, so that it doesn't
+        # matter how the backend splits it up.
+        self._data.append(data)
+
+    def _flush_data(self):
+        'Add the data collected by handle_data to the current element.'
+        if len(self._data) == 1:
+            data = self._data[0]
+        else:
+            data = ''.join(self._data)
+        self._data = []
+        # Strip whitespace around lines and remove empty lines. Most
+        # chunks have only one line, so we avoid the join in that case.
+        lines = data.splitlines()
+        if len(lines) == 1:
+            text = lines[0].strip()
+        else:
+            text = '\n'.join(filter(None, map(str.strip, lines)))
         if text:
             try:
-                self.elem_stack[-1].add_child(text)
+                self.elem_stack[-1].add_text(text)
             except IndexError:
                 if self.in_content:
                     self.builder.handle_elem(text)
 
-    def getebook(self, base, path):
+    def getebook(self, base, path, processes = None):
         '''Parse the html from base+path, and keep following the link to
-        the next part of the book.'''
+        the next part of the book. Pages are read from self.source. If
+        problems were found in the html source, a summary is issued as a
+        single warning.
+
+        If the builder has add_config and add_source methods (like
+        getebook.epub.EpubBuilder), it is told the settings of the
+        parser and every page that was read, for its build fingerprint.
+
+        If processes is given, the pages are parsed in that many worker
+        processes (see the parallel submodule). Set it to 0 to use one
+        per CPU.
+
+        Returns "complete" if the last part of the book was reached.
+        Otherwise, the build was stopped early (see Budget) and the
+        reason is returned: "loop" or "duplicate" if a page was read
+        twice, "max_pages", "max_bytes" or "max_time" if a limit was
+        reached.'''
+        if processes is not None:
+            import getebook.parallel
+            return getebook.parallel.run(self, base, path, processes)
+        import getebook.encoding
+        import urllib.parse
+        import warnings
+        try:
+            self.builder.add_config('parser', self.config())
+            add_source = self.builder.add_source
+        except AttributeError:
+            add_source = None
+        crawl = _Crawl(self.budget)
+        status = 'complete'
+        if self.parse_cache:
+            parser_key = self.parse_cache.parser_key(self)
         while path:
             try:
                 base = self.base
             except AttributeError:
                 pass
-            r = requests.get(urllib.parse.urljoin(base, path))
+            url = urllib.parse.urljoin(base, path)
+            reason = crawl.check_url(url)
+            if reason:
+                status = crawl.stop(self.builder, url, reason)
+                break
+            r = self.source.get(url)
             if not r:
                 raise PageNotFound('Got error code %03d.' % r.status_code)
+            reason = crawl.check_page(url, r.content)
+            if reason:
+                status = crawl.stop(self.builder, url, reason)
+                break
+            if add_source:
+                add_source(url, r.content)
             self.builder.new_part()
-            self.feed(r.text)
+            if self.parse_cache:
+                self._parse_cached(url, r, parser_key)
+            else:
+                if self.diagnostics:
+                    self.diagnostics.url = url
+                    self.diagnostics.pages += 1
+                for text in getebook.encoding.iter_decode(r):
+                    self.feed(text)
+                self.close()
             path = self.next_part
             self.reset()
+        if self.diagnostics and self.diagnostics.counts:
+            warnings.warn(str(self.diagnostics))
+        return status
+
+    def _parse_cached(self, url, r, parser_key):
+        '''Hand the content of the page r, read from url, to the builder
+        like feed and close, using self.parse_cache. Afterwards,
+        next_part is set as if the page had been parsed.'''
+        import getebook.encoding
+        import getebook.events
+        encoding = getebook.encoding.response_encoding(r)
+        key = self.parse_cache.key(parser_key, encoding, r.content)
+        result = self.parse_cache.get(key, url)
+        if not result:
+            (builder, diagnostics) = (self.builder, self.diagnostics)
+            try:
+                base = self.base
+            except AttributeError:
+                base = None
+            self.builder = getebook.events.Recorder()
+            try:
+                result = getebook.events.parse_page(self, url,
+                           r.content.decode(encoding, 'replace'))
+            finally:
+                (self.builder, self.diagnostics) = (builder, diagnostics)
+                if base:
+                    self.base = base
+            self.parse_cache.put(key, result)
+        getebook.events.replay(result.events, self.builder)
+        if result.diagnostics and self.diagnostics:
+            self.diagnostics.url = url
+            self.diagnostics.merge(result.diagnostics)
+        if result.base:
+            self.base = result.base
+        self.next_part = result.next_part
+
+    def unchanged(self, build_info):
+        '''Check if a book built with the builder and this parser would
+        be the same as an existing build, without parsing anything.
+        build_info is the information stored in the existing epub (see
+        getebook.epub.read_build_info). Returns True if the settings of
+        the builder and the parser are the same and all pages of the
+        book still have the same content. Only the pages that make up
+        the existing build are read (from self.source).'''
+        import hashlib
+        try:
+            # getebook records the settings with add_config.
+            inputs = self.builder.inputs + \
+                     [self.builder.config_input('parser', self.config())]
+            if self.builder.config_fingerprint(inputs) != \
+               build_info['config']:
+                return False
+            pages = build_info['pages']
+        except (AttributeError, KeyError, TypeError):
+            return False
+        for (url, digest) in pages:
+            r = self.source.get(url)
+            if not r or hashlib.sha256(r.content).hexdigest() != digest:
+                return False
+        return True
+
+_lib_fingerprint = None
+
+def _library_fingerprint():
+    '''Return a hash of the source code of the getebook package. Any
+    change to the code changes the fingerprint.'''
+    global _lib_fingerprint
+    if not _lib_fingerprint:
+        import glob
+        import hashlib
+        import os.path
+        h = hashlib.sha256()
+        pkg_dir = os.path.dirname(os.path.abspath(__file__))
+        for name in sorted(glob.glob(os.path.join(pkg_dir, '*.py'))):
+            with open(name, 'rb') as f:
+                h.update(f.read())
+        _lib_fingerprint = h.hexdigest()
+    return _lib_fingerprint
@@ -0,0 +1,115 @@
+# Copyright (c) 2016, Max Fillinger <max@max-fillinger.net>
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES WITH
+# REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF MERCHANTABILITY
+# AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY SPECIAL, DIRECT,
+# INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES WHATSOEVER RESULTING FROM
+# LOSS OF USE, DATA OR PROFITS, WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR
+# OTHER TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR
+# PERFORMANCE OF THIS SOFTWARE.
+
+'''Tokenizer backends for getebook.EbookParser.
+
+A backend turns html source into a sequence of events and reports them
+to a target object by calling its handle_starttag(tag, attrs),
+handle_endtag(tag) and handle_data(data) methods, where attrs is a list
+of (key, value) pairs. Backends are created as backend(target) and
+provide the methods feed(data), close(), reset() and getpos(). If the
+balanced attribute of a backend is True, it reports exactly one end tag
+for every start tag, even if the source lacks it.
+
+HTMLParserBackend uses html.parser from the standard library and is the
+default. It reports the tags as they are in the source. LxmlBackend uses
+the (much faster) C parser from lxml and is only available if lxml is
+installed. lxml builds a tree from the source and reports its elements,
+so it is balanced. For well-formed pages, both give the same ebook; for
+broken html, lxml may repair the tree differently (e.g., by moving a
+<div> out of an <i> element), but no content is lost.'''
+
+import html.parser
+
+__all__ = ['HTMLParserBackend', 'LxmlBackend', 'backends']
+
+class HTMLParserBackend(html.parser.HTMLParser):
+    'Tokenizer backend using html.parser.'
+    balanced = False
+
+    def __init__(self, target):
+        '''Initialize the backend. Events are reported to target.'''
+        # We bind the target's handlers directly to the instance so
+        # that html.parser calls them without an extra indirection.
+        self.handle_starttag = target.handle_starttag
+        self.handle_endtag = target.handle_endtag
+        self.handle_data = target.handle_data
+        super().__init__(convert_charrefs = True)
+
+# Attributes whose value doesn't matter, as long as they are present.
+_boolean_attrs = frozenset(['checked', 'compact', 'declare', 'defer',
+                            'disabled', 'hidden', 'ismap', 'multiple',
+                            'nohref', 'noresize', 'noshade', 'nowrap',
+                            'readonly', 'selected'])
+
+class _LxmlTarget:
+    'Parser target that translates lxml callbacks into handle_* calls.'
+    def __init__(self, target):
+        self._handle_starttag = target.handle_starttag
+        self.end = target.handle_endtag
+        self.data = target.handle_data
+
+    def start(self, tag, attrib):
+        'Report a start tag with attributes as (key, value) pairs.'
+        # lxml gives attributes without value (like "nowrap") an empty
+        # value, html.parser gives them None.
+        self._handle_starttag(tag, [(key, None)
+                                    if not val and key in _boolean_attrs
+                                    else (key, val)
+                                    for (key, val) in attrib.items()])
+
+    def close(self):
+        pass
+
+class LxmlBackend:
+    '''Tokenizer backend using the incremental parser of lxml. Since lxml
+    does not report source positions to parser targets, getpos() always
+    returns (0, 0).'''
+    balanced = True
+
+    def __init__(self, target):
+        '''Initialize the backend. Events are reported to target.
+        Raises ImportError if lxml is not installed.'''
+        import lxml.etree
+        self._etree = lxml.etree
+        self._target = _LxmlTarget(target)
+        self.reset()
+
+    def reset(self):
+        'Discard unprocessed data and start over with a new document.'
+        self._parser = self._etree.HTMLParser(target = self._target,
+                                              remove_comments = True,
+                                              remove_pis = True,
+                                              no_network = True)
+
+    def feed(self, data):
+        'Feed data to the parser.'
+        self._parser.feed(data)
+
+    def close(self):
+        '''Process any buffered data. Elements that are still open are
+        closed.'''
+        try:
+            self._parser.close()
+        except self._etree.XMLSyntaxError:
+            # Raised on documents without any content; there is
+            # nothing to report in that case.
+            pass
+
+    def getpos(self):
+        'Return (0, 0); lxml does not report line numbers.'
+        return (0, 0)
+
+# Available backends by name, e.g. for selecting one on the command line.
+backends = {'html.parser': HTMLParserBackend, 'lxml': LxmlBackend}
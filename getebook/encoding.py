@@ -0,0 +1,142 @@
+# Copyright (c) 2016, Max Fillinger <max@max-fillinger.net>
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES WITH
+# REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF MERCHANTABILITY
+# AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY SPECIAL, DIRECT,
+# INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES WHATSOEVER RESULTING FROM
+# LOSS OF USE, DATA OR PROFITS, WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR
+# OTHER TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR
+# PERFORMANCE OF THIS SOFTWARE.
+
+'''Decoding of downloaded webpages.
+
+The encoding of a page is determined from (in this order):
+
+1. a byte order mark,
+2. the charset in the Content-Type header,
+3. a <meta> tag in the first few kilobytes of the page,
+4. a check whether the page is valid UTF-8,
+5. the encoding that was declared (by 1-3) for a previous page on the
+   same host,
+6. charset detection with charset_normalizer or chardet, if one of them
+   is installed.
+
+If all of that fails, windows-1252 is used. Detected encodings are not
+remembered for the host, since a wrong guess for one short page would
+spoil all the other pages of the book.'''
+
+import codecs
+import re
+import urllib.parse
+
+__all__ = ['find_encoding', 'response_encoding', 'iter_decode', 'decode',
+           'host_encodings']
+
+# Number of bytes that are searched for a <meta> tag.
+sniff_len = 4096
+
+# Encodings declared for previous pages, by host.
+host_encodings = {}
+
+_boms = [(codecs.BOM_UTF8, 'utf-8-sig'),
+         # UTF-32 must come before UTF-16 since the UTF-32-LE BOM starts
+         # with the UTF-16-LE BOM.
+         (codecs.BOM_UTF32_LE, 'utf-32'), (codecs.BOM_UTF32_BE, 'utf-32'),
+         (codecs.BOM_UTF16_LE, 'utf-16'), (codecs.BOM_UTF16_BE, 'utf-16')]
+_header_re = re.compile(r'charset\s*=\s*["\']?\s*([^\s;"\']+)', re.I)
+_meta_re = re.compile(
+  rb'<meta[^>]+?charset\s*=\s*["\']?\s*([-\w.:]+)', re.I)
+
+def _lookup(name):
+    'Return the normalized name of an encoding, or None if it is unknown.'
+    try:
+        name = codecs.lookup(name).name
+    except LookupError:
+        return None
+    # Browsers treat latin-1 as windows-1252, and so do we.
+    if name in ('latin-1', 'iso8859-1'):
+        return 'cp1252'
+    return name
+
+def _detect(data):
+    '''Guess the encoding of data with charset_normalizer or chardet.
+    Returns None if neither is installed or if detection fails.'''
+    try:
+        import charset_normalizer
+    except ImportError:
+        pass
+    else:
+        match = charset_normalizer.from_bytes(data).best()
+        if match:
+            return _lookup(match.encoding)
+        return None
+    try:
+        import chardet
+    except ImportError:
+        return None
+    enc = chardet.detect(data)['encoding']
+    if enc:
+        return _lookup(enc)
+    return None
+
+def find_encoding(data, content_type = None, host = None):
+    '''Determine the encoding of the page data (bytes), which was
+    downloaded from host with the given Content-Type header.'''
+    enc = None
+    for (bom, bom_enc) in _boms:
+        if data.startswith(bom):
+            enc = bom_enc
+            break
+    if not enc and content_type:
+        m = _header_re.search(content_type)
+        if m:
+            enc = _lookup(m.group(1))
+    if not enc:
+        m = _meta_re.search(data, 0, sniff_len)
+        if m:
+            enc = _lookup(m.group(1).decode('ascii'))
+    if enc:
+        if host:
+            host_encodings[host] = enc
+        return enc
+    # Most pages without declared encoding are UTF-8 or plain ASCII. The
+    # whole page is checked, since a page that only has a few non-ASCII
+    # characters near the end would otherwise get replacement characters.
+    try:
+        data.decode('utf-8')
+    except UnicodeDecodeError:
+        pass
+    else:
+        return 'utf-8'
+    enc = host_encodings.get(host)
+    # If the host declared UTF-8 before, this page is not UTF-8 after all.
+    if enc and not enc.startswith('utf-8'):
+        return enc
+    return _detect(data[:sniff_len * 16]) or 'cp1252'
+
+def response_encoding(r):
+    'Determine the encoding of the requests.Response r.'
+    host = urllib.parse.urlsplit(r.url).netloc.lower()
+    return find_encoding(r.content, r.headers.get('Content-Type'), host)
+
+def iter_decode(r, chunk_size = 1 << 16):
+    '''Decode the content of the requests.Response r piece by piece,
+    chunk_size bytes at a time, and yield the resulting strings.
+    Undecodable bytes are replaced.'''
+    decoder = codecs.getincrementaldecoder(response_encoding(r))('replace')
+    data = r.content
+    for i in range(0, len(data), chunk_size):
+        text = decoder.decode(data[i:i+chunk_size])
+        if text:
+            yield text
+    text = decoder.decode(b'', True)
+    if text:
+        yield text
+
+def decode(r):
+    'Return the content of the requests.Response r as a string.'
+    return r.content.decode(response_encoding(r), 'replace')
@@ -17,15 +17,22 @@
 '''Contains the EpubBuilder class to build epub2.0.1 files with the getebook
 module.'''
 
-import html
 import re
 import datetime
 import getebook
+import hashlib
+import json
+import os
 import os.path
-import re
-import zipfile
 
-__all__ = ['EpubBuilder', 'EpubTOC', 'Author']
+__all__ = ['EpubBuilder', 'EpubTOC', 'Author', 'ChunkWriter', 'pack',
+           'read_build_info']
+
+# Name of the archive member with the build fingerprint.
+_build_info_name = 'META-INF/getebook.json'
+# Timestamp of all archive members in reproducible mode. This is the
+# earliest date a zip file can store.
+_fixed_date = (1980, 1, 1, 0, 0, 0)
 
 def _normalize(name):
     '''Transform "Firstname [Middlenames] Lastname" into
@@ -35,21 +42,87 @@ def _normalize(name):
         return name
     return split[-1] + ', ' + ' '.join(name[0:-1])
 
+# Translation tables for escaping text and attribute values. Characters
+# that are not allowed in XML are removed.
+_text_table = {ord('&'): '&amp;', ord('<'): '&lt;', ord('>'): '&gt;',
+               0xfffe: None, 0xffff: None}
+for _c in range(32):
+    if not _c in (9, 10, 13):
+        _text_table[_c] = None
+_attr_table = dict(_text_table)
+_attr_table.update({ord('"'): '&quot;', ord("'"): '&#x27;'})
+# Most strings need no escaping at all, and searching for the characters
+# that do is much faster than str.translate.
+_text_special = re.compile('[&<>\x00-\x08\x0b\x0c\x0e-\x1f\ufffe\uffff]')
+_attr_special = re.compile('[&<>"\'\x00-\x08\x0b\x0c\x0e-\x1f\ufffe\uffff]')
+# Tag and attribute names that can be written to XHTML. Anything else
+# (e.g., "o:p" from word processors) would make the file invalid.
+_name_re = re.compile('^[a-zA-Z_][-a-zA-Z0-9_.]*$')
+
+def _create_tmp(directory):
+    '''Create an empty temporary file in directory and return its name.
+    Unlike with tempfile.mkstemp, the permissions follow the umask, as
+    for any new file, so the file can be renamed to its final name as
+    it is.'''
+    while True:
+        name = os.path.join(directory, 'tmp%s.tmp' % os.urandom(6).hex())
+        try:
+            fd = os.open(name, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+        except FileExistsError:
+            continue
+        os.close(fd)
+        return name
+
+def _escape(text):
+    'Escape text for use in XML.'
+    if _text_special.search(text):
+        return text.translate(_text_table)
+    return text
+
+def _escape_attr(val):
+    'Escape an attribute value for use in XML.'
+    if _attr_special.search(val):
+        return val.translate(_attr_table)
+    return val
+
+_heading_tags = frozenset(getebook._headings)
+
+# Start tags that have already been written, by (tag, attributes).
+_starttags = {}
+
 def _make_starttag(tag, attrs):
-    'Write a starttag.'
-    out = '<' + tag
-    for key in attrs:
-        out += ' {}="{}"'.format(key, html.escape(attrs[key]))
-    out += '>'
+    '''Write a starttag. Attributes without value get their name as
+    value, attributes with invalid names are left out.'''
+    key = (tag, tuple(attrs.items()))
+    try:
+        return _starttags[key]
+    except KeyError:
+        pass
+    except TypeError:
+        # Unhashable attribute value, just don't cache it.
+        key = None
+    out = ['<', tag]
+    for (name, val) in attrs.items():
+        if not _name_re.match(name) and name != 'xml:lang':
+            continue
+        if val is None:
+            val = name
+        out.append(' %s="%s"' % (name, _escape_attr(str(val))))
+    out.append('>')
+    out = ''.join(out)
+    if key:
+        if len(_starttags) >= 4096:
+            _starttags.clear()
+        _starttags[key] = out
     return out
 
 def _make_xml_elem(tag, text, attr = []):
     'Write a flat xml element.'
     out = '    <' + tag
     for (key, val) in attr:
-        out += ' {}="{}"'.format(key, val)
+        out += ' {}="{}"'.format(key, _escape_attr(val))
     if text:
-        out += '>{}</{}>\n'.format(text, tag)
+        out += '>{}</{}>\n'.format(_escape(text), tag)
     else:
         out += ' />\n'
     return out
@@ -84,8 +157,8 @@ class EpubTOC(getebook.TOC):
 
     def _navp_xml(self, entry, indent_lvl):
         'Write xml for an entry and all its subentries.'
-        xml = self._navp.format('  '*indent_lvl, str(entry.no), entry.text,
-          entry.target)
+        xml = self._navp.format('  '*indent_lvl, str(entry.no),
+          _escape(entry.text), _escape_attr(entry.target))
         for sub in entry.entries:
             xml += self._navp_xml(sub, indent_lvl+1)
         xml += '  '*indent_lvl + '</navPoint>\n'
@@ -93,9 +166,10 @@ class EpubTOC(getebook.TOC):
 
     def write_xml(self, uid, title, authors):
         'Write the xml code for the table of contents.'
-        xml = self._head.format(uid, self.max_depth, title)
+        xml = self._head.format(_escape_attr(str(uid)), self.max_depth,
+                                _escape(str(title)))
         for aut in authors:
-            xml += self._doc_author.format(aut)
+            xml += self._doc_author.format(_escape(str(aut)))
         xml += '  <navMap>\n'
         for entry in self.entries:
             xml += self._navp_xml(entry, 2)
@@ -282,11 +356,183 @@ class _OPFfile:
             guide += finfo.guide_entry()
         return self._opf.format(metadata, manif, spine, guide)
 
+class ChunkWriter:
+    '''Non-seekable file object that collects everything written to it
+    until it is taken out with take(). Use it to stream an epub as it is
+    being built, e.g. from a WSGI application:
+
+    >>> out = ChunkWriter()
+    >>> builder = EpubBuilder(out)
+    >>> # ... add content to builder and yield out.take() after every page
+    >>> builder.finalize()
+    >>> yield out.take()'''
+    def __init__(self):
+        'Initialize with no data.'
+        self._chunks = []
+
+    def write(self, data):
+        'Collect data and return its length.'
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        'Return the data written since the last call and forget it.'
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+class _DirArchive:
+    '''Stand-in for zipfile.ZipFile that writes the members of the epub
+    as files in a directory (an "exploded" epub). A file is only
+    rewritten if its content changed.'''
+    compression = None
+
+    def __init__(self, directory):
+        '''Initialize. The directory is created if necessary; if it
+        exists, it must be empty or contain an exploded epub.'''
+        if os.path.isdir(directory) and os.listdir(directory) and \
+           not os.path.exists(os.path.join(directory, 'mimetype')):
+            raise ValueError('%s is not an exploded epub' % directory)
+        os.makedirs(directory, exist_ok = True)
+        self.directory = directory
+        self.written = set()
+        # Members whose files were written or deleted
+        self.changed = []
+
+    def _path(self, name):
+        'Return the filename of the member name.'
+        return os.path.join(self.directory, *name.split('/'))
+
+    def writestr(self, zinfo_or_arcname, data, compress_type = None):
+        'Write data (str or bytes) to the member with the given name.'
+        name = getattr(zinfo_or_arcname, 'filename', zinfo_or_arcname)
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        self.written.add(name)
+        path = self._path(name)
+        try:
+            if os.path.getsize(path) == len(data):
+                with open(path, 'rb') as f:
+                    if f.read() == data:
+                        return
+        except FileNotFoundError:
+            os.makedirs(os.path.dirname(path), exist_ok = True)
+        with open(path, 'wb') as f:
+            f.write(data)
+        self.changed.append(name)
+
+    def write(self, filename, arcname):
+        'Copy the file filename to the member arcname.'
+        with open(filename, 'rb') as f:
+            self.writestr(arcname, f.read())
+
+    def remove_stale(self):
+        '''Delete the files of all members that were not written, e.g.
+        parts that a previous build of the book had in addition.'''
+        for name in _members(self.directory):
+            if not name in self.written:
+                os.remove(self._path(name))
+                self.changed.append(name)
+
+    def close(self):
+        'Nothing to do; the files are complete when they are written.'
+        pass
+
+def _members(directory):
+    '''Return the names of the members of the exploded epub in
+    directory, in the order they are packed.'''
+    names = []
+    for (dirpath, dirnames, filenames) in os.walk(directory):
+        rel = os.path.relpath(dirpath, directory)
+        for fn in filenames:
+            if rel == '.':
+                names.append(fn)
+            else:
+                names.append('/'.join(rel.split(os.sep) + [fn]))
+    # The mimetype file must come first, and readers find the rest
+    # through META-INF/container.xml.
+    first = ['mimetype', 'META-INF/container.xml']
+    return [n for n in first if n in names] + \
+           sorted(n for n in names if not n in first)
+
+def pack(directory, epub_file, reproducible = False, compress = True):
+    '''Pack the exploded epub in directory (see EpubBuilder) into
+    epub_file (a filename or a writable binary file object). In
+    reproducible mode, the members get a fixed timestamp and
+    permissions. If compress is False, the members are stored without
+    compression, which is faster.'''
+    import zipfile
+    if compress:
+        compression = zipfile.ZIP_DEFLATED
+    else:
+        compression = zipfile.ZIP_STORED
+    with zipfile.ZipFile(epub_file, 'w', compression) as zf:
+        for name in _members(directory):
+            path = os.path.join(directory, *name.split('/'))
+            if name == 'mimetype':
+                compress_type = zipfile.ZIP_STORED
+            else:
+                compress_type = compression
+            if reproducible:
+                zinfo = zipfile.ZipInfo(name, _fixed_date)
+                zinfo.compress_type = compress_type
+                zinfo.create_system = 3 # Unix
+                zinfo.external_attr = 0o644 << 16
+                with open(path, 'rb') as f:
+                    zf.writestr(zinfo, f.read())
+            else:
+                zf.write(path, name, compress_type)
+
+def read_build_info(epub_file):
+    '''Return the build information stored in an epub made by
+    EpubBuilder, or None if there is none (or epub_file is not an epub
+    file). It is a dict with the keys "fingerprint" (of the whole build),
+    "config" (of the settings of the builder and parser) and "pages" (a
+    list of [url, sha256] for every page the book was made from). See
+    EpubBuilder.fingerprint and getebook.EbookParser.unchanged.
+    epub_file can also be the directory of an exploded epub.'''
+    import zipfile
+    if isinstance(epub_file, str) and os.path.isdir(epub_file):
+        try:
+            with open(os.path.join(epub_file, *_build_info_name.split('/')),
+                      encoding = 'utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+    try:
+        with zipfile.ZipFile(epub_file) as zf:
+            return json.loads(zf.read(_build_info_name).decode('utf-8'))
+    except (OSError, KeyError, ValueError, zipfile.BadZipFile):
+        return None
+
 class EpubBuilder:
     '''Builds an epub2.0.1 file. Some of the attributes of this class
     (title, uid, lang) are marked as "mandatory" because they represent
     metadata that is required by the epub specification. If these
-    attributes are left unset, default values will be used.'''
+    attributes are left unset, default values will be used.
+
+    In reproducible mode, building the same book twice gives exactly the
+    same file: all archive members get a fixed timestamp, the optional
+    metadata is written in a fixed order and the default uid is derived
+    from the content instead of being random.
+
+    Every epub contains a fingerprint of the build, computed from the
+    settings of the builder and parser and the content of the pages the
+    book was made from (which the parser reports with add_config and
+    add_source). A batch job can compare it with an existing file to
+    skip books that have not changed:
+
+    >>> builder = EpubBuilder(\'out.epub\', reproducible = True)
+    >>> # ... set metadata, add title page, create parser p
+    >>> info = read_build_info(\'out.epub\')
+    >>> if info and p.unchanged(info):
+    ...     builder.discard()
+    ... else:
+    ...     p.getebook(base, path)
+    ...     builder.finalize()'''
 
     _style_css = (
       'h1, h2, h3, h4, h5, h6 {\n'
@@ -352,36 +598,119 @@ class EpubBuilder:
     )
 
     _finalized = False
+    _tmp_name = None
 
-    def __init__(self, epub_file):
-        '''Initialize the EpubBuilder instance. "epub_file" is the
-        filename of the epub to be created.'''
-        self.epub_f = zipfile.ZipFile(epub_file, 'w', zipfile.ZIP_DEFLATED)
-        self.epub_f.writestr('mimetype', 'application/epub+zip')
-        self.epub_f.writestr('META-INF/container.xml', self._container_xml)
+    def __init__(self, epub_file, reproducible = False, index = False,
+                 exploded = False):
+        '''Initialize the EpubBuilder instance. "epub_file" is either the
+        filename of the epub to be created or a writable binary file
+        object. The file object does not need to be seekable, so the
+        epub can be written directly to a socket or an HTTP response
+        (see ChunkWriter). It is not closed by the builder. A file given
+        by name is only replaced when the epub is finalized, and in
+        reproducible mode, it is left alone if the new epub is
+        identical. If index is True, a full-text index of the book is
+        built in the index attribute and stored in the epub (see the
+        search submodule).
+
+        If exploded is True, epub_file is the name of a directory, and
+        the members of the epub are written there as separate files
+        instead of to a zip archive. A file is only rewritten if its
+        content changed, and files in the directory that don\'t belong
+        to the new book are deleted when it is finalized. Use pack to
+        turn the directory into an epub file.'''
+        import zipfile
+        self._zipfile = zipfile
+        self.reproducible = reproducible
+        self.exploded = exploded
+        if exploded:
+            self.epub_f = _DirArchive(epub_file)
+        else:
+            if isinstance(epub_file, str):
+                self.filename = epub_file
+                self._tmp_name = _create_tmp(
+                                   os.path.dirname(os.path.abspath(epub_file)))
+                epub_file = self._tmp_name
+            self.epub_f = zipfile.ZipFile(epub_file, 'w',
+                                          zipfile.ZIP_DEFLATED)
+        # Settings and sources of the build, for the fingerprint
+        self.inputs = []
+        self._content_hash = hashlib.sha256()
+        # The mimetype file must come first and must not be compressed.
+        self._writestr('mimetype', 'application/epub+zip',
+                       zipfile.ZIP_STORED)
+        self._writestr('META-INF/container.xml', self._container_xml)
         self.toc = EpubTOC()
         self.opf = _OPFfile()
         self.opf.filelist.append(_Fileinfo('toc.ncx', False))
         self.opf.filelist.append(_Fileinfo('style.css', False))
         self._authors = []
         self.opt_meta = {} # Optional metadata (other than authors)
-        self.content = ''
+        self._content = [] # XHTML of the current part, in pieces
         self.part_no = 0
         self.cont_filename = 'part%03d.html' % self.part_no
+        if index:
+            import getebook.search
+            self.index = getebook.search.Index()
+            self.index.new_part(self.cont_filename)
+            self.add_config('index', True)
+        else:
+            self.index = None
 
     def __enter__(self):
         'Return self for use in with ... as ... statement.'
         return self
 
     def __exit__(self, except_type, except_val, traceback):
-        'Call finalize() and close the file.'
+        '''Call finalize() and close the file. If the with block raised an
+        exception, call discard() instead, so a partial book doesn't
+        replace an existing file.'''
+        if except_type:
+            if not self._finalized:
+                self.discard()
+            return False
         try:
             self.finalize()
         finally:
             # Close again in case an exception happened in finalize()
             self.epub_f.close()
+            self._remove_tmp()
         return False
 
+    def _remove_tmp(self):
+        'Remove the temporary file if it is still there.'
+        if self._tmp_name:
+            try:
+                os.remove(self._tmp_name)
+            except FileNotFoundError:
+                pass
+            self._tmp_name = None
+
+    def _writestr(self, name, data, compress_type = None):
+        '''Write data (str or bytes) to the archive under name. In
+        reproducible mode, the member gets a fixed timestamp and
+        permissions.'''
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        self._content_hash.update(name.encode('utf-8') + b'\0')
+        self._content_hash.update(hashlib.sha256(data).digest())
+        if self.reproducible:
+            zinfo = self._zipfile.ZipInfo(name, _fixed_date)
+            # ZIP_STORED is 0, so don't test compress_type for truth.
+            if compress_type is None:
+                compress_type = self.epub_f.compression
+            zinfo.compress_type = compress_type
+            zinfo.create_system = 3 # Unix
+            zinfo.external_attr = 0o644 << 16
+            self.epub_f.writestr(zinfo, data)
+        else:
+            self.epub_f.writestr(name, data, compress_type)
+
+    @property
+    def content(self):
+        'XHTML code of the current part. (read-only)'
+        return ''.join(self._content)
+
     @property
     def uid(self):
         '''Unique identifier of the ebook. (mandatory)
@@ -392,14 +721,25 @@ class EpubBuilder:
         try:
             return self._uid
         except AttributeError:
-            import random
-            from string import (ascii_letters, digits)
-            alnum = ascii_letters + digits
-            self.uid = ''.join([random.choice(alnum) for i in range(15)])
-            return self._uid
+            pass
+        if self.reproducible:
+            # Derived from everything written so far, so this is only
+            # final when the epub is finalized.
+            return self._make_uid('getebook-' + \
+                                  self._content_hash.hexdigest()[:32])
+        import random
+        from string import (ascii_letters, digits)
+        alnum = ascii_letters + digits
+        self._uid = self._make_uid(''.join([random.choice(alnum)
+                                            for i in range(15)]))
+        return self._uid
     @uid.setter
     def uid(self, val):
-        self._uid = _EpubMeta('dc:identifier', str(val), ('id', 'uid_id'))
+        self._uid = self._make_uid(val)
+        self._uid_set = True
+
+    def _make_uid(self, val):
+        return _EpubMeta('dc:identifier', str(val), ('id', 'uid_id'))
 
     @property
     def title(self):
@@ -524,33 +864,44 @@ class EpubBuilder:
             if len(self._authors) == 1:
                 aut_str = str(self._authors[0])
             else:
-                aut_str = ', '.join(str(self._authors[0:-1])) + ', and ' \
-                                                       + str(self._authors[-1])
-            tp += '<div class="getebook-tp-authors">%s</div>\n' % aut_str
+                aut_str = ', '.join([str(a) for a in self._authors[0:-1]]) \
+                                          + ', and ' + str(self._authors[-1])
+            tp += '<div class="getebook-tp-authors">%s</div>\n' % \
+                                                               _escape(aut_str)
         if not main_title:
             main_title = str(self.title)
-        tp += '<div class="getebook-tp-title">%s' % main_title
+        tp += '<div class="getebook-tp-title">%s' % _escape(main_title)
         if subtitle:
-            tp += '<div class="getebook-tp-sub">%s</div>' % subtitle
+            tp += '<div class="getebook-tp-sub">%s</div>' % _escape(subtitle)
         tp += '</div>\n</div>\n'
         self.opf.filelist.insert(0, _Fileinfo('title.html',
           guide_title = 'Titlepage', guide_type = 'title-page'))
-        self.epub_f.writestr('title.html', self._html.format(self.title, tp))
+        self.inputs.append(['titlepage', main_title, subtitle])
+        self._writestr('title.html',
+                       self._html.format(_escape(str(self.title)), tp))
 
     def headingpage(self, heading, subtitle = None, toc_text = None):
         '''Create a page containing only a (large) heading, optionally
         with a smaller subtitle. If toc_text is not given, it defaults
         to the heading.'''
+        self.inputs.append(['headingpage', heading, subtitle, toc_text])
         self.new_part()
         tag = 'h%d' % min(6, self.toc.depth)
-        self.content += '<div class="getebook-tp">'
-        self.content += '<{} class="getebook-tp-title">{}'.format(tag, heading)
+        self._content.append('<div class="getebook-tp">')
+        self._content.append('<{} class="getebook-tp-title">{}'.format(tag,
+                                                             _escape(heading)))
         if subtitle:
-            self.content += '<div class="getebook-tp-sub">%s</div>' % subtitle
-        self.content += '</%s>\n' % tag
+            self._content.append('<div class="getebook-tp-sub">%s</div>'
+                                 % _escape(subtitle))
+        self._content.append('</%s></div>\n' % tag)
         if not toc_text:
             toc_text = heading
         self.toc.new_entry(toc_text, self.cont_filename)
+        if self.index:
+            self.index.new_entry(toc_text)
+            self.index.add_text(heading)
+            if subtitle:
+                self.index.add_text(subtitle)
         self.new_part()
 
     def insert_file(self, name, in_spine = False, guide_title = None,
@@ -562,7 +913,15 @@ class EpubBuilder:
             arcname = os.path.basename(name)
         self.opf.filelist.append(_Fileinfo(arcname, in_spine, guide_title,
                                  guide_type))
-        self.epub_f.write(name, arcname)
+        with open(name, 'rb') as f:
+            data = f.read()
+        self.inputs.append(['file', arcname,
+                            hashlib.sha256(data).hexdigest()])
+        if self.reproducible:
+            self._writestr(arcname, data)
+        else:
+            # Keep the timestamp and permissions of the file.
+            self.epub_f.write(name, arcname)
 
     def add_file(self, arcname, str_or_bytes, in_spine = False,
       guide_title = None, guide_type = None):
@@ -570,7 +929,62 @@ class EpubBuilder:
         under the name arcname.'''
         self.opf.filelist.append(_Fileinfo(arcname, in_spine, guide_title,
                                  guide_type))
-        self.epub_f.writestr(arcname, str_or_bytes)
+        if isinstance(str_or_bytes, str):
+            str_or_bytes = str_or_bytes.encode('utf-8')
+        self.inputs.append(['file', arcname,
+                            hashlib.sha256(str_or_bytes).hexdigest()])
+        self._writestr(arcname, str_or_bytes)
+
+    def add_config(self, name, config):
+        '''Record settings that determine the content of the book (e.g.
+        those of the parser, see getebook.EbookParser.config) for the
+        build fingerprint. config must be serializable as JSON.'''
+        self.inputs.append(self.config_input(name, config))
+
+    def config_input(self, name, config):
+        '''Return the entry that add_config(name, config) adds to
+        inputs, without adding it.'''
+        return ['config', name, config]
+
+    def add_source(self, url, content):
+        '''Record that the page at url, with content (bytes), is read
+        for the book. The pages are part of the build fingerprint.'''
+        self.inputs.append(['page', url, hashlib.sha256(content).hexdigest()])
+
+    def _fingerprint(self, inputs):
+        'Return the hash of inputs and of the settings of the builder.'
+        meta = [self.lang, self.title] + self._authors
+        meta += [self.opt_meta[key] for key in sorted(self.opt_meta)]
+        if getattr(self, '_uid_set', False):
+            meta.append(self._uid)
+        h = hashlib.sha256()
+        h.update(getebook._library_fingerprint().encode())
+        h.update(json.dumps([[[m.tag, m.text, list(m.attr)] for m in meta],
+                             self._style_css, self.reproducible, inputs],
+                            sort_keys = True).encode('utf-8'))
+        return h.hexdigest()
+
+    def config_fingerprint(self, inputs = None):
+        '''Return the fingerprint of the settings of the build, i.e.,
+        of everything except the content of the pages. By default, the
+        inputs recorded so far are used.'''
+        if inputs is None:
+            inputs = self.inputs
+        return self._fingerprint([i for i in inputs if i[0] != 'page'])
+
+    @property
+    def fingerprint(self):
+        '''Fingerprint of the build: a hash of the metadata, the
+        stylesheet, the title page and added files, the settings of the
+        parser, the content of all pages and the getebook source code.
+        (read-only)'''
+        return self._fingerprint(self.inputs)
+
+    def build_info(self):
+        'Return the build information that is stored in the epub.'
+        return {'fingerprint': self.fingerprint,
+                'config': self.config_fingerprint(),
+                'pages': [i[1:] for i in self.inputs if i[0] == 'page']}
 
     def false_heading(self, elem):
         '''Handle a "false heading", i.e., text that appears in heading
@@ -599,12 +1013,13 @@ class EpubBuilder:
         # Set the class attribute value.
         elem.attrs['class'] = 'getebook-chapter-h'
         self.toc.new_entry(toc_text, self.cont_filename)
+        if self.index:
+            self.index.new_entry(toc_text)
         # Add heading to the epub.
         tag = 'h%d' % min(self.toc.depth, 6)
-        self.content += _make_starttag(tag, elem.attrs)
-        for elem in elem.children:
-            self.handle_elem(elem)
-        self.content += '</%s>\n' % tag
+        self._content.append(_make_starttag(tag, elem.attrs))
+        self._write(elem.children)
+        self._content.append('</%s>\n' % tag)
 
     def par_heading(self, elem):
         '''Handle a "paragraph heading", i.e., a chaper heading or part
@@ -615,68 +1030,116 @@ class EpubBuilder:
     def _handle_par_h(self):
         'Check if there is a waiting paragraph heading and handle it.'
         try:
-            self._heading(self.par_h)
+            par_h = self.par_h
         except AttributeError:
             pass
+        else:
+            # Remove it first, otherwise _heading merges it with itself.
+            del self.par_h
+            self._heading(par_h)
 
     def handle_elem(self, elem):
         'Handle html element as supplied by getebook.EbookParser.'
-        try:
-            tag = elem.tag
-        except AttributeError:
-            # elem should be a string
-            is_string = True
-            tag = None
-        else:
-            is_string = False
-        if tag in getebook._headings:
+        if getattr(elem, 'tag', None) in _heading_tags:
             self._heading(elem)
         else:
             # Handle waiting par_h if necessary (see par_heading)
-            try:
-                self._heading(self.par_h)
-            except AttributeError:
-                pass
-            if is_string:
-                self.content += elem
-            elif tag == 'br':
-                self.content += '<br />\n'
-            elif tag == 'img':
-                self.content += self._handle_image(elem.attrs) + '\n'
-            elif tag == 'a' or tag == 'noscript':
-                # Ignore tag, just write child elements
-                for child in elem.children:
-                    self.handle_elem(child)
+            self._handle_par_h()
+            self._write((elem,))
+
+    def start_elem(self, elem):
+        '''Write the start tag of elem. Its children are passed to
+        handle_elem after this, followed by a call of end_elem. This is
+        used by getebook.EbookParser to write the content of large
+        elements piece by piece.'''
+        self._handle_par_h()
+        tag = elem.tag
+        if not (tag == 'a' or tag == 'noscript' or not _name_re.match(tag)):
+            self._content.append(_make_starttag(tag, elem.attrs))
+
+    def end_elem(self, elem):
+        'Write the end tag of an element started with start_elem.'
+        self._handle_par_h()
+        tag = elem.tag
+        if tag == 'p':
+            self._content.append('</p>\n')
+        elif not (tag == 'a' or tag == 'noscript' or \
+                  not _name_re.match(tag)):
+            self._content.append('</%s>' % tag)
+
+    def _write(self, elems):
+        '''Write the elements (and strings) in elems and all their
+        children as XHTML. The tree is walked with an explicit stack, so
+        deeply nested elements don\'t hit the recursion limit.'''
+        append = self._content.append
+        index = self.index
+        # Iterators over the children of the open elements, and their
+        # end tags (None for elements whose tags are not written).
+        stack = [iter(elems)]
+        end_tags = []
+        while True:
+            for child in stack[-1]:
+                if isinstance(child, str):
+                    append(_escape(child))
+                    if index:
+                        index.add_text(child)
+                    continue
+                tag = child.tag
+                if tag in _heading_tags:
+                    self._heading(child)
+                elif tag == 'br':
+                    append('<br />\n')
+                elif tag == 'img':
+                    append(self._handle_image(child.attrs) + '\n')
+                elif tag == 'a' or tag == 'noscript' or \
+                     not _name_re.match(tag):
+                    # Ignore tag, just write child elements
+                    stack.append(iter(child.children))
+                    end_tags.append(None)
+                    break
+                else:
+                    append(_make_starttag(tag, child.attrs))
+                    stack.append(iter(child.children))
+                    if tag == 'p':
+                        end_tags.append('</p>\n')
+                    else:
+                        end_tags.append('</%s>' % tag)
+                    break
             else:
-                self.content += _make_starttag(tag, elem.attrs)
-                for child in elem.children:
-                    self.handle_elem(child)
-                self.content += '</%s>' % tag
-                if tag == 'p':
-                    self.content += '\n'
+                # All children of the innermost element are written.
+                stack.pop()
+                if not end_tags:
+                    return
+                end_tag = end_tags.pop()
+                if end_tag:
+                    append(end_tag)
 
     def _handle_image(self, attrs):
-        'Returns the alt text of an image tag.'
+        'Returns the (escaped) alt text of an image tag.'
         try:
-            return attrs['alt']
+            return _escape(attrs['alt'] or '')
         except KeyError:
             return ''
 
+    def _write_part(self):
+        'Write the current part to the archive.'
+        html = self._html.format(_escape(str(self.title)),
+                                 ''.join(self._content))
+        self._writestr(self.cont_filename, html)
+
     def new_part(self):
         '''Begin a new part of the epub. Write the current html document
         to the archive and begin a new one.'''
         # Handle waiting par_h (see par_heading)
-        try:
-            self._heading(self.par_h)
-        except AttributeError:
-            pass
-        if self.content:
-            html = self._html.format(self.title, self.content)
-            self.epub_f.writestr(self.cont_filename, html)
+        self._handle_par_h()
+        if self._content:
+            self._write_part()
             self.part_no += 1
-        self.content = ''
+        self._content = []
         self.cont_filename = 'part%03d.html' % self.part_no
         self.opf.filelist.append(_Fileinfo(self.cont_filename))
+        if self.index:
+            self.index.new_part(self.cont_filename)
 
     def finalize(self):
         'Complete and close the epub file.'
@@ -686,18 +1149,90 @@ class EpubBuilder:
             # a with-block would lead to an exception when __exit__
             # calls finalize again.
             return
+        self._handle_par_h()
+        if self._content:
+            self._write_part()
+        self._writestr('style.css', self._style_css)
+        self._writestr(_build_info_name,
+                       json.dumps(self.build_info(), sort_keys = True))
+        if self.reproducible and not hasattr(self, '_uid'):
+            self._uid = self.uid
+        if self.index:
+            # Written after the uid is fixed, since it contains it.
+            import getebook.search
+            catalog = self.index.catalog(str(self.uid), str(self.title),
+                                         [str(a) for a in self._authors])
+            self._writestr(getebook.search._index_name,
+                           json.dumps(catalog, sort_keys = True,
+                                      separators = (',', ':')))
+        self.opf.meta = [self.uid, self.lang, self.title] + self._authors
+        if self.reproducible:
+            self.opf.meta += [self.opt_meta[key]
+                              for key in sorted(self.opt_meta)]
+        else:
+            self.opf.meta += self.opt_meta.values()
+        self._writestr('package.opf', self.opf.write_xml())
+        self._writestr('toc.ncx',
+          self.toc.write_xml(self.uid, self.title, self._authors))
         try:
-            self._heading(self.par_h)
+            remove_stale = self.epub_f.remove_stale
         except AttributeError:
             pass
-        if self.content:
-            html = self._html.format(self.title, self.content)
-            self.epub_f.writestr(self.cont_filename, html)
-        self.opf.meta = [self.uid, self.lang, self.title] + self._authors
-        self.opf.meta += self.opt_meta.values()
-        self.epub_f.writestr('package.opf', self.opf.write_xml())
-        self.epub_f.writestr('toc.ncx',
-          self.toc.write_xml(self.uid, self.title, self._authors))
-        self.epub_f.writestr('style.css', self._style_css)
+        else:
+            remove_stale()
         self.epub_f.close()
         self._finalized = True
+        if self._tmp_name:
+            self._replace_file()
+
+    def _replace_file(self):
+        '''Move the finished epub to its final name. In reproducible
+        mode, an identical existing file is kept instead.'''
+        if self.reproducible:
+            import filecmp
+            try:
+                same = filecmp.cmp(self._tmp_name, self.filename,
+                                   shallow = False)
+            except OSError:
+                same = False
+            if same:
+                self._remove_tmp()
+                return
+        os.replace(self._tmp_name, self.filename)
+        self._tmp_name = None
+
+    def write_style(self):
+        '''Only write style.css and stop, leaving the other files of an
+        exploded epub as they are. This allows trying out changes to the
+        stylesheet without building the book again. The build
+        information is not updated, so the book is not regarded as
+        unchanged the next time it is built (see read_build_info). The
+        builder can not be used afterwards.'''
+        if not self.exploded:
+            raise ValueError('write_style only works in exploded mode')
+        self._writestr('style.css', self._style_css)
+        self.discard()
+
+    def discard(self):
+        '''Stop building without writing the epub. A file given by name
+        is left as it was. The builder can not be used afterwards.'''
+        self._finalized = True
+        self.epub_f.close()
+        self._remove_tmp()
+
+def main(argv = None):
+    'Pack an exploded epub from the command line.'
+    import argparse
+    argp = argparse.ArgumentParser(description = ('Pack an exploded epub '
+                                   '(see EpubBuilder) into an epub file.'))
+    argp.add_argument('directory')
+    argp.add_argument('filename')
+    argp.add_argument('--reproducible', action = 'store_true',
+                      help = 'use fixed timestamps and permissions')
+    argp.add_argument('--store', action = 'store_true',
+                      help = 'don\'t compress (faster, but a bigger file)')
+    args = argp.parse_args(argv)
+    pack(args.directory, args.filename, args.reproducible, not args.store)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+# Copyright (c) 2016, Max Fillinger <max@max-fillinger.net>
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES WITH
+# REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF MERCHANTABILITY
+# AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY SPECIAL, DIRECT,
+# INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES WHATSOEVER RESULTING FROM
+# LOSS OF USE, DATA OR PROFITS, WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR
+# OTHER TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR
+# PERFORMANCE OF THIS SOFTWARE.
+
+'''Recording and replaying the output of getebook.EbookParser.
+
+The parser hands its results to a builder by calling the methods
+handle_elem, par_heading, false_heading, start_elem and end_elem. A
+Recorder takes the place of the builder and keeps these calls as a list
+of events, which can be pickled (e.g. to send them to another process or
+to store them) and replayed into a real builder later. Replaying gives
+the same result as parsing the page with the builder directly.'''
+
+import getebook
+
+__all__ = ['PageResult', 'Recorder', 'parse_page', 'replay']
+
+class Recorder:
+    '''Builder stand-in that records the calls made by the parser. The
+    events are (method name, argument) pairs in the list events.'''
+    def __init__(self):
+        'Initialize with no events.'
+        self.events = []
+
+    def handle_elem(self, elem):
+        self.events.append(('handle_elem', elem))
+
+    def par_heading(self, elem):
+        self.events.append(('par_heading', elem))
+
+    def false_heading(self, elem):
+        self.events.append(('false_heading', elem))
+
+    def start_elem(self, elem):
+        # The parser adds children to elem after this call, but only the
+        # tag and attributes are needed here.
+        self.events.append(('start_elem', getebook.Element(elem.tag,
+                                                           elem.attrs)))
+
+    def end_elem(self, elem):
+        self.events.append(('end_elem', getebook.Element(elem.tag, ())))
+
+class PageResult:
+    '''Everything the parser found on one page: the events for the
+    builder, the link to the next page (next_part, None if there is none),
+    the URL from a <base> tag (base, None if there is none) and the
+    problems in the html (diagnostics, a getebook.Diagnostics instance or
+    None).'''
+    def __init__(self, events, next_part, base, diagnostics):
+        self.events = events
+        self.next_part = next_part
+        self.base = base
+        self.diagnostics = diagnostics
+
+def parse_page(parser, url, text, chunk_size = 1 << 16):
+    '''Parse one page with parser, whose builder must be a Recorder, and
+    return a PageResult. url is the URL of the page and text its
+    content as a string. If the parser collects diagnostics, a fresh
+    getebook.Diagnostics instance is used for the page.'''
+    try:
+        del parser.base
+    except AttributeError:
+        pass
+    if parser.diagnostics:
+        parser.diagnostics = getebook.Diagnostics(
+                               parser.diagnostics.max_samples)
+        parser.diagnostics.url = url
+        parser.diagnostics.pages = 1
+    parser.builder.events = []
+    for i in range(0, len(text), chunk_size):
+        parser.feed(text[i:i+chunk_size])
+    parser.close()
+    result = PageResult(parser.builder.events, parser.next_part,
+                        getattr(parser, 'base', None), parser.diagnostics)
+    parser.reset()
+    return result
+
+def replay(events, builder):
+    'Make the calls recorded in events on builder.'
+    methods = {}
+    for (name, arg) in events:
+        try:
+            method = methods[name]
+        except KeyError:
+            method = methods[name] = getattr(builder, name)
+        method(arg)
@@ -0,0 +1,337 @@
+# Copyright (c) 2016, Max Fillinger <max@max-fillinger.net>
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES WITH
+# REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF MERCHANTABILITY
+# AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY SPECIAL, DIRECT,
+# INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES WHATSOEVER RESULTING FROM
+# LOSS OF USE, DATA OR PROFITS, WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR
+# OTHER TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR
+# PERFORMANCE OF THIS SOFTWARE.
+
+'''Polite downloading of webpages.
+
+All pages are fetched through a RateLimiter, which keeps a token bucket
+and a limit on concurrent connections for every host. If the server
+answers with 429 or 503 (or any other server error), the limiter backs
+off, honoring a Retry-After header if there is one.
+
+On systems that support fcntl, the state of the limiter is kept in lock
+files in a directory of the user, so all threads and processes of the
+user share the budget for a host.
+
+Requests time out after 30 seconds without an answer from the server by
+default, so that a stalled connection doesn't hold on to its host's
+connection slot (and the build) forever.
+
+Example:
+
+>>> import getebook.fetch
+>>> r = getebook.fetch.get(\'http://www.ebook-site.org/some-book/1\')'''
+
+import json
+import os
+import os.path
+import threading
+import time
+import urllib.parse
+
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows. The budget is only shared between
+    # threads then.
+    fcntl = None
+
+__all__ = ['RateLimiter', 'get', 'default_limiter']
+
+# Status codes that make the limiter back off and retry.
+_retry_codes = (429, 500, 502, 503, 504)
+
+def _retry_after(r):
+    '''Return the number of seconds given in the Retry-After header of
+    response r, or 0 if there is none.'''
+    try:
+        val = r.headers['Retry-After']
+    except KeyError:
+        return 0
+    try:
+        return max(0, float(val))
+    except ValueError:
+        pass
+    # Retry-After can also be a HTTP date.
+    import email.utils
+    try:
+        date = email.utils.parsedate_to_datetime(val)
+    except (TypeError, ValueError):
+        return 0
+    return max(0, date.timestamp() - time.time())
+
+class _HostState:
+    '''Token bucket and backoff state of one host. The state is a dict
+    with the keys "tokens", "time" (of the last update), "not_before"
+    (no requests before this time) and "delay" (current backoff delay).
+
+    Use the instance as a context manager to get exclusive access to the
+    state.'''
+    def __init__(self, path):
+        'Initialize. If path is None, the state is only kept in memory.'
+        self.path = path
+        self._lock = threading.Lock()
+        self._state = None
+
+    def _initial(self):
+        return {'tokens': None, 'time': time.time(), 'not_before': 0,
+                'delay': 0}
+
+    def __enter__(self):
+        self._lock.acquire()
+        if not self.path:
+            if not self._state:
+                self._state = self._initial()
+            return self._state
+        try:
+            self._f = open(self.path, 'a+')
+        except BaseException:
+            self._lock.release()
+            raise
+        fcntl.flock(self._f, fcntl.LOCK_EX)
+        self._f.seek(0)
+        try:
+            self._state = json.load(self._f)
+        except ValueError:
+            # New or damaged file
+            self._state = self._initial()
+        return self._state
+
+    def __exit__(self, except_type, except_val, traceback):
+        try:
+            if self.path:
+                self._f.seek(0)
+                self._f.truncate()
+                json.dump(self._state, self._f)
+                self._f.flush()
+                fcntl.flock(self._f, fcntl.LOCK_UN)
+                self._f.close()
+        finally:
+            self._lock.release()
+        return False
+
+def _default_state_dir():
+    '''Create the directory for the state of the user's limiters in the
+    system\'s temporary directory, and return its name. The name is
+    predictable, so another user may have created it first (and put
+    symbolic links to other files into it). Then, a warning is issued
+    and None is returned, so the state is not shared between
+    processes.'''
+    import stat
+    import tempfile
+    name = os.path.join(tempfile.gettempdir(),
+                        'getebook-ratelimit-%d' % os.getuid())
+    try:
+        os.makedirs(name, mode = 0o700, exist_ok = True)
+        st = os.lstat(name)
+    except OSError:
+        # E.g. a file of that name exists
+        st = None
+    if not st or not stat.S_ISDIR(st.st_mode) or \
+       st.st_uid != os.getuid() or stat.S_IMODE(st.st_mode) != 0o700:
+        import warnings
+        warnings.warn('%s is not a private directory of this user, the '
+                      'rate limit is not shared with other processes'
+                      % name)
+        return None
+    return name
+
+class RateLimiter:
+    '''Limits the rate of requests per host. rate is the sustained
+    number of requests per second, burst the number of requests that
+    can be made at once after a period of inactivity, and max_concurrent
+    the maximal number of simultaneous connections to a host. After an
+    error response, the limiter waits for the time given in the
+    Retry-After header, or for an exponentially increasing delay of at
+    most max_delay seconds. A request is tried up to max_tries times.
+    timeout is passed on to requests; a try fails if the server doesn't
+    answer for that many seconds.
+
+    If state_dir is given (and fcntl is available), the state is shared
+    through lock files in that directory with all other RateLimiter
+    instances using the same directory, also in other processes. Set it
+    to None to only share it between threads using this instance.'''
+
+    def __init__(self, rate = 1.0, burst = 3, max_concurrent = 2,
+                 max_delay = 300.0, max_tries = 5, state_dir = '',
+                 timeout = 30.0):
+        '''Initialize the limiter. By default, state_dir is a directory
+        of the user in the system\'s temporary directory. If that
+        directory belongs to somebody else or others can access it, the
+        state is not shared between processes.'''
+        # requests is only imported here since it is slow to import.
+        import requests
+        if rate <= 0:
+            raise ValueError('rate must be positive')
+        if max_concurrent < 1:
+            raise ValueError('max_concurrent must be at least 1')
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.max_concurrent = max_concurrent
+        self.max_delay = max_delay
+        self.max_tries = max_tries
+        self.timeout = timeout
+        if not fcntl:
+            state_dir = None
+        elif state_dir == '':
+            state_dir = _default_state_dir()
+        elif state_dir:
+            os.makedirs(state_dir, mode = 0o700, exist_ok = True)
+        self.state_dir = state_dir
+        self.session = requests.Session()
+        self._hosts = {}
+        self._semaphores = {}
+        self._lock = threading.Lock()
+        # Slot to wait for when all are taken (see _acquire_slot)
+        self._next_slot = 0
+
+    def _host_state(self, host):
+        'Return the _HostState instance for host.'
+        with self._lock:
+            try:
+                return self._hosts[host]
+            except KeyError:
+                if self.state_dir:
+                    path = os.path.join(self.state_dir,
+                                        host.replace(':', '_') + '.state')
+                else:
+                    path = None
+                self._hosts[host] = _HostState(path)
+                return self._hosts[host]
+
+    def _take_token(self, host):
+        '''Try to take a token from the bucket for host. Returns 0 on
+        success, otherwise the time to wait before trying again.'''
+        with self._host_state(host) as state:
+            now = time.time()
+            if state['tokens'] is None:
+                state['tokens'] = self.burst
+            state['tokens'] = min(self.burst, state['tokens'] \
+                                      + (now - state['time']) * self.rate)
+            state['time'] = now
+            if state['not_before'] > now:
+                return state['not_before'] - now
+            if state['tokens'] >= 1:
+                state['tokens'] -= 1
+                return 0
+            return (1 - state['tokens']) / self.rate
+
+    def _update(self, host, failed, retry_after = 0):
+        '''Update the backoff delay for host after a request. On failure,
+        the delay is doubled, on success it is halved.'''
+        with self._host_state(host) as state:
+            now = time.time()
+            if failed:
+                delay = min(self.max_delay,
+                            max(2 * state['delay'], 1 / self.rate))
+                state['delay'] = delay
+                state['not_before'] = max(state['not_before'],
+                                          now + max(delay, retry_after))
+                # Don't allow a burst right after the pause.
+                state['tokens'] = 0
+            elif state['delay']:
+                state['delay'] /= 2
+                if state['delay'] < 1 / self.rate:
+                    state['delay'] = 0
+
+    def _acquire_slot(self, host):
+        '''Wait until less than max_concurrent connections to host are
+        open. Returns an object that must be passed to _release_slot.'''
+        if not self.state_dir:
+            with self._lock:
+                try:
+                    sem = self._semaphores[host]
+                except KeyError:
+                    sem = threading.BoundedSemaphore(self.max_concurrent)
+                    self._semaphores[host] = sem
+            sem.acquire()
+            return sem
+        # Every slot is a lock file. Locks held by a process are
+        # released automatically if it dies, so slots can't leak.
+        prefix = os.path.join(self.state_dir, host.replace(':', '_'))
+        for i in range(self.max_concurrent):
+            f = open('%s.slot%d' % (prefix, i), 'a')
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                f.close()
+            else:
+                return f
+        # All slots are taken. Wait for one of them; the threads of this
+        # instance take turns, so that they don't all wait for the same.
+        with self._lock:
+            i = self._next_slot
+            self._next_slot = (i + 1) % self.max_concurrent
+        f = open('%s.slot%d' % (prefix, i), 'a')
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        except BaseException:
+            f.close()
+            raise
+        return f
+
+    def _release_slot(self, slot):
+        'Release a slot acquired with _acquire_slot.'
+        if not self.state_dir:
+            slot.release()
+        else:
+            fcntl.flock(slot, fcntl.LOCK_UN)
+            slot.close()
+
+    def get(self, url, **kwargs):
+        '''Send a GET request for url, respecting the limits for its
+        host. Keyword arguments are passed on to requests; timeout
+        defaults to the timeout of the limiter. Returns the response; if
+        all tries failed, that is the last error response. Connection
+        errors and timeouts are only raised after the last try.'''
+        import requests
+        kwargs.setdefault('timeout', self.timeout)
+        host = urllib.parse.urlsplit(url).netloc.lower()
+        tries = 0
+        while True:
+            tries += 1
+            wait = self._take_token(host)
+            while wait > 0:
+                time.sleep(wait)
+                wait = self._take_token(host)
+            slot = self._acquire_slot(host)
+            try:
+                r = self.session.get(url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                self._update(host, True)
+                if tries >= self.max_tries:
+                    raise
+                continue
+            finally:
+                self._release_slot(slot)
+            if r.status_code in _retry_codes:
+                self._update(host, True, _retry_after(r))
+                if tries < self.max_tries:
+                    continue
+            else:
+                self._update(host, False)
+            return r
+
+# Limiter used by getebook.EbookParser and the get() function. It can
+# be replaced by a RateLimiter instance with different settings.
+default_limiter = None
+_default_lock = threading.Lock()
+
+def get(url, **kwargs):
+    '''Send a GET request for url through default_limiter (which is
+    created with default settings if it is None).'''
+    global default_limiter
+    with _default_lock:
+        if not default_limiter:
+            default_limiter = RateLimiter()
+    return default_limiter.get(url, **kwargs)
@@ -0,0 +1,252 @@
+# Copyright (c) 2016, Max Fillinger <max@max-fillinger.net>
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES WITH
+# REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF MERCHANTABILITY
+# AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY SPECIAL, DIRECT,
+# INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES WHATSOEVER RESULTING FROM
+# LOSS OF USE, DATA OR PROFITS, WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR
+# OTHER TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR
+# PERFORMANCE OF THIS SOFTWARE.
+
+'''Parsing the pages of a book in several processes.
+
+run(parser, base, path, processes) does the same as
+parser.getebook(base, path), but the pages are parsed in a pool of
+worker processes. This is worthwhile if the pages are read from a local
+source (see the sources submodule); parsing is then the bottleneck.
+
+The main process reads the pages one after the other and finds the link
+to the next page with a quick scan for anchors matching link_next, so
+that it can hand the pages to the workers before the previous ones are
+parsed. The workers return the calls the parser makes on the builder
+(see the events submodule), and the main process replays them in the
+order of the pages. The result is the same as with the serial parser:
+if the scan guessed the next page wrong, the work done for the wrong
+pages is thrown away and the build continues with the right one.'''
+
+import collections
+import getebook
+import getebook.encoding
+import getebook.events
+import html
+import re
+import urllib.parse
+
+__all__ = ['run']
+
+_anchor_re = re.compile(r'<a(\s[^>]*)?>(.*?)</a\s*>', re.I | re.S)
+_base_re = re.compile(r'<base\s[^>]*>', re.I)
+_href_re = re.compile(r'''\shref\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s>]+))''',
+                      re.I)
+_tag_re = re.compile(r'<[^>]*>')
+
+def _href(tag):
+    'Return the href attribute value in the start tag tag, or None.'
+    m = _href_re.search(tag)
+    if not m:
+        return None
+    return html.unescape(next(g for g in m.groups() if g is not None))
+
+def _link_text(source):
+    'Return the text of an anchor the way the parser sees it.'
+    text = ''
+    # The parser strips every piece of text between tags separately.
+    for piece in _tag_re.split(source):
+        lines = html.unescape(piece).splitlines()
+        text += '\n'.join(filter(None, map(str.strip, lines)))
+    return text
+
+def _scan(text, next_re):
+    '''Guess the link to the next page and the URL of a <base> tag in
+    the html source text. Returns (href, base), where both may be None.
+    Unlike the parser, the scan doesn\'t know which anchors are part of
+    the book content, so it may be wrong.'''
+    base = None
+    m = _base_re.search(text)
+    if m:
+        base = _href(m.group(0))
+    for m in _anchor_re.finditer(text):
+        if next_re.match(_link_text(m.group(2))):
+            return (_href(m.group(1) or ''), base)
+    return (None, base)
+
+# Parser of a worker process
+_worker_parser = None
+
+def _init_worker(config):
+    'Create the parser of a worker process.'
+    global _worker_parser
+    (link_next, root_check, quirks, backend, streaming, max_samples) = config
+    if max_samples is None:
+        diagnostics = None
+    else:
+        diagnostics = getebook.Diagnostics(max_samples)
+    p = getebook.EbookParser(getebook.events.Recorder(), link_next,
+                             backend = backend, diagnostics = diagnostics)
+    p.root_check = root_check
+    p.quirks = quirks
+    p._streaming = streaming
+    _worker_parser = p
+
+def _parse(url, text):
+    'Parse a page in a worker process.'
+    return getebook.events.parse_page(_worker_parser, url, text)
+
+class _Page:
+    'A page that is being parsed.'
+    def __init__(self, url, response = None, text = None, error = None,
+                 stop = None):
+        self.url = url
+        self.response = response
+        self.text = text
+        self.error = error
+        # Result from the parse cache, and the key for storing it there
+        self.result = None
+        self.key = None
+        # Reason to stop the build at this page (see getebook.Budget).
+        self.stop = stop
+        self.future = None
+
+def run(parser, base, path, processes = None):
+    '''Parse the html from base+path and the following pages like
+    parser.getebook(base, path), with processes worker processes (by
+    default, one per CPU). Returns the status of the build, like
+    parser.getebook.'''
+    import concurrent.futures
+    import os
+    import warnings
+    builder = parser.builder
+    try:
+        builder.add_config('parser', parser.config())
+        add_source = builder.add_source
+    except AttributeError:
+        add_source = None
+    if parser.diagnostics:
+        max_samples = parser.diagnostics.max_samples
+    else:
+        max_samples = None
+    config = (parser.next_re.pattern, parser.root_check, parser.quirks,
+              type(parser.backend), parser._streaming, max_samples)
+    if not processes:
+        processes = os.cpu_count() or 1
+    pool = concurrent.futures.ProcessPoolExecutor(processes,
+             initializer = _init_worker, initargs = (config,))
+    # Keep enough pages in flight to keep all workers busy.
+    window = 2 * processes
+    pending = collections.deque()
+    crawl = getebook._Crawl(parser.budget)
+    status = 'complete'
+    cache = parser.parse_cache
+    if cache:
+        parser_key = cache.parser_key(parser)
+
+    def fetch(url, base):
+        '''Read the page at url and look it up in the parse cache or
+        submit it to the pool. Returns the guessed URL of the next page
+        and the base URL after this page.'''
+        # Assume that the pages in front of this one will be used, so
+        # that no pages beyond the budget are read.
+        reason = crawl.check_url(url, len(pending))
+        if not reason and crawl.key(url) in [crawl.key(p.url)
+                                             for p in pending]:
+            reason = 'loop'
+        if reason:
+            pending.append(_Page(url, stop = reason))
+            return (None, base)
+        try:
+            r = parser.source.get(url)
+        except Exception as e:
+            # Raised when the page is replayed, if it is really needed.
+            pending.append(_Page(url, error = e))
+            return (None, base)
+        if not r:
+            pending.append(_Page(url, r))
+            return (None, base)
+        encoding = getebook.encoding.response_encoding(r)
+        page = _Page(url, r)
+        pending.append(page)
+        if cache:
+            page.key = cache.key(parser_key, encoding, r.content)
+            page.result = cache.get(page.key, url)
+        if page.result:
+            # No need to guess.
+            (href, page_base) = (page.result.next_part, page.result.base)
+        else:
+            page.text = r.content.decode(encoding, 'replace')
+            page.future = pool.submit(_parse, url, page.text)
+            (href, page_base) = _scan(page.text, parser.next_re)
+        if page_base:
+            base = page_base
+        if not href:
+            return (None, base)
+        return (urllib.parse.urljoin(base, href), base)
+
+    try:
+        try:
+            base = parser.base
+        except AttributeError:
+            pass
+        # Next page to fetch, and the base URL the scan assumes for it.
+        fetch_url = urllib.parse.urljoin(base, path)
+        fetch_base = base
+        while True:
+            while fetch_url and len(pending) < window:
+                (fetch_url, fetch_base) = fetch(fetch_url, fetch_base)
+            if not pending:
+                break
+            page = pending.popleft()
+            # The reason of a stopped page still holds now that all pages
+            # in front of it were used.
+            reason = page.stop or crawl.check_url(page.url)
+            if reason:
+                status = crawl.stop(builder, page.url, reason)
+                break
+            if page.error:
+                raise page.error
+            if not page.response:
+                raise getebook.PageNotFound('Got error code %03d.' % \
+                                            page.response.status_code)
+            reason = crawl.check_page(page.url, page.response.content)
+            if reason:
+                status = crawl.stop(builder, page.url, reason)
+                break
+            result = page.result
+            if not result:
+                result = page.future.result()
+                if cache:
+                    cache.put(page.key, result)
+            if add_source:
+                add_source(page.url, page.response.content)
+            builder.new_part()
+            getebook.events.replay(result.events, builder)
+            if result.diagnostics and parser.diagnostics:
+                parser.diagnostics.url = page.url
+                parser.diagnostics.merge(result.diagnostics)
+            if result.base:
+                parser.base = result.base
+                base = result.base
+            if result.next_part:
+                true_next = urllib.parse.urljoin(base, result.next_part)
+            else:
+                true_next = None
+            if pending:
+                guessed = pending[0].url
+            else:
+                guessed = fetch_url
+            if true_next != guessed:
+                # Wrong guess, throw away what was done for it.
+                for p in pending:
+                    if p.future:
+                        p.future.cancel()
+                pending.clear()
+                fetch_url = true_next
+                fetch_base = base
+    finally:
+        pool.shutdown(cancel_futures = True)
+    if parser.diagnostics and parser.diagnostics.counts:
+        warnings.warn(str(parser.diagnostics))
+    return status
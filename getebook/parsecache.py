@@ -0,0 +1,175 @@
+# Copyright (c) 2016, Max Fillinger <max@max-fillinger.net>
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES WITH
+# REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF MERCHANTABILITY
+# AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY SPECIAL, DIRECT,
+# INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES WHATSOEVER RESULTING FROM
+# LOSS OF USE, DATA OR PROFITS, WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR
+# OTHER TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR
+# PERFORMANCE OF THIS SOFTWARE.
+
+'''Cache for the results of parsing pages.
+
+When a book is built again after changing only the metadata, the
+stylesheet or other settings of the builder, the parser does the same
+work as before. With a ParseCache, it stores what it found on every page
+(a getebook.events.PageResult) and replays it into the builder the next
+time, without parsing the page:
+
+>>> import getebook.parsecache
+>>> cache = getebook.parsecache.ParseCache(\'parse-cache\')
+>>> p = getebook.EbookParser(builder, \'Next Page >>\', parse_cache = cache)
+
+Results are stored under a hash of the page content, its encoding, the
+settings of the parser (see getebook.EbookParser.config and its
+diagnostics), the tokenizer backend and the getebook source code. Any
+change to these leads to new entries; old ones are deleted when the
+cache grows too big.
+
+The entries are pickled, so only use a directory that nobody else can
+write to.'''
+
+import getebook
+import glob
+import hashlib
+import json
+import os
+import os.path
+import pickle
+import tempfile
+import threading
+
+__all__ = ['ParseCache']
+
+class ParseCache:
+    '''Directory with the results of parsing pages. If the total size
+    exceeds max_size bytes, the least recently used entries are deleted
+    until it is below three quarters of max_size.'''
+    def __init__(self, directory, max_size = 256 << 20):
+        'Initialize the cache, creating the directory if necessary.'
+        os.makedirs(directory, exist_ok = True)
+        self.directory = directory
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        # Total size of the entries, or None if it is not known yet.
+        # Other processes using the directory are only noticed when
+        # evicting.
+        self._size = None
+        self._lock = threading.Lock()
+
+    def parser_key(self, parser):
+        '''Return the part of the keys that depends on the settings of
+        parser (a getebook.EbookParser instance).'''
+        h = hashlib.sha256()
+        h.update(getebook._library_fingerprint().encode())
+        if parser.diagnostics:
+            max_samples = parser.diagnostics.max_samples
+        else:
+            max_samples = None
+        h.update(json.dumps([type(parser.backend).__name__,
+                             parser._streaming, max_samples,
+                             parser.config()], sort_keys = True).encode())
+        return h.hexdigest()
+
+    def key(self, parser_key, encoding, content):
+        '''Return the key for a page with content (bytes) decoded with
+        encoding and parsed by a parser with parser_key.'''
+        h = hashlib.sha256()
+        h.update(('%s %s\n' % (parser_key, encoding)).encode())
+        h.update(content)
+        return h.hexdigest()
+
+    def path(self, key):
+        'Return the filename for key.'
+        return os.path.join(self.directory, key + '.pickle')
+
+    def get(self, key, url):
+        '''Return the getebook.events.PageResult for key if it is in the
+        cache, else None. url is the URL of the page, for the samples in
+        the diagnostics.'''
+        path = self.path(key)
+        try:
+            with open(path, 'rb') as f:
+                result = pickle.load(f)
+            # Mark as recently used.
+            os.utime(path)
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        except (EOFError, pickle.UnpicklingError, AttributeError,
+                ImportError):
+            # Damaged, or written by an incompatible version.
+            self._remove(path)
+            self.misses += 1
+            return None
+        if result.diagnostics:
+            # The same page may have been read from another URL before.
+            result.diagnostics.url = url
+            for samples in result.diagnostics.samples.values():
+                for smp in samples:
+                    smp['url'] = url
+        self.hits += 1
+        return result
+
+    def put(self, key, result):
+        '''Store the getebook.events.PageResult result under key and
+        evict old entries if necessary.'''
+        (fd, tmp_name) = tempfile.mkstemp(suffix = '.tmp',
+                                          dir = self.directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump(result, f, pickle.HIGHEST_PROTOCOL)
+                size = f.tell()
+            os.replace(tmp_name, self.path(key))
+        except BaseException:
+            self._remove(tmp_name)
+            raise
+        with self._lock:
+            if self._size is None:
+                self._size = self._scan()[1]
+            else:
+                self._size += size
+            full = self._size > self.max_size
+        if full:
+            self.evict()
+
+    def _remove(self, name):
+        'Delete the file name if it exists.'
+        try:
+            os.remove(name)
+        except FileNotFoundError:
+            pass
+
+    def _scan(self):
+        '''Return a list of (mtime, size, filename) of all entries, oldest
+        first, and their total size.'''
+        entries = []
+        total = 0
+        for name in glob.glob(os.path.join(self.directory, '*.pickle')):
+            try:
+                st = os.stat(name)
+            except FileNotFoundError:
+                continue
+            entries.append((st.st_mtime, st.st_size, name))
+            total += st.st_size
+        entries.sort()
+        return (entries, total)
+
+    def evict(self):
+        'Delete the least recently used entries until the cache fits.'
+        with self._lock:
+            (entries, total) = self._scan()
+            # Evicting a bit more than necessary means the directory
+            # doesn't have to be scanned again for every new entry.
+            if total > self.max_size:
+                for (mtime, size, name) in entries:
+                    if total <= self.max_size * 3 // 4:
+                        break
+                    self._remove(name)
+                    total -= size
+            self._size = total
@@ -0,0 +1,275 @@
+# Copyright (c) 2016, Max Fillinger <max@max-fillinger.net>
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES WITH
+# REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF MERCHANTABILITY
+# AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY SPECIAL, DIRECT,
+# INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES WHATSOEVER RESULTING FROM
+# LOSS OF USE, DATA OR PROFITS, WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR
+# OTHER TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR
+# PERFORMANCE OF THIS SOFTWARE.
+
+'''Profiling of ebook builds.
+
+Use a Profile instance as a context manager around the build:
+
+>>> import getebook.profiling
+>>> with getebook.profiling.Profile(p, \'prof\') as prof:
+...     p.getebook(\'http://www.ebook-site.org\', \'some-book/1\')
+...     builder.finalize()
+>>> print(prof.report())
+
+Afterwards, the directory (here "prof") contains:
+
+- profile.pstats: cProfile statistics, for the pstats module or tools
+    like snakeviz.
+- stacks.collapsed: sampled call stacks in the collapsed format of
+    flamegraph.pl (also read by speedscope).
+- partNNN.tracemalloc: tracemalloc snapshots taken after every call of
+    the builder\'s new_part method, for tracemalloc.Snapshot.load.
+- stages.json: time, number of calls and change of allocated memory by
+    stage of the build. The stages are fetch (reading pages from the
+    source), parse (tokenizing the html and building elements), quirks
+    (testing elements against the quirks), builder (turning elements
+    into the output format), zip (compressing and writing the archive)
+    and other (everything else). Time spent in a stage that is called
+    from another one only counts for the inner one.'''
+
+import json
+import os
+import os.path
+import sys
+import threading
+import time
+
+__all__ = ['Profile']
+
+_stages = ['fetch', 'parse', 'quirks', 'builder', 'zip', 'other']
+
+class _StageTimer:
+    'Accounts time and allocations to the innermost active stage.'
+    def __init__(self, memory):
+        'Initialize. If memory is True, allocations are tracked, too.'
+        self.memory = memory
+        self.time = dict.fromkeys(_stages + ['profiler'], 0.0)
+        self.alloc = dict.fromkeys(_stages + ['profiler'], 0)
+        self.calls = dict.fromkeys(_stages + ['profiler'], 0)
+        # Entries are [stage, start time, start memory, time in inner
+        # stages, memory in inner stages].
+        self._stack = []
+
+    def _memory(self):
+        if self.memory:
+            import tracemalloc
+            return tracemalloc.get_traced_memory()[0]
+        return 0
+
+    def enter(self, stage):
+        'Enter stage.'
+        self.calls[stage] += 1
+        self._stack.append([stage, time.perf_counter(), self._memory(), 0, 0])
+
+    def leave(self):
+        'Leave the current stage.'
+        (stage, start, mem, inner_time, inner_mem) = self._stack.pop()
+        elapsed = time.perf_counter() - start
+        allocated = self._memory() - mem
+        self.time[stage] += elapsed - inner_time
+        self.alloc[stage] += allocated - inner_mem
+        if self._stack:
+            self._stack[-1][3] += elapsed
+            self._stack[-1][4] += allocated
+
+    def wrap(self, stage, func):
+        'Return func wrapped so that calls are accounted to stage.'
+        def wrapper(*args, **kwargs):
+            self.enter(stage)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.leave()
+        return wrapper
+
+class _Sampler(threading.Thread):
+    '''Thread that periodically records the call stack of another thread
+    and counts how often every stack was seen.'''
+    def __init__(self, thread_id, interval):
+        super().__init__(daemon = True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.counts = {}
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame:
+                code = frame.f_code
+                stack.append('%s (%s:%d)' % (code.co_name,
+                  os.path.basename(code.co_filename), code.co_firstlineno))
+                frame = frame.f_back
+            if stack:
+                key = ';'.join(reversed(stack))
+                self.counts[key] = self.counts.get(key, 0) + 1
+
+    def stop(self):
+        'Stop sampling and wait for the thread to end.'
+        self._stop_event.set()
+        self.join()
+
+    def write(self, filename):
+        'Write the stacks in collapsed format.'
+        with open(filename, 'w') as f:
+            for (stack, count) in sorted(self.counts.items()):
+                f.write('%s %d\n' % (stack, count))
+
+class Profile:
+    '''Context manager that profiles the work of the getebook.EbookParser
+    instance parser and its builder and writes the results to directory
+    (see the module docstring). cprofile, memory and sample_interval
+    (in seconds) control whether cProfile, tracemalloc and the stack
+    sampler are used; set sample_interval to None to turn the sampler
+    off. memory_frames is the number of frames tracemalloc stores for
+    every allocation.'''
+    def __init__(self, parser, directory, cprofile = True, memory = True,
+                 sample_interval = 0.005, memory_frames = 10):
+        'Initialize. Nothing is profiled until the context is entered.'
+        self.parser = parser
+        self.directory = directory
+        self.cprofile = cprofile
+        self.memory = memory
+        self.sample_interval = sample_interval
+        self.memory_frames = memory_frames
+        self.stages = _StageTimer(memory)
+        self._patched = []
+        self._part_no = 0
+
+    def _patch(self, obj, name, wrapper):
+        'Replace the method name of obj by wrapper(method).'
+        try:
+            method = getattr(obj, name)
+        except AttributeError:
+            return
+        self._patched.append((obj, name, name in vars(obj), method))
+        setattr(obj, name, wrapper(method))
+
+    def _unpatch(self):
+        'Restore all methods replaced by _patch.'
+        for (obj, name, had_attr, method) in reversed(self._patched):
+            if had_attr:
+                setattr(obj, name, method)
+            else:
+                delattr(obj, name)
+        self._patched = []
+
+    def _new_part(self, method):
+        'Wrap the new_part method of the builder to take snapshots.'
+        wrapped = self.stages.wrap('builder', method)
+        def new_part(*args, **kwargs):
+            result = wrapped(*args, **kwargs)
+            if self.memory:
+                import tracemalloc
+                self.stages.enter('profiler')
+                try:
+                    tracemalloc.take_snapshot().dump(os.path.join(
+                      self.directory, 'part%03d.tracemalloc' % self._part_no))
+                finally:
+                    self.stages.leave()
+                self._part_no += 1
+            return result
+        return new_part
+
+    def _instrument(self):
+        'Wrap the methods of parser and builder that make up the stages.'
+        stage = lambda name: (lambda method: self.stages.wrap(name, method))
+        parser = self.parser
+        self._patch(parser.source, 'get', stage('fetch'))
+        for name in ('feed', 'close'):
+            self._patch(parser, name, stage('parse'))
+        for name in ('test_skip', 'may_skip', 'test_par_heading',
+                     'test_false_heading'):
+            self._patch(parser.quirks, name, stage('quirks'))
+        builder = parser.builder
+        for name in ('handle_elem', 'par_heading', 'false_heading',
+                     'start_elem', 'end_elem', 'headingpage', 'finalize'):
+            self._patch(builder, name, stage('builder'))
+        self._patch(builder, 'new_part', self._new_part)
+        try:
+            zip_f = builder.epub_f
+        except AttributeError:
+            pass
+        else:
+            for name in ('writestr', 'write', 'close'):
+                self._patch(zip_f, name, stage('zip'))
+
+    def __enter__(self):
+        'Start profiling.'
+        import cProfile
+        os.makedirs(self.directory, exist_ok = True)
+        self._instrument()
+        if self.memory:
+            import tracemalloc
+            self._started_tracemalloc = not tracemalloc.is_tracing()
+            if self._started_tracemalloc:
+                tracemalloc.start(self.memory_frames)
+        if self.sample_interval:
+            self._sampler = _Sampler(threading.get_ident(),
+                                     self.sample_interval)
+            self._sampler.start()
+        if self.cprofile:
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+        self.stages.enter('other')
+        return self
+
+    def __exit__(self, except_type, except_val, traceback):
+        'Stop profiling and write the results.'
+        self.stages.leave()
+        try:
+            # Stop everything before writing, so that nothing keeps
+            # running if a write fails.
+            if self.cprofile:
+                self._profiler.disable()
+            if self.sample_interval:
+                self._sampler.stop()
+            if self.memory and self._started_tracemalloc:
+                import tracemalloc
+                tracemalloc.stop()
+            if self.cprofile:
+                self._profiler.dump_stats(os.path.join(self.directory,
+                                                       'profile.pstats'))
+            if self.sample_interval:
+                self._sampler.write(os.path.join(self.directory,
+                                                 'stacks.collapsed'))
+            with open(os.path.join(self.directory, 'stages.json'),
+                      'w') as f:
+                json.dump(self.summary(), f, indent = 2)
+        finally:
+            # The parser and builder must work normally afterwards.
+            self._unpatch()
+        return False
+
+    def summary(self):
+        '''Return a dict that maps every stage to a dict with its time
+        (in seconds), number of calls and change of allocated memory (in
+        bytes; 0 if memory is not tracked).'''
+        st = self.stages
+        return {stage: {'time': st.time[stage], 'calls': st.calls[stage],
+                        'memory': st.alloc[stage]}
+                for stage in _stages + ['profiler']}
+
+    def report(self):
+        'Return the time and memory by stage as a table.'
+        lines = ['%-10s %10s %10s %12s' % ('stage', 'time (s)', 'calls',
+                                            'memory (KiB)')]
+        total = 0.0
+        for (stage, val) in self.summary().items():
+            total += val['time']
+            lines.append('%-10s %10.3f %10d %12.1f' % (stage, val['time'],
+                         val['calls'], val['memory'] / 1024))
+        lines.append('%-10s %10.3f' % ('total', total))
+        return '\n'.join(lines)
@@ -0,0 +1,269 @@
+# Copyright (c) 2016, Max Fillinger <max@max-fillinger.net>
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES WITH
+# REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF MERCHANTABILITY
+# AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY SPECIAL, DIRECT,
+# INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES WHATSOEVER RESULTING FROM
+# LOSS OF USE, DATA OR PROFITS, WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR
+# OTHER TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR
+# PERFORMANCE OF THIS SOFTWARE.
+
+'''Full-text search index for ebooks.
+
+An EpubBuilder created with index = True collects every word of the
+book text while writing it and stores an inverted index in the epub
+(as META-INF/getebook-index.json), so the book doesn\'t have to be
+unpacked and parsed again to make it searchable. The index of a book is
+a catalog with only one book; merge combines the indexes of many books
+into one catalog:
+
+    python -m getebook.search merge catalog.json book1.epub book2.epub
+    python -m getebook.search query catalog.json some words
+
+An index is a JSON object with the keys:
+
+- version: 1
+- books: a list of objects with the uid, title and authors of a book,
+    its parts (list of filenames) and toc (list of [text, part number]
+    for every entry of the table of contents, in order).
+- terms: maps every term (a word, case-folded) to its postings, a list
+    of [book number, part number, toc entry number, positions]. The
+    toc entry number is -1 for text before the first entry. positions
+    are the numbers of the words in the part, given as the differences
+    to the previous one (the first as is).'''
+
+import collections
+import json
+import operator
+import re
+
+__all__ = ['Index', 'merge', 'read_index', 'search']
+
+# Name of the index in the epub
+_index_name = 'META-INF/getebook-index.json'
+
+_word_re = re.compile(r'\w+')
+
+class Index:
+    '''Inverted index of a book, filled by the builder while the book is
+    written.'''
+    def __init__(self):
+        'Initialize an empty index.'
+        self.parts = []
+        self.toc = []
+        # term -> list of [part number, toc entry number, positions]
+        self.terms = {}
+        self._toc_no = -1
+        self._pos = 0
+        # Text of the current part since the last toc entry. It is only
+        # split into words when the part or entry changes, which is much
+        # faster than doing it for every piece.
+        self._text = []
+
+    def new_part(self, name):
+        '''Add text to the part with the filename name from now on. Does
+        nothing if that already is the current part.'''
+        if not self.parts or self.parts[-1] != name:
+            self._flush()
+            self.parts.append(name)
+            self._pos = 0
+
+    def new_entry(self, text):
+        '''Begin a new entry of the table of contents with text, in the
+        current part.'''
+        self._flush()
+        self.toc.append([text, len(self.parts) - 1])
+        self._toc_no = len(self.toc) - 1
+
+    def add_text(self, text):
+        'Add the words in text to the current part.'
+        self._text.append(text)
+
+    def _flush(self):
+        'Add the words of the collected text to the index.'
+        if not self._text:
+            return
+        # Separate the pieces so that words don\'t run into each other.
+        words = _word_re.findall(' '.join(self._text).casefold())
+        self._text = []
+        positions = collections.defaultdict(list)
+        for (pos, word) in enumerate(words, self._pos):
+            positions[word].append(pos)
+        self._pos += len(words)
+        (part, toc_no, terms) = (len(self.parts) - 1, self._toc_no,
+                                 self.terms)
+        for (word, pos) in positions.items():
+            try:
+                terms[word].append([part, toc_no, pos])
+            except KeyError:
+                terms[word] = [[part, toc_no, pos]]
+
+    def catalog(self, uid = None, title = None, authors = ()):
+        '''Return the index as a catalog (see the module docstring) with
+        one book, which has the given uid, title and authors.'''
+        self._flush()
+        terms = {}
+        for (term, postings) in self.terms.items():
+            terms[term] = [[0, part, toc_no, _deltas(positions)]
+                           for (part, toc_no, positions) in postings]
+        return {'version': 1,
+                'books': [{'uid': uid, 'title': title,
+                           'authors': list(authors), 'parts': self.parts,
+                           'toc': self.toc}],
+                'terms': terms}
+
+def _deltas(positions):
+    'Return the differences between consecutive positions.'
+    return list(map(operator.sub, positions, [0] + positions[:-1]))
+
+def _positions(deltas):
+    'Return the positions from the differences made by _deltas.'
+    pos = 0
+    out = []
+    for d in deltas:
+        pos += d
+        out.append(pos)
+    return out
+
+def read_index(filename):
+    '''Return the index in the epub filename, or None if it has none.
+    Files ending in .json are read as an index directly, and filename
+    may also be the directory of an exploded epub.'''
+    import os.path
+    if filename.endswith('.json'):
+        with open(filename, encoding = 'utf-8') as f:
+            return json.load(f)
+    if os.path.isdir(filename):
+        try:
+            with open(os.path.join(filename, *_index_name.split('/')),
+                      encoding = 'utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+    import zipfile
+    with zipfile.ZipFile(filename) as z:
+        try:
+            data = z.read(_index_name)
+        except KeyError:
+            return None
+    return json.loads(data.decode('utf-8'))
+
+def merge(indexes):
+    '''Merge the indexes (catalogs or indexes of single books) in the
+    iterable indexes into one catalog. If books with the same uid appear
+    more than once, the last one is kept.'''
+    books = []
+    by_uid = {}
+    terms = {}
+    for index in indexes:
+        if index.get('version') != 1:
+            raise ValueError('unsupported index version: %r' % \
+                             index.get('version'))
+        # Book numbers in this index -> book numbers in the catalog
+        numbers = []
+        for book in index['books']:
+            uid = book.get('uid')
+            if uid is not None and uid in by_uid:
+                # Replaced by a newer build; its postings are dropped
+                # below.
+                books[by_uid[uid]] = None
+            by_uid[uid] = len(books)
+            numbers.append(len(books))
+            books.append(book)
+        for (term, postings) in index['terms'].items():
+            terms.setdefault(term, []).extend(
+              [[numbers[p[0]]] + p[1:] for p in postings])
+    # Remove the replaced books and renumber.
+    renumber = {}
+    kept = []
+    for (no, book) in enumerate(books):
+        if book is not None:
+            renumber[no] = len(kept)
+            kept.append(book)
+    out_terms = {}
+    for (term, postings) in terms.items():
+        postings = [[renumber[p[0]]] + p[1:] for p in postings
+                    if p[0] in renumber]
+        if postings:
+            out_terms[term] = postings
+    return {'version': 1, 'books': kept, 'terms': out_terms}
+
+def search(index, query):
+    '''Return the places in index that contain all words of the string
+    query, as a list of (book, part, toc entry, positions) tuples, where
+    book is the book object from the index, part a filename, toc entry
+    the text of the table of contents entry (None before the first
+    one), and positions a dict mapping the words to their positions in
+    the part.'''
+    words = _word_re.findall(query.casefold())
+    if not words:
+        return []
+    # (book, part, toc entry number) -> {word: positions}
+    places = None
+    for word in words:
+        found = {}
+        for (book, part, toc_no, deltas) in index['terms'].get(word, []):
+            key = (book, part, toc_no)
+            if places is None or key in places:
+                found[key] = _positions(deltas)
+        if places is None:
+            places = {key: {word: pos} for (key, pos) in found.items()}
+        else:
+            places = {key: places[key] for key in found}
+            for (key, pos) in found.items():
+                places[key][word] = pos
+    hits = []
+    for ((book_no, part, toc_no), positions) in sorted(places.items()):
+        book = index['books'][book_no]
+        if toc_no >= 0:
+            toc_text = book['toc'][toc_no][0]
+        else:
+            toc_text = None
+        hits.append((book, book['parts'][part], toc_text, positions))
+    return hits
+
+def main(argv = None):
+    'Merge or query indexes from the command line.'
+    import argparse
+    import sys
+    argp = argparse.ArgumentParser(description = ('Merge and query the '
+                                   'full-text indexes of ebooks.'))
+    sub = argp.add_subparsers(dest = 'command', required = True)
+    merge_p = sub.add_parser('merge', help = ('merge the indexes of epubs '
+                             'and catalogs into a catalog'))
+    merge_p.add_argument('output', help = 'catalog to write')
+    merge_p.add_argument('input', nargs = '+',
+                         help = 'epub, or index or catalog (.json)')
+    query_p = sub.add_parser('query', help = ('show the places that '
+                             'contain all of the words'))
+    query_p.add_argument('index', help = 'epub or catalog')
+    query_p.add_argument('words', nargs = '+')
+    args = argp.parse_args(argv)
+    if args.command == 'merge':
+        indexes = []
+        for name in args.input:
+            index = read_index(name)
+            if index is None:
+                print('%s: no index' % name, file = sys.stderr)
+            else:
+                indexes.append(index)
+        catalog = merge(indexes)
+        with open(args.output, 'w', encoding = 'utf-8') as f:
+            json.dump(catalog, f, sort_keys = True,
+                      separators = (',', ':'))
+    else:
+        index = read_index(args.index)
+        if index is None:
+            sys.exit('%s: no index' % args.index)
+        for (book, part, toc_text, positions) in search(index,
+                                               ' '.join(args.words)):
+            print('%s: %s, %s (%s)' % (book['title'], part, toc_text,
+                  ', '.join('%s: %d' % (w, len(p))
+                            for (w, p) in sorted(positions.items()))))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,363 @@
+# Copyright (c) 2016, Max Fillinger <max@max-fillinger.net>
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES WITH
+# REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF MERCHANTABILITY
+# AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY SPECIAL, DIRECT,
+# INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES WHATSOEVER RESULTING FROM
+# LOSS OF USE, DATA OR PROFITS, WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR
+# OTHER TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR
+# PERFORMANCE OF THIS SOFTWARE.
+
+'''Local HTTP service for building epubs, with a cache for the results.
+
+Start it with
+
+    python -m getebook.service --port 8080 --cache-dir ~/.cache/getebook
+
+and POST a JSON object describing the book to /build. The answer is the
+epub file. The JSON object can have the following keys:
+
+- url (required): URL of the first page of the book.
+- link_next (required), root_tag, root_class, root_id: as for
+    getebook.EbookParser.
+- title, author, lang, uid, date, rights, publisher: metadata, as for
+    getebook.epub.EpubBuilder.
+- subtitle: subtitle for the title page.
+- titlepage: if true (the default), a title page is added.
+- style_css: CSS that is appended to the default stylesheet.
+- quirks: a list of objects with a key "type" ("skip", "par_heading"
+    or "false_heading"), the other keys are passed as keyword arguments
+    to the corresponding method of getebook.Quirks.
+
+Results are cached under a fingerprint of the request and of the
+getebook source code, so a repeated request is answered from the cache.
+Identical requests that arrive while a book is being built wait for
+that build instead of starting their own.
+
+Builds can be limited in pages, size and time (see the --max-pages,
+--max-page-mib and --max-time options). A build that reaches a limit,
+or whose pages link back to an earlier one, fails; partial books are
+never cached.
+
+With --parse-cache-dir, the results of parsing pages are kept (see
+getebook.parsecache), so a request that only differs from an earlier
+one in metadata or style is built without parsing the pages again.'''
+
+import argparse
+import getebook
+import getebook.epub
+import glob
+import hashlib
+import http.server
+import json
+import os
+import os.path
+import shutil
+import tempfile
+import threading
+
+__all__ = ['BuildCache', 'BuildService', 'ConfigError', 'build',
+           'check_config', 'fingerprint', 'serve']
+
+class ConfigError(Exception):
+    pass
+
+# Largest accepted build request in bytes.
+_max_request_size = 1 << 20
+
+_meta_keys = ['title', 'author', 'lang', 'uid', 'date', 'rights', 'publisher']
+_quirk_types = ['skip', 'par_heading', 'false_heading']
+_config_keys = ['url', 'link_next', 'root_tag', 'root_class', 'root_id',
+                'subtitle', 'titlepage', 'style_css', 'quirks'] + _meta_keys
+
+def check_config(config):
+    '''Raise ConfigError if config (a dict) is not a valid build
+    request.'''
+    if not isinstance(config, dict):
+        raise ConfigError('build request must be a JSON object')
+    for key in ('url', 'link_next'):
+        if not key in config:
+            raise ConfigError('missing key: %s' % key)
+    for key in config:
+        if not key in _config_keys:
+            raise ConfigError('unknown key: %s' % key)
+    for quirk in config.get('quirks', []):
+        if not isinstance(quirk, dict) or \
+           not quirk.get('type') in _quirk_types:
+            raise ConfigError('invalid quirk: %r' % (quirk,))
+
+def fingerprint(config):
+    'Return the cache key for the build request config.'
+    h = hashlib.sha256()
+    h.update(getebook._library_fingerprint().encode())
+    h.update(json.dumps(config, sort_keys = True).encode())
+    return h.hexdigest()
+
+def build(config, epub_file, budget = None, parse_cache = None):
+    '''Build the epub described by config (see the module docstring) and
+    write it to epub_file (a filename or a binary file object). budget
+    is a getebook.Budget instance limiting the pages that are read, and
+    parse_cache a getebook.parsecache.ParseCache instance.'''
+    check_config(config)
+    with getebook.epub.EpubBuilder(epub_file) as bld:
+        for key in _meta_keys:
+            if key in config:
+                setattr(bld, key, config[key])
+        if 'style_css' in config:
+            bld.style_css += config['style_css']
+        if config.get('titlepage', True):
+            bld.titlepage(subtitle = config.get('subtitle'))
+        p = getebook.EbookParser(bld, config['link_next'],
+                                 config.get('root_tag'),
+                                 config.get('root_class'),
+                                 config.get('root_id'),
+                                 budget = budget,
+                                 parse_cache = parse_cache)
+        for quirk in config.get('quirks', []):
+            args = dict(quirk)
+            add_quirk = getattr(p.quirks, args.pop('type'))
+            try:
+                add_quirk(**args)
+            except TypeError as e:
+                raise ConfigError('invalid quirk: %s' % e)
+        p.getebook(config['url'], config['url'])
+
+class BuildCache:
+    '''Directory with finished epubs. If the total size exceeds max_size
+    bytes, the least recently used files are deleted.'''
+    def __init__(self, directory, max_size = 1 << 30):
+        'Initialize the cache, creating the directory if necessary.'
+        os.makedirs(directory, exist_ok = True)
+        self.directory = directory
+        self.max_size = max_size
+        self._lock = threading.Lock()
+
+    def path(self, key):
+        'Return the filename for key.'
+        return os.path.join(self.directory, key + '.epub')
+
+    def get(self, key):
+        'Return the filename for key if it is in the cache, else None.'
+        path = self.path(key)
+        try:
+            # Mark as recently used.
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def put(self, key, tmp_name):
+        '''Move the file tmp_name into the cache under key and evict old
+        entries if necessary. Returns the new filename.'''
+        path = self.path(key)
+        os.replace(tmp_name, path)
+        self.evict()
+        return path
+
+    def evict(self):
+        'Delete the least recently used entries until the cache fits.'
+        with self._lock:
+            entries = []
+            total = 0
+            for name in glob.glob(os.path.join(self.directory, '*.epub')):
+                try:
+                    st = os.stat(name)
+                except FileNotFoundError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, name))
+                total += st.st_size
+            entries.sort()
+            # Never delete the newest file, even if it alone is too big.
+            for (mtime, size, name) in entries[:-1]:
+                if total <= self.max_size:
+                    break
+                try:
+                    os.remove(name)
+                except FileNotFoundError:
+                    pass
+                except OSError:
+                    # E.g. on Windows, while the file is being sent.
+                    continue
+                total -= size
+
+class _Build:
+    'A build in progress.'
+    def __init__(self):
+        self.done = threading.Event()
+        self.path = None
+        self.error = None
+
+class BuildService:
+    '''Builds epubs on request, using a BuildCache. Concurrent identical
+    requests are only built once.'''
+    def __init__(self, cache, budget = None, parse_cache = None):
+        '''Initialize the service with a BuildCache instance. budget is
+        the getebook.Budget for every build; it should be strict, or
+        partial books end up in the cache. By default, there are no
+        limits. parse_cache is an optional
+        getebook.parsecache.ParseCache instance used by all builds.'''
+        self.cache = cache
+        if not budget:
+            budget = getebook.Budget(strict = True)
+        self.budget = budget
+        self.parse_cache = parse_cache
+        self._running = {}
+        self._lock = threading.Lock()
+
+    def get(self, config):
+        '''Return the filename of the epub for config, building it if it
+        is not in the cache. Exceptions from the build are raised in all
+        threads waiting for it. Other requests may evict the file at any
+        time; use open_epub to read it.'''
+        check_config(config)
+        key = fingerprint(config)
+        path = self.cache.get(key)
+        if path:
+            return path
+        with self._lock:
+            # A build for key may have finished since the first lookup.
+            # It puts the epub into the cache before it is removed from
+            # _running, so looking again under the lock is enough.
+            path = self.cache.get(key)
+            if path:
+                return path
+            try:
+                running = self._running[key]
+                leader = False
+            except KeyError:
+                running = _Build()
+                self._running[key] = running
+                leader = True
+        if not leader:
+            running.done.wait()
+            if isinstance(running.error, Exception):
+                raise running.error
+            if not running.path:
+                # E.g. the leader was interrupted with KeyboardInterrupt,
+                # which must not be raised in this thread.
+                raise RuntimeError('the build was aborted: %r'
+                                   % (running.error,))
+            return running.path
+        try:
+            (fd, tmp_name) = tempfile.mkstemp(suffix = '.tmp',
+                                              dir = self.cache.directory)
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    build(config, f, self.budget, self.parse_cache)
+                running.path = self.cache.put(key, tmp_name)
+            except BaseException:
+                os.remove(tmp_name)
+                raise
+        except BaseException as e:
+            running.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._running[key]
+            running.done.set()
+        return running.path
+
+    def open_epub(self, config, tries = 3):
+        '''Like get, but return the epub as a file object opened for
+        reading. Another request may evict the file from the cache before
+        it is opened; then it is built again, up to tries times.'''
+        for i in range(tries - 1):
+            try:
+                return open(self.get(config), 'rb')
+            except FileNotFoundError:
+                pass
+        return open(self.get(config), 'rb')
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    'Request handler for the build service.'
+    def _error(self, code, msg):
+        body = (msg + '\n').encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'text/plain; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        'Handle a build request.'
+        if self.path != '/build':
+            self._error(404, 'not found')
+            return
+        try:
+            length = int(self.headers['Content-Length'])
+            if length < 0:
+                raise ValueError('invalid Content-Length')
+            if length > _max_request_size:
+                self._error(413, 'build request too large')
+                return
+            config = json.loads(self.rfile.read(length).decode('utf-8'))
+            f = self.server.service.open_epub(config)
+        except (TypeError, ValueError, ConfigError) as e:
+            self._error(400, str(e))
+            return
+        except (getebook.PageNotFound, getebook.BuildStopped) as e:
+            self._error(502, str(e))
+            return
+        except Exception as e:
+            self._error(500, '%s: %s' % (type(e).__name__, e))
+            return
+        # Once it is open, the file can be sent even if it is evicted.
+        with f:
+            size = os.fstat(f.fileno()).st_size
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/epub+zip')
+            self.send_header('Content-Length', str(size))
+            self.end_headers()
+            shutil.copyfileobj(f, self.wfile)
+
+def serve(service, host = 'localhost', port = 8080):
+    'Serve build requests for the BuildService instance service forever.'
+    server = http.server.ThreadingHTTPServer((host, port), _Handler)
+    server.service = service
+    server.serve_forever()
+
+def main(argv = None):
+    'Run the service from the command line.'
+    argp = argparse.ArgumentParser(description = 'Local epub build service.')
+    argp.add_argument('--host', default = 'localhost',
+                      help = 'address to listen on (default: localhost)')
+    argp.add_argument('--port', type = int, default = 8080,
+                      help = 'port to listen on (default: 8080)')
+    argp.add_argument('--cache-dir', default = os.path.join(
+                        os.path.expanduser('~'), '.cache', 'getebook'),
+                      help = 'directory for cached epubs')
+    argp.add_argument('--max-size', type = int, default = 1024,
+                      help = 'maximal size of the cache in MiB')
+    argp.add_argument('--max-pages', type = int,
+                      help = 'maximal number of pages of a book')
+    argp.add_argument('--max-page-mib', type = float,
+                      help = 'maximal size of the pages of a book in MiB')
+    argp.add_argument('--max-time', type = float,
+                      help = 'maximal time for reading a book in seconds')
+    argp.add_argument('--parse-cache-dir',
+                      help = 'directory for the results of parsing pages')
+    argp.add_argument('--parse-cache-size', type = int, default = 256,
+                      help = ('maximal size of the parse cache in MiB '
+                              '(default: 256)'))
+    args = argp.parse_args(argv)
+    cache = BuildCache(args.cache_dir, args.max_size << 20)
+    if args.max_page_mib is None:
+        max_bytes = None
+    else:
+        max_bytes = int(args.max_page_mib * (1 << 20))
+    budget = getebook.Budget(args.max_pages, max_bytes, args.max_time,
+                             strict = True)
+    if args.parse_cache_dir:
+        import getebook.parsecache
+        parse_cache = getebook.parsecache.ParseCache(
+                        args.parse_cache_dir, args.parse_cache_size << 20)
+    else:
+        parse_cache = None
+    serve(BuildService(cache, budget, parse_cache), args.host, args.port)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,335 @@
+# Copyright (c) 2016, Max Fillinger <max@max-fillinger.net>
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES WITH
+# REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF MERCHANTABILITY
+# AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY SPECIAL, DIRECT,
+# INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES WHATSOEVER RESULTING FROM
+# LOSS OF USE, DATA OR PROFITS, WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR
+# OTHER TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR
+# PERFORMANCE OF THIS SOFTWARE.
+
+'''Sources of webpages for getebook.EbookParser.
+
+A source has a method get(url) that returns a response object with the
+attributes url, status_code, headers and content (bytes), which is
+false if the page was not found. requests.Response objects fit this
+description. The following sources are available:
+
+- HTTPSource: download pages (through getebook.fetch).
+- MirrorSource: read pages from a directory created by wget --mirror.
+- WarcSource: read pages from a WARC file (optionally gzipped).
+
+Example:
+
+>>> import getebook.sources
+>>> src = getebook.sources.WarcSource(\'crawl.warc.gz\')
+>>> p = getebook.EbookParser(builder, link_next = \'Next\', source = src)
+>>> p.getebook(\'http://www.ebook-site.org\', \'some-book/1\')'''
+
+import getebook.fetch
+import io
+import json
+import mmap
+import os
+import os.path
+import urllib.parse
+import zlib
+
+__all__ = ['Page', 'HTTPSource', 'MirrorSource', 'WarcSource']
+
+class _Headers(dict):
+    'Dictionary of HTTP headers with case-insensitive get().'
+    def __init__(self, pairs = ()):
+        super().__init__((key.lower(), val) for (key, val) in pairs)
+
+    def __getitem__(self, key):
+        return super().__getitem__(key.lower())
+
+    def get(self, key, default = None):
+        return super().get(key.lower(), default)
+
+    def __contains__(self, key):
+        return super().__contains__(key.lower())
+
+class Page:
+    'A page from a local source, with the interface of requests.Response.'
+    def __init__(self, url, content, status_code = 200, headers = ()):
+        'Initialize the page. headers is a list of (name, value) pairs.'
+        self.url = url
+        self.content = content
+        self.status_code = status_code
+        self.headers = _Headers(headers)
+
+    def __bool__(self):
+        'True if the status code is less than 400.'
+        return self.status_code < 400
+
+def _not_found(url):
+    return Page(url, b'', 404)
+
+def _strip_fragment(url):
+    return urllib.parse.urldefrag(url)[0]
+
+class HTTPSource:
+    'Source that downloads pages through getebook.fetch.'
+    def get(self, url):
+        'Download url.'
+        return getebook.fetch.get(url)
+
+class MirrorSource:
+    '''Source that reads pages from a local mirror of websites, with one
+    subdirectory per host, as created by "wget --mirror". Pages saved
+    with --adjust-extension and directory indices (index.html) are
+    found as well.'''
+    def __init__(self, directory):
+        'Initialize the source for the mirror in directory.'
+        self.directory = directory
+        self._root = os.path.realpath(directory)
+
+    def _candidates(self, url):
+        '''Return the filenames under which url may be saved. URLs that
+        lead out of the mirror have none.'''
+        parts = urllib.parse.urlsplit(_strip_fragment(url))
+        path = urllib.parse.unquote(parts.path)
+        if parts.query:
+            path += '?' + parts.query
+        # Unquoting may have turned "%2e%2e" into "..".
+        names = [p for p in path.split('/') if p and p != '.']
+        if '..' in names or parts.netloc in ('.', '..'):
+            return []
+        base = os.path.join(self.directory, parts.netloc, *names)
+        if path.endswith('/') or not path:
+            return [os.path.join(base, 'index.html')]
+        return [base, base + '.html', os.path.join(base, 'index.html')]
+
+    def _inside(self, name):
+        '''Check if the file name is inside the mirror, after resolving
+        symbolic links (and, on Windows, backslashes in the URL).'''
+        name = os.path.realpath(name)
+        try:
+            return os.path.commonpath([self._root, name]) == self._root
+        except ValueError:
+            # On different drives
+            return False
+
+    def get(self, url):
+        'Read the page for url from the mirror.'
+        for name in self._candidates(url):
+            if self._inside(name) and os.path.isfile(name):
+                with open(name, 'rb') as f:
+                    return Page(url, f.read())
+        return _not_found(url)
+
+def _parse_headers(data):
+    '''Parse header lines (bytes, separated by CRLF) into a list of
+    (name, value) pairs.'''
+    headers = []
+    for line in data.split(b'\r\n'):
+        (key, sep, val) = line.partition(b':')
+        if sep:
+            headers.append((key.strip().decode('latin-1'),
+                            val.strip().decode('latin-1')))
+    return headers
+
+def _unchunk(body):
+    'Undo chunked transfer encoding.'
+    out = []
+    pos = 0
+    while True:
+        end = body.find(b'\r\n', pos)
+        if end < 0:
+            break
+        try:
+            size = int(body[pos:end].split(b';')[0], 16)
+        except ValueError:
+            break
+        if size == 0:
+            break
+        out.append(body[end+2:end+2+size])
+        pos = end + 2 + size + 2
+    return b''.join(out)
+
+def _http_response(url, block):
+    'Turn the block of a WARC response record into a Page.'
+    (head, sep, body) = block.partition(b'\r\n\r\n')
+    (status_line, sep, header_data) = head.partition(b'\r\n')
+    try:
+        status = int(status_line.split()[1])
+    except (IndexError, ValueError):
+        status = 200
+    headers = _parse_headers(header_data)
+    page = Page(url, body, status, headers)
+    if 'chunked' in page.headers.get('Transfer-Encoding', '').lower():
+        page.content = _unchunk(page.content)
+    enc = page.headers.get('Content-Encoding', '').lower()
+    if enc in ('gzip', 'x-gzip'):
+        page.content = zlib.decompress(page.content, 31)
+    elif enc == 'deflate':
+        page.content = zlib.decompress(page.content)
+    return page
+
+class WarcSource:
+    '''Source that reads pages from a WARC file, either uncompressed or
+    gzipped record by record (.warc.gz). The file is indexed once, and
+    the index is saved next to it (with the suffix ".idx") so that it
+    can be reused as long as the file does not change. Records are read
+    by seeking to their offset, the archive is never loaded as a whole.'''
+
+    def __init__(self, filename, save_index = True):
+        '''Open the WARC file and index it. If save_index is False, the
+        index is not saved to disk.'''
+        self.filename = filename
+        self._f = open(filename, 'rb')
+        self._mmap = None
+        try:
+            self._open(save_index)
+        except BaseException:
+            self.close()
+            raise
+
+    def _open(self, save_index):
+        'Check the type of the file and load or build the index.'
+        self._gzip = self._f.read(2) == b'\x1f\x8b'
+        self._f.seek(0)
+        if not self._gzip:
+            try:
+                self._mmap = mmap.mmap(self._f.fileno(), 0,
+                                       access = mmap.ACCESS_READ)
+            except ValueError:
+                # Empty file
+                pass
+        st = os.fstat(self._f.fileno())
+        self._stamp = [st.st_size, st.st_mtime]
+        self.index = self._load_index()
+        if self.index is None:
+            self.index = self._build_index()
+            if save_index:
+                self._save_index()
+
+    def close(self):
+        'Close the WARC file.'
+        if self._mmap:
+            self._mmap.close()
+        self._f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, except_type, except_val, traceback):
+        self.close()
+        return False
+
+    def _load_index(self):
+        'Load a saved index, or return None if there is no valid one.'
+        try:
+            with open(self.filename + '.idx') as f:
+                saved = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if saved.get('stamp') != self._stamp:
+            return None
+        return {url: tuple(pos) for (url, pos) in saved['index'].items()}
+
+    def _save_index(self):
+        'Save the index next to the WARC file.'
+        try:
+            with open(self.filename + '.idx', 'w') as f:
+                json.dump({'stamp': self._stamp, 'index': self.index}, f)
+        except OSError:
+            # Not writable, we will just index again next time.
+            pass
+
+    def _read_record_head(self, f):
+        '''Read the WARC header of the record at the current position of
+        file object f. Returns the headers as a dict and the length of
+        the block, or (None, 0) at the end of the file.'''
+        line = f.readline()
+        while line in (b'\r\n', b'\n'):
+            line = f.readline()
+        if not line:
+            return (None, 0)
+        if not line.startswith(b'WARC/'):
+            raise ValueError('%s: not a WARC record at offset %d' % \
+                             (self.filename, f.tell() - len(line)))
+        head = []
+        line = f.readline()
+        while line and line not in (b'\r\n', b'\n'):
+            head.append(line.rstrip(b'\r\n'))
+            line = f.readline()
+        headers = _Headers(_parse_headers(b'\r\n'.join(head)))
+        return (headers, int(headers.get('Content-Length', 0)))
+
+    def _add_to_index(self, index, headers, pos):
+        'Add the record with the given headers to the index.'
+        if headers.get('WARC-Type') != 'response':
+            return
+        url = _strip_fragment(headers.get('WARC-Target-URI', '').strip('<>'))
+        # Keep the first capture of a URL.
+        if url and not url in index:
+            index[url] = pos
+
+    def _build_index(self):
+        '''Read through the file once and map the URL of every response
+        record to its position. For uncompressed files, the position is
+        (offset, length) of the record block, for gzipped files it is
+        (offset, length) of the gzip member holding the record.'''
+        index = {}
+        f = self._f
+        f.seek(0)
+        if not self._gzip:
+            while True:
+                (headers, length) = self._read_record_head(f)
+                if headers is None:
+                    break
+                self._add_to_index(index, headers, (f.tell(), length))
+                f.seek(length, io.SEEK_CUR)
+            return index
+        # Every record is a gzip member. We decompress one member at a
+        # time; whatever is left over belongs to the next member.
+        offset = 0
+        data = b''
+        while True:
+            if not data:
+                data = f.read(1 << 16)
+                if not data:
+                    break
+            dec = zlib.decompressobj(31)
+            start = offset
+            out = [dec.decompress(data)]
+            while not dec.eof:
+                offset += len(data)
+                data = f.read(1 << 16)
+                if not data:
+                    break
+                out.append(dec.decompress(data))
+            consumed = len(data) - len(dec.unused_data)
+            offset += consumed
+            data = dec.unused_data
+            (headers, length) = self._read_record_head(
+                                    io.BytesIO(b''.join(out)))
+            if headers is not None:
+                self._add_to_index(index, headers, (start, offset - start))
+        return index
+
+    def _read_block(self, pos):
+        'Return the record block at position pos (see _build_index).'
+        (offset, length) = pos
+        if not self._gzip:
+            return self._mmap[offset:offset+length]
+        self._f.seek(offset)
+        record = io.BytesIO(zlib.decompress(self._f.read(length), 31))
+        (headers, length) = self._read_record_head(record)
+        return record.read(length)
+
+    def get(self, url):
+        'Read the page for url from the archive.'
+        url = _strip_fragment(url)
+        try:
+            pos = self.index[url]
+        except KeyError:
+            return _not_found(url)
+        return _http_response(url, self._read_block(pos))
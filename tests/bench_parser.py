@@ -0,0 +1,144 @@
+# Copyright (c) 2016, Max Fillinger <max@max-fillinger.net>
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES WITH
+# REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF MERCHANTABILITY
+# AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY SPECIAL, DIRECT,
+# INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES WHATSOEVER RESULTING FROM
+# LOSS OF USE, DATA OR PROFITS, WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR
+# OTHER TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR
+# PERFORMANCE OF THIS SOFTWARE.
+
+'''Benchmarks for EbookParser. Run them with
+
+    python -m tests.bench_parser [-n REPETITIONS] [-b BACKEND] [NAME ...]
+
+from the top directory of the repository. They are not run with the
+tests; test_scaling only checks that the pathological pages take linear
+time. The prose benchmark also reports how often handle_data is called
+and how many strings the builder gets, per MB of input.'''
+
+import argparse
+import getebook
+import getebook.backends
+import getebook.epub
+import io
+import time
+
+def deep_inline(n):
+    '''n paragraphs, each opened under two more unclosed inline tags, so
+    the inline tags pile up to a depth of 2n. Scanning elem_stack for an
+    open paragraph at every <p> made this quadratic.'''
+    return ''.join('<font><span><p>text %d</p>' % i for i in range(n))
+
+def unclosed_inline(n):
+    '''n paragraphs without end tags, each followed by 20 unclosed inline
+    tags, which the next paragraph has to close. This is linear, but
+    every missing end tag costs a diagnostic.'''
+    return ''.join('<p>text %d' % i + '<font><span>' * 10
+                   for i in range(n))
+
+# Pathological pages, see test_scaling.
+benchmarks = {'deep-inline': deep_inline,
+              'unclosed-inline': unclosed_inline}
+
+_paragraph = '''<p>It was a dark &amp; stormy night; the rain fell in
+torrents, except at occasional intervals, when it was checked by a
+violent gust of wind<!-- sic --> which swept up the streets (for it is
+in London that our scene lies), <i>rattling</i> along the housetops
+&#8212; and fiercely agitating the scanty flame of the lamps.</p>
+'''
+
+def prose(n):
+    '''n paragraphs of prose with entities, comments and line breaks in
+    the source, like a page saved from a word processor.'''
+    return _paragraph * n
+
+def page(body):
+    'Return an html page with body as its book content.'
+    return '<html><body><div id="c">%s</div></body></html>' % body
+
+def parse(html, backend = getebook.backends.HTMLParserBackend):
+    '''Parse html into an epub in memory and return the time it took in
+    seconds.'''
+    bld = getebook.epub.EpubBuilder(io.BytesIO())
+    p = getebook.EbookParser(bld, 'Next', root_tag = 'div', root_id = 'c',
+                             backend = backend)
+    bld.new_part()
+    start = time.perf_counter()
+    p.feed(html)
+    p.close()
+    bld.finalize()
+    return time.perf_counter() - start
+
+class _CountingParser(getebook.EbookParser):
+    'EbookParser that counts the calls of handle_data.'
+    data_calls = 0
+
+    def handle_data(self, data):
+        self.data_calls += 1
+        super().handle_data(data)
+
+class _CountingBuilder(getebook.epub.EpubBuilder):
+    'EpubBuilder that counts the strings in the elements it gets.'
+    text_nodes = 0
+
+    def handle_elem(self, elem):
+        stack = [elem]
+        while stack:
+            e = stack.pop()
+            if isinstance(e, str):
+                self.text_nodes += 1
+            else:
+                stack.extend(e.children)
+        super().handle_elem(elem)
+
+def count(html, backend = getebook.backends.HTMLParserBackend):
+    '''Parse html like parse, and return the number of handle_data calls
+    and of strings handed to the builder.'''
+    bld = _CountingBuilder(io.BytesIO())
+    p = _CountingParser(bld, 'Next', root_tag = 'div', root_id = 'c',
+                        backend = backend)
+    bld.new_part()
+    p.feed(html)
+    p.close()
+    bld.finalize()
+    return (p.data_calls, bld.text_nodes)
+
+def main(argv = None):
+    'Run the benchmarks from the command line.'
+    names = sorted(benchmarks) + ['prose']
+    argp = argparse.ArgumentParser(description = 'EbookParser benchmarks.')
+    argp.add_argument('-n', '--repetitions', type = int, default = 10000,
+                      help = 'size of the pages (default: 10000)')
+    argp.add_argument('-b', '--backend', default = 'html.parser',
+                      choices = sorted(getebook.backends.backends),
+                      help = 'tokenizer backend (default: html.parser)')
+    argp.add_argument('names', nargs = '*', metavar = 'NAME',
+                      help = 'benchmarks to run (default: all of %s)'
+                             % ', '.join(names))
+    args = argp.parse_args(argv)
+    for name in args.names:
+        if not name in names:
+            argp.error('unknown benchmark: %s' % name)
+    backend = getebook.backends.backends[args.backend]
+    for name in args.names or names:
+        if name == 'prose':
+            html = page(prose(args.repetitions))
+            mb = len(html.encode()) / (1 << 20)
+            t = parse(html, backend)
+            (data_calls, text_nodes) = count(html, backend)
+            print('prose: %.1f MB, %.2f s per MB, %d handle_data calls '
+                  'and %d strings per MB' % (mb, t / mb, data_calls / mb,
+                                             text_nodes / mb))
+            continue
+        html = page(benchmarks[name](args.repetitions))
+        t = parse(html, backend)
+        print('%s: %d repetitions, %.2f s (%.1f us per repetition)'
+              % (name, args.repetitions, t, t / args.repetitions * 1e6))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,152 @@
+# Copyright (c) 2016, Max Fillinger <max@max-fillinger.net>
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES WITH
+# REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF MERCHANTABILITY
+# AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY SPECIAL, DIRECT,
+# INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES WHATSOEVER RESULTING FROM
+# LOSS OF USE, DATA OR PROFITS, WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR
+# OTHER TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR
+# PERFORMANCE OF THIS SOFTWARE.
+
+'''Conformance tests for the tokenizer backends: for the pages in the
+corpus directory, and for generated pages with properly nested
+elements, every backend must give the same ebook as html.parser.'''
+
+import getebook
+import getebook.backends
+import getebook.epub
+import glob
+import io
+import os.path
+import random
+import re
+import unittest
+import zipfile
+
+_corpus_dir = os.path.join(os.path.dirname(__file__), 'corpus')
+
+try:
+    import lxml
+    _have_lxml = True
+except ImportError:
+    _have_lxml = False
+
+def build(html, backend):
+    '''Build an epub from the page html with backend. Returns the
+    members of the epub (as a dict), the link to the next page and the
+    base URL found by the parser.'''
+    out = io.BytesIO()
+    builder = getebook.epub.EpubBuilder(out, reproducible = True)
+    p = getebook.EbookParser(builder, 'Next|Kapitel [0-9]* >>',
+                             root_tag = 'div', root_id = 'gutenb',
+                             backend = backend, diagnostics = None)
+    builder.new_part()
+    p.feed(html)
+    p.close()
+    builder.finalize()
+    with zipfile.ZipFile(io.BytesIO(out.getvalue())) as zf:
+        members = {name: zf.read(name) for name in zf.namelist()}
+    return (members, p.next_part, getattr(p, 'base', None))
+
+def body_text(members):
+    'Return the <body> of all parts of an epub, joined.'
+    return ''.join(members[name].decode('utf-8').split('<body>')[1]
+                   for name in sorted(members) if name.startswith('part'))
+
+_inline = ['span', 'font', 'i', 'b', 'em']
+_block = ['p', 'div', 'h2', 'blockquote']
+
+def nested_page(rnd, depth = 0, inline = False):
+    'Return a random piece of html with properly nested elements.'
+    out = []
+    for i in range(rnd.randint(1, 3)):
+        if depth > 3 or rnd.random() < 0.4:
+            out.append('w%d ' % rnd.randint(0, 999))
+            continue
+        if inline:
+            tag = rnd.choice(_inline)
+        elif depth:
+            tag = rnd.choice(_inline + _block)
+        else:
+            tag = rnd.choice(_block)
+        # Paragraphs, headings and inline elements may only contain
+        # inline elements.
+        out.append('<%s>%s</%s>' % (tag, nested_page(rnd, depth + 1,
+                                    inline or not tag in ('div',
+                                                          'blockquote')),
+                                    tag))
+    return ''.join(out)
+
+def broken_page(rnd):
+    'Return random html with unclosed and stray tags.'
+    out = []
+    for i in range(rnd.randint(3, 25)):
+        r = rnd.random()
+        if r < 0.35:
+            out.append('w%d ' % rnd.randint(0, 999))
+        elif r < 0.7:
+            out.append('<%s>' % rnd.choice(_inline + _block + ['br']))
+        else:
+            # A stray </div> would close the content root.
+            out.append('</%s>' % rnd.choice(_inline + ['p', 'h2',
+                                                      'blockquote']))
+    return ''.join(out)
+
+def _page(body):
+    'Put body into a page, followed by a paragraph.'
+    return ('<html><body><div id="gutenb">%s<p>w1000</p></div></body>'
+            '</html>' % body)
+
+@unittest.skipUnless(_have_lxml, 'lxml is not installed')
+class LxmlBackendTest(unittest.TestCase):
+    def assert_same(self, html, msg = None):
+        'Check that both backends give the same ebook for html.'
+        self.assertEqual(build(html, getebook.backends.HTMLParserBackend),
+                         build(html, getebook.backends.LxmlBackend), msg)
+
+    def test_corpus(self):
+        names = sorted(glob.glob(os.path.join(_corpus_dir, '*.html')))
+        self.assertTrue(names)
+        for name in names:
+            with open(name, encoding = 'utf-8') as f:
+                html = f.read()
+            with self.subTest(page = os.path.basename(name)):
+                self.assert_same(html)
+
+    def test_nested(self):
+        rnd = random.Random(1)
+        for i in range(300):
+            body = nested_page(rnd)
+            self.assert_same(_page(body), body)
+
+    def test_broken_keeps_content(self):
+        # lxml repairs broken html differently than the parser would, so
+        # the ebooks differ, but all text must be kept.
+        rnd = random.Random(1)
+        for i in range(300):
+            body = broken_page(rnd)
+            text = body_text(build(_page(body),
+                                   getebook.backends.LxmlBackend)[0])
+            self.assertEqual(sorted(re.findall(r'w[0-9]+', text)),
+                             sorted(re.findall(r'w[0-9]+', body) +
+                                    ['w1000']), body)
+
+    def test_implied_end_tags(self):
+        # lxml puts the second paragraph inside the span and reports the
+        # end tags of span, font and the first paragraph after it.
+        html = _page('<div class="wrap"><p>a <font><span>b<p>c</div>'
+                     '<p>after</p>')
+        self.assert_same(html)
+        self.assertIn('<p>after</p>', body_text(build(html,
+                                       getebook.backends.LxmlBackend)[0]))
+
+    def test_valueless_attribute(self):
+        self.assert_same(_page('<table><tr><td nowrap>x</td></tr></table>'
+                               '<p><img src="a.png" alt="">y</p>'))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,141 @@
+# Copyright (c) 2016, Max Fillinger <max@max-fillinger.net>
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES WITH
+# REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF MERCHANTABILITY
+# AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY SPECIAL, DIRECT,
+# INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES WHATSOEVER RESULTING FROM
+# LOSS OF USE, DATA OR PROFITS, WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR
+# OTHER TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR
+# PERFORMANCE OF THIS SOFTWARE.
+
+'''Tests for the limits of a build (getebook.Budget): loops, duplicate
+pages, and the page, size and time limits, with and without parallel
+parsing.'''
+
+import getebook
+import getebook.epub
+import getebook.sources
+import io
+import os
+import os.path
+import tempfile
+import unittest
+import unittest.mock
+import warnings
+
+_pages = 5
+
+def page(i, link):
+    'Return page i of the book with a link to the page link.'
+    if link:
+        link = '<a href="/book/%s">Next</a>' % link
+    else:
+        link = ''
+    return ('<html><body><div id="c"><h2>Chapter %s</h2><p>Text.</p>'
+            '</div>%s</body></html>' % (i, link)).encode()
+
+class _Clock:
+    'Replacement for time.monotonic that advances a second per call.'
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        self.now += 1
+        return self.now
+
+class BudgetTest(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.mirror = tmp.name
+        os.makedirs(os.path.join(self.mirror, 'example.org', 'book'))
+        for i in range(1, _pages + 1):
+            self.write(i, page(i, i + 1 if i < _pages else None))
+
+    def write(self, name, content):
+        'Write content (bytes) as page name of the book.'
+        with open(os.path.join(self.mirror, 'example.org', 'book',
+                               str(name)), 'wb') as f:
+            f.write(content)
+
+    def build(self, budget, processes = None):
+        '''Build the book with budget. Returns the status and the
+        numbers of the pages that were used.'''
+        bld = getebook.epub.EpubBuilder(io.BytesIO())
+        p = getebook.EbookParser(bld, 'Next', root_tag = 'div',
+                                 root_id = 'c', diagnostics = None,
+                                 source = getebook.sources.MirrorSource(
+                                            self.mirror),
+                                 budget = budget)
+        try:
+            status = p.getebook('http://example.org/', 'book/1', processes)
+        finally:
+            bld.discard()
+        pages = [i[1].rsplit('/', 1)[1] for i in bld.inputs
+                 if i[0] == 'page']
+        if status != 'complete':
+            self.assertIn(['config', 'stopped', status], bld.inputs)
+        return (status, pages)
+
+    def check(self, budget, status, pages):
+        '''Check that a build with budget ends with status after pages,
+        serially and in parallel. If the build is stopped, check that a
+        strict budget raises BuildStopped instead.'''
+        for processes in (None, 2):
+            with self.subTest(processes = processes):
+                with warnings.catch_warnings(record = True) as w:
+                    warnings.simplefilter('always')
+                    result = self.build(budget, processes)
+                self.assertEqual(result, (status, pages))
+                if status == 'complete':
+                    self.assertEqual(w, [])
+                    continue
+                self.assertEqual(len(w), 1)
+                self.assertIn('after %d pages' % len(pages),
+                              str(w[0].message))
+                budget.strict = True
+                try:
+                    with self.assertRaises(getebook.BuildStopped) as cm:
+                        self.build(budget, processes)
+                finally:
+                    budget.strict = False
+                self.assertEqual(cm.exception.reason, status)
+
+    def test_complete(self):
+        self.check(getebook.Budget(), 'complete',
+                   ['1', '2', '3', '4', '5'])
+
+    def test_loop(self):
+        self.write(3, page(3, '1#top'))
+        self.check(getebook.Budget(), 'loop', ['1', '2', '3'])
+
+    def test_duplicate(self):
+        self.write(2, page(2, 'copy'))
+        self.write('copy', page(2, 'copy'))
+        self.check(getebook.Budget(), 'duplicate', ['1', '2'])
+
+    def test_max_pages(self):
+        self.check(getebook.Budget(max_pages = 3), 'max_pages',
+                   ['1', '2', '3'])
+        self.check(getebook.Budget(max_pages = 5), 'complete',
+                   ['1', '2', '3', '4', '5'])
+
+    def test_max_bytes(self):
+        size = len(page(1, 2))
+        self.check(getebook.Budget(max_bytes = 2 * size), 'max_bytes',
+                   ['1', '2'])
+
+    def test_max_time(self):
+        self.check(getebook.Budget(max_time = 0), 'max_time', [])
+        # The clock is read when the build starts and before each page.
+        with unittest.mock.patch('time.monotonic', _Clock()):
+            with self.assertWarns(UserWarning):
+                (status, pages) = self.build(getebook.Budget(max_time = 3))
+        self.assertEqual((status, pages), ('max_time', ['1', '2']))
+
+if __name__ == '__main__':
+    unittest.main()
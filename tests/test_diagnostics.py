@@ -0,0 +1,118 @@
+# Copyright (c) 2016, Max Fillinger <max@max-fillinger.net>
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES WITH
+# REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF MERCHANTABILITY
+# AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY SPECIAL, DIRECT,
+# INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES WHATSOEVER RESULTING FROM
+# LOSS OF USE, DATA OR PROFITS, WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR
+# OTHER TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR
+# PERFORMANCE OF THIS SOFTWARE.
+
+'''Tests for getebook.Diagnostics: every problem is counted, but only
+the first few of every kind are kept as samples.'''
+
+import getebook
+import getebook.epub
+import getebook.sources
+import io
+import os
+import os.path
+import tempfile
+import unittest
+import warnings
+
+_pages = 3
+_unclosed = 4 # Unclosed tags per page
+
+def page(i):
+    'Return page i of the book, with unclosed tags on lines 2 to 5.'
+    if i < _pages:
+        link = '<a href="/book/%d">Next</a>' % (i + 1)
+    else:
+        link = ''
+    return ('<html><body><div id="c">\n' + '<p><i>Text.</p>\n' * _unclosed
+            + '</div>%s</body></html>' % link).encode()
+
+class DiagnosticsTest(unittest.TestCase):
+    def test_report(self):
+        diag = getebook.Diagnostics(max_samples = 2)
+        diag.url = 'u'
+        positions = []
+        def getpos():
+            positions.append(len(positions) + 1)
+            return (positions[-1], 0)
+        for i in range(5):
+            diag.report('a', 'detail %d' % i, getpos)
+        diag.report('b', 'other', getpos)
+        # The position is only needed for samples.
+        self.assertEqual(len(positions), 3)
+        self.assertEqual(diag.counts, {'a': 5, 'b': 1})
+        self.assertEqual(diag.samples, {
+          'a': [{'url': 'u', 'line': 1, 'detail': 'detail 0'},
+                {'url': 'u', 'line': 2, 'detail': 'detail 1'}],
+          'b': [{'url': 'u', 'line': 3, 'detail': 'other'}]})
+        other = getebook.Diagnostics(max_samples = 2)
+        other.url = 'v'
+        other.pages = 2
+        for kind in ('b', 'b', 'c'):
+            other.report(kind, kind, lambda: (7, 0))
+        diag.merge(other)
+        self.assertEqual(diag.summary(), {
+          'pages': 2, 'counts': {'a': 5, 'b': 3, 'c': 1},
+          'samples': {
+            'a': [{'url': 'u', 'line': 1, 'detail': 'detail 0'},
+                  {'url': 'u', 'line': 2, 'detail': 'detail 1'}],
+            'b': [{'url': 'u', 'line': 3, 'detail': 'other'},
+                  {'url': 'v', 'line': 7, 'detail': 'b'}],
+            'c': [{'url': 'v', 'line': 7, 'detail': 'c'}]}})
+        self.assertEqual(str(diag).splitlines()[:4],
+                         ['problems in 2 pages:', '  a: 5',
+                          '    u, line 1: detail 0',
+                          '    u, line 2: detail 1'])
+
+    def build(self, max_samples, processes = None):
+        'Build the book and return the diagnostics.'
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        os.makedirs(os.path.join(tmp.name, 'example.org', 'book'))
+        for i in range(1, _pages + 1):
+            with open(os.path.join(tmp.name, 'example.org', 'book', str(i)),
+                      'wb') as f:
+                f.write(page(i))
+        bld = getebook.epub.EpubBuilder(io.BytesIO())
+        diag = getebook.Diagnostics(max_samples)
+        p = getebook.EbookParser(bld, 'Next', root_tag = 'div',
+                                 root_id = 'c', diagnostics = diag,
+                                 source = getebook.sources.MirrorSource(
+                                            tmp.name))
+        try:
+            with warnings.catch_warnings(record = True) as w:
+                warnings.simplefilter('always')
+                p.getebook('http://example.org/', 'book/1', processes)
+        finally:
+            bld.discard()
+        self.assertEqual([str(x.message) for x in w], [str(diag)])
+        return diag
+
+    def test_parser(self):
+        for processes in (None, 2):
+            for max_samples in (0, 3, 6, 100):
+                with self.subTest(processes = processes,
+                                  max_samples = max_samples):
+                    diag = self.build(max_samples, processes)
+                    self.assertEqual(diag.pages, _pages)
+                    self.assertEqual(diag.counts, {'missing-end-tag':
+                                                   _pages * _unclosed})
+                    samples = [(s['url'], s['line'], s['detail'])
+                               for s in diag.samples['missing-end-tag']]
+                    self.assertEqual(samples, [
+                      ('http://example.org/book/%d' % i, line, 'i')
+                      for i in range(1, _pages + 1)
+                      for line in range(2, _unclosed + 2)][:max_samples])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,118 @@
+# Copyright (c) 2016, Max Fillinger <max@max-fillinger.net>
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES WITH
+# REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF MERCHANTABILITY
+# AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY SPECIAL, DIRECT,
+# INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES WHATSOEVER RESULTING FROM
+# LOSS OF USE, DATA OR PROFITS, WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR
+# OTHER TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR
+# PERFORMANCE OF THIS SOFTWARE.
+
+'''Tests for the choice of the encoding of downloaded pages.'''
+
+import codecs
+import getebook.encoding
+import unittest
+import unittest.mock
+
+find_encoding = getebook.encoding.find_encoding
+
+class _Response:
+    'Stand-in for requests.Response.'
+    def __init__(self, url, content, content_type = None):
+        self.url = url
+        self.content = content
+        self.headers = {}
+        if content_type:
+            self.headers['Content-Type'] = content_type
+
+def meta(charset):
+    'Return the start of a page that declares charset in a <meta> tag.'
+    return b'<html><head><meta charset="%s"></head>' % charset.encode()
+
+class EncodingTest(unittest.TestCase):
+    def setUp(self):
+        patch = unittest.mock.patch.dict(getebook.encoding.host_encodings,
+                                         clear = True)
+        patch.start()
+        self.addCleanup(patch.stop)
+        # Charset detection depends on the installed library; it is
+        # replaced by a fixed guess.
+        self.guess = None
+        patch = unittest.mock.patch('getebook.encoding._detect',
+                                    lambda data: self.guess)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def test_precedence(self):
+        page = meta('koi8-r') + 'Müller'.encode('latin-1')
+        header = 'text/html; charset=iso-8859-15'
+        self.assertEqual(find_encoding(codecs.BOM_UTF8 + page, header),
+                         'utf-8-sig')
+        self.assertEqual(find_encoding(page, header), 'iso8859-15')
+        self.assertEqual(find_encoding(page, 'text/html'), 'koi8-r')
+        self.assertEqual(find_encoding(page, 'text/html; charset=nonsense'),
+                         'koi8-r')
+        self.assertEqual(find_encoding('Müller'.encode('utf-8')), 'utf-8')
+        self.guess = 'iso8859-15'
+        self.assertEqual(find_encoding('Müller'.encode('latin-1')),
+                         'iso8859-15')
+        self.guess = None
+        # latin-1 is treated as windows-1252, like browsers do.
+        self.assertEqual(find_encoding(meta('latin-1')), 'cp1252')
+        self.assertEqual(find_encoding('Müller'.encode('latin-1')), 'cp1252')
+
+    def test_invalid_utf8_at_end(self):
+        # A non-UTF-8 byte far behind the start must be noticed.
+        data = b'x' * (1 << 20) + 'Straße'.encode('latin-1')
+        self.assertEqual(find_encoding(data), 'cp1252')
+        r = _Response('http://example.org/1', data)
+        self.assertTrue(getebook.encoding.decode(r).endswith('Straße'))
+
+    def test_host_declared(self):
+        find_encoding(meta('koi8-r'), host = 'example.org')
+        page = 'Привет'.encode('koi8-r')
+        self.assertEqual(find_encoding(page, host = 'example.org'),
+                         'koi8-r')
+        # Valid UTF-8 and declarations still come first.
+        self.assertEqual(find_encoding('Müller'.encode('utf-8'),
+                                       host = 'example.org'), 'utf-8')
+        self.assertEqual(find_encoding(meta('cp1252'), host = 'example.org'),
+                         'cp1252')
+        # The last declaration counts.
+        self.assertEqual(find_encoding(page, host = 'example.org'),
+                         'cp1252')
+        # Other hosts are not affected.
+        self.assertEqual(find_encoding(page, host = 'example.com'),
+                         'cp1252')
+
+    def test_host_detected(self):
+        # A guess for one page is not used for the next one.
+        self.guess = 'cp1006'
+        page = 'Müller Straße'.encode('latin-1')
+        self.assertEqual(find_encoding(page, host = 'example.org'),
+                         'cp1006')
+        self.guess = None
+        self.assertEqual(find_encoding(page, host = 'example.org'),
+                         'cp1252')
+        self.assertEqual(getebook.encoding.host_encodings, {})
+
+    def test_host_utf8(self):
+        # If a host declared UTF-8 and a page is not, it is detected.
+        find_encoding(b'', 'text/html; charset=utf-8', 'example.org')
+        self.guess = 'iso8859-15'
+        self.assertEqual(find_encoding('Müller'.encode('latin-1'),
+                                       host = 'example.org'), 'iso8859-15')
+
+    def test_response(self):
+        r = _Response('http://Example.org/1', meta('koi8-r'))
+        self.assertEqual(getebook.encoding.response_encoding(r), 'koi8-r')
+        self.assertEqual(getebook.encoding.host_encodings,
+                         {'example.org': 'koi8-r'})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,376 @@
+# Copyright (c) 2016, Max Fillinger <max@max-fillinger.net>
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES WITH
+# REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF MERCHANTABILITY
+# AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY SPECIAL, DIRECT,
+# INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES WHATSOEVER RESULTING FROM
+# LOSS OF USE, DATA OR PROFITS, WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR
+# OTHER TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR
+# PERFORMANCE OF THIS SOFTWARE.
+
+'''Tests for EpubBuilder: every XML file in the epub must be well-formed,
+whatever the input, an epub streamed to a non-seekable file has the same
+content as one written to a normal file, and exploded builds only touch
+the files that changed.'''
+
+import getebook
+import getebook.backends
+import getebook.epub
+import io
+import os
+import os.path
+import stat
+import tempfile
+import unittest
+import xml.etree.ElementTree as etree
+import zipfile
+
+# Text with characters that must be escaped or removed in XML
+_nasty = 'a & b < c > d "e" \'f\' \x01\x0b\x1f\ufffe end'
+
+_page = '''<html><body><div id="gutenb">
+<h2 class="x&quot;y">Chapter &amp; &lt;One&gt; \x02</h2>
+<p class="centerbig">1. Kapitel &amp;</p>
+<h3>Heading after a paragraph heading</h3>
+<h4 class="note">False &lt;heading&gt;</h4>
+<p align=center nowrap title="&quot;quoted&quot; &amp; &lt;angled&gt; \x03">
+  Text with &amp; and &lt; and &gt; and raw control characters \x04\x0c.</p>
+<p>Word processor markup<o:p></o:p> and <st1:place w:st="on">tags with
+  colons</st1:place>, <span foo:bar="1" data-x="2" 1bad="3">odd
+  attributes</span>.</p>
+<div class="wrap"><p>Paragraph in a wrapper<br>with a line break
+  <img src="a.png" alt="&lt;alt&gt; &amp; &quot;text&quot;"></p>
+<p>Unclosed paragraph in the wrapper<i>with unclosed <b>inline</div>
+<p>%s</p>
+<p title="only \x05">Only control characters \x06\x07</p>
+<a name="anchor">Anchor text</a>
+</div></body></html>''' % ('<span>' * 2000 + 'Deeply nested' +
+                           '</span>' * 2000)
+
+def build(backend = getebook.backends.HTMLParserBackend, stream = True,
+          reproducible = False):
+    '''Build an epub with nasty metadata and content from _page. Returns
+    the epub as bytes. If stream is False, the builder is used without
+    its start_elem method.'''
+    out = io.BytesIO()
+    bld = getebook.epub.EpubBuilder(out, reproducible = reproducible,
+                                    index = True)
+    bld.title = 'Title ' + _nasty
+    bld.author = ['Author ' + _nasty,
+                  getebook.epub.Author('Other <Author>', 'Author, &')]
+    bld.rights = 'Rights ' + _nasty
+    bld.publisher = 'Publisher ' + _nasty
+    bld.uid = 'uid & <uid>'
+    bld.titlepage('Main title \x08', 'Subtitle ' + _nasty)
+    bld.headingpage('Heading ' + _nasty, 'Subheading ' + _nasty,
+                    'TOC ' + _nasty)
+    p = getebook.EbookParser(bld, 'Next', root_tag = 'div',
+                             root_id = 'gutenb', backend = backend,
+                             diagnostics = None)
+    p.quirks.par_heading('centerbig', None)
+    p.quirks.false_heading('note', None)
+    p._streaming = stream
+    bld.new_part()
+    p.feed(_page)
+    p.close()
+    bld.add_file('extra.html', '<html>not checked</html>')
+    bld.finalize()
+    return out.getvalue()
+
+def check_xml(test, epub):
+    '''Parse every XML member of epub with xml.etree. Returns the text
+    of all parts and the elements with a nowrap attribute.'''
+    text = ''
+    nowrap = []
+    with zipfile.ZipFile(io.BytesIO(epub)) as zf:
+        names = [n for n in zf.namelist()
+                 if n.endswith(('.html', '.opf', '.ncx', '.xml'))
+                 and n != 'extra.html']
+        test.assertIn('package.opf', names)
+        test.assertIn('toc.ncx', names)
+        for name in names:
+            with test.subTest(member = name):
+                root = etree.fromstring(zf.read(name))
+                if name.startswith('part'):
+                    text += ''.join(root.itertext())
+                    nowrap += root.findall('.//*[@nowrap]')
+    return (text, nowrap)
+
+class XMLTest(unittest.TestCase):
+    def check(self, **kwargs):
+        (text, nowrap) = check_xml(self, build(**kwargs))
+        # Attributes without value get their name as value.
+        self.assertEqual([e.get('nowrap') for e in nowrap], ['nowrap'])
+        for piece in ('Text with & and < and > and raw control',
+                      'Only control characters',
+                      'Word processor markup', 'tags with\ncolons',
+                      'Deeply nested', 'Unclosed paragraph', 'inline',
+                      'Anchor text'):
+            self.assertIn(piece, text)
+
+    def test_streaming(self):
+        self.check()
+
+    def test_not_streaming(self):
+        self.check(stream = False)
+
+    def test_reproducible(self):
+        self.check(reproducible = True)
+
+    def test_lxml(self):
+        try:
+            import lxml
+        except ImportError:
+            self.skipTest('lxml is not installed')
+        self.check(backend = getebook.backends.LxmlBackend)
+
+    def test_metadata(self):
+        with zipfile.ZipFile(io.BytesIO(build())) as zf:
+            opf = etree.fromstring(zf.read('package.opf'))
+            ncx = etree.fromstring(zf.read('toc.ncx'))
+        dc = '{http://purl.org/dc/elements/1.1/}'
+        self.assertEqual(opf.find('.//%stitle' % dc).text,
+                         'Title a & b < c > d "e" \'f\'  end')
+        self.assertEqual(opf.find('.//%sidentifier' % dc).text,
+                         'uid & <uid>')
+        ncx_text = ''.join(ncx.itertext())
+        self.assertIn('TOC a & b < c > d', ncx_text)
+        self.assertIn('Chapter & <One>', ncx_text)
+
+class FileTest(unittest.TestCase):
+    def test_permissions(self):
+        # The epub gets the permissions of any new file, not those of a
+        # temporary file.
+        if os.name != 'posix':
+            self.skipTest('needs POSIX permissions')
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        name = os.path.join(tmp.name, 'book.epub')
+        for umask in (0o022, 0o077, 0o027):
+            old = os.umask(umask)
+            try:
+                getebook.epub.EpubBuilder(name).finalize()
+            finally:
+                os.umask(old)
+            mode = stat.S_IMODE(os.stat(name).st_mode)
+            self.assertEqual(mode, 0o666 & ~umask)
+        self.assertEqual(os.listdir(tmp.name), ['book.epub'])
+
+    def test_error_keeps_file(self):
+        # A build that fails inside the with block must not replace an
+        # existing book.
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        name = os.path.join(tmp.name, 'book.epub')
+        with open(name, 'wb') as f:
+            f.write(b'old book')
+        with self.assertRaises(getebook.BuildStopped):
+            with getebook.epub.EpubBuilder(name) as bld:
+                bld.new_part()
+                bld.handle_elem('Partial text.')
+                raise getebook.BuildStopped('pages', 'too many pages')
+        with open(name, 'rb') as f:
+            self.assertEqual(f.read(), b'old book')
+        self.assertEqual(os.listdir(tmp.name), ['book.epub'])
+
+def build_book(epub_file, chapters, exploded = False):
+    '''Build a reproducible book with one part per chapter (a pair of
+    heading and text) and return the builder.'''
+    bld = getebook.epub.EpubBuilder(epub_file, reproducible = True,
+                                    exploded = exploded)
+    bld.uid = 'uid'
+    bld.title = 'Title'
+    p = getebook.EbookParser(bld, 'Next', root_tag = 'div',
+                             root_id = 'gutenb', diagnostics = None)
+    for (heading, text) in chapters:
+        bld.new_part()
+        p.feed('<html><body><div id="gutenb"><h2>%s</h2><p>%s</p>'
+               '</div></body></html>' % (heading, text))
+    p.close()
+    bld.finalize()
+    return bld
+
+_chapters = [('One', 'First text.'), ('Two', 'Second text.'),
+             ('Three', 'Third text.')]
+
+class ExplodedTest(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.dir = os.path.join(tmp.name, 'book')
+
+    def snapshot(self):
+        '''Return the members of the exploded book with their content,
+        after setting their modification times far into the past.'''
+        files = {}
+        for name in getebook.epub._members(self.dir):
+            path = os.path.join(self.dir, *name.split('/'))
+            with open(path, 'rb') as f:
+                files[name] = f.read()
+            os.utime(path, (1, 1))
+        return files
+
+    def rewritten(self):
+        'Return the members that were written since the snapshot.'
+        return {name for name in getebook.epub._members(self.dir)
+                if os.stat(os.path.join(self.dir,
+                                        *name.split('/'))).st_mtime > 1}
+
+    def test_rebuild(self):
+        build_book(self.dir, _chapters, exploded = True)
+        old = self.snapshot()
+        self.assertIn('part002.html', old)
+        # Nothing is written if nothing changed.
+        build_book(self.dir, _chapters, exploded = True)
+        self.assertEqual(self.rewritten(), set())
+        self.assertEqual(self.snapshot(), old)
+        # Only the changed part is written.
+        chapters = [_chapters[0], ('Two', 'Changed text.'), _chapters[2]]
+        bld = build_book(self.dir, chapters, exploded = True)
+        self.assertEqual(bld.epub_f.changed, ['part001.html'])
+        self.assertEqual(self.rewritten(), {'part001.html'})
+        new = self.snapshot()
+        self.assertIn(b'Changed text.', new['part001.html'])
+        del old['part001.html']
+        del new['part001.html']
+        self.assertEqual(new, old)
+        # A shorter book removes the parts it doesn't have anymore.
+        build_book(self.dir, chapters[:2], exploded = True)
+        self.assertNotIn('part002.html', getebook.epub._members(self.dir))
+        self.assertEqual(self.rewritten(), {'package.opf', 'toc.ncx'})
+
+    def test_pack(self):
+        build_book(self.dir, _chapters, exploded = True)
+        built = io.BytesIO()
+        build_book(built, _chapters)
+        packed = io.BytesIO()
+        getebook.epub.pack(self.dir, packed, reproducible = True)
+        # The members come in a different order, but are the same.
+        with zipfile.ZipFile(built) as zf_built, \
+             zipfile.ZipFile(packed) as zf_packed:
+            self.assertIsNone(zf_packed.testzip())
+            infos = zf_packed.infolist()
+            self.assertEqual(infos[0].filename, 'mimetype')
+            self.assertEqual(infos[0].compress_type, zipfile.ZIP_STORED)
+            self.assertEqual(sorted(zf_packed.namelist()),
+                             sorted(zf_built.namelist()))
+            for info in infos:
+                with self.subTest(member = info.filename):
+                    built_info = zf_built.getinfo(info.filename)
+                    self.assertEqual(zf_packed.read(info),
+                                     zf_built.read(built_info))
+                    self.assertEqual((info.date_time, info.external_attr),
+                                     (built_info.date_time,
+                                      built_info.external_attr))
+        # Packing is reproducible, too.
+        again = io.BytesIO()
+        getebook.epub.pack(self.dir, again, reproducible = True)
+        self.assertEqual(again.getvalue(), packed.getvalue())
+        stored = io.BytesIO()
+        getebook.epub.pack(self.dir, stored, compress = False)
+        with zipfile.ZipFile(stored) as zf:
+            self.assertEqual({i.compress_type for i in zf.infolist()},
+                             {zipfile.ZIP_STORED})
+
+    def test_write_style(self):
+        build_book(self.dir, _chapters, exploded = True)
+        old = self.snapshot()
+        bld = getebook.epub.EpubBuilder(self.dir, exploded = True)
+        bld.style_css = 'p { color: red }'
+        bld.write_style()
+        self.assertEqual(self.rewritten(), {'style.css'})
+        new = self.snapshot()
+        self.assertEqual(new['style.css'], b'p { color: red }')
+        del old['style.css']
+        del new['style.css']
+        self.assertEqual(new, old)
+        with self.assertRaises(ValueError):
+            getebook.epub.EpubBuilder(io.BytesIO()).write_style()
+
+    def test_not_exploded(self):
+        # A directory with other files is never taken for a book.
+        os.makedirs(self.dir)
+        with open(os.path.join(self.dir, 'other'), 'w') as f:
+            f.write('other')
+        with self.assertRaises(ValueError):
+            build_book(self.dir, _chapters, exploded = True)
+        self.assertEqual(os.listdir(self.dir), ['other'])
+
+class _Pipe:
+    '''Write-only file object that can't seek or tell its position, like
+    a pipe or socket.'''
+    def __init__(self):
+        self.data = bytearray()
+
+    def write(self, data):
+        self.data += data
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def seekable(self):
+        return False
+
+    def tell(self):
+        raise OSError('not seekable')
+
+    def seek(self, offset, whence = 0):
+        raise OSError('not seekable')
+
+class StreamTest(unittest.TestCase):
+    def check_same(self, epub, expected):
+        '''Check that the bytes epub are a valid epub with the same
+        members as the bytes expected.'''
+        with zipfile.ZipFile(io.BytesIO(epub)) as zf, \
+             zipfile.ZipFile(io.BytesIO(expected)) as zf_exp:
+            self.assertIsNone(zf.testzip())
+            self.assertEqual(zf.namelist(), zf_exp.namelist())
+            for info in zf.infolist():
+                with self.subTest(member = info.filename):
+                    info_exp = zf_exp.getinfo(info.filename)
+                    self.assertEqual(zf.read(info), zf_exp.read(info_exp))
+                    self.assertEqual((info.compress_type, info.date_time),
+                                     (info_exp.compress_type,
+                                      info_exp.date_time))
+        # Readers expect the uncompressed mimetype right after the first
+        # local header.
+        self.assertEqual(epub[30:58], b'mimetypeapplication/epub+zip')
+
+    def test_chunk_writer(self):
+        expected = io.BytesIO()
+        build_book(expected, _chapters)
+        out = getebook.epub.ChunkWriter()
+        bld = getebook.epub.EpubBuilder(out, reproducible = True)
+        bld.uid = 'uid'
+        bld.title = 'Title'
+        p = getebook.EbookParser(bld, 'Next', root_tag = 'div',
+                                 root_id = 'gutenb', diagnostics = None)
+        chunks = []
+        for (heading, text) in _chapters:
+            bld.new_part()
+            p.feed('<html><body><div id="gutenb"><h2>%s</h2><p>%s</p>'
+                   '</div></body></html>' % (heading, text))
+            chunks.append(out.take())
+        p.close()
+        bld.finalize()
+        chunks.append(out.take())
+        # The epub is sent while it is being built.
+        self.assertTrue(chunks[0])
+        self.assertIn(b'part001.html', b''.join(chunks[:-1]))
+        self.assertEqual(out.take(), b'')
+        self.check_same(b''.join(chunks), expected.getvalue())
+
+    def test_pipe(self):
+        expected = io.BytesIO()
+        build_book(expected, _chapters)
+        out = _Pipe()
+        build_book(out, _chapters)
+        self.check_same(bytes(out.data), expected.getvalue())
+
+if __name__ == '__main__':
+    unittest.main()
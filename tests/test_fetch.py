@@ -0,0 +1,139 @@
+# Copyright (c) 2016, Max Fillinger <max@max-fillinger.net>
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES WITH
+# REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF MERCHANTABILITY
+# AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY SPECIAL, DIRECT,
+# INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES WHATSOEVER RESULTING FROM
+# LOSS OF USE, DATA OR PROFITS, WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR
+# OTHER TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR
+# PERFORMANCE OF THIS SOFTWARE.
+
+'Tests for the rate limiter.'
+
+import getebook.fetch
+import os
+import os.path
+import socket
+import stat
+import tempfile
+import threading
+import time
+import unittest
+import unittest.mock
+
+try:
+    import requests
+except ImportError:
+    requests = None
+
+@unittest.skipUnless(requests, 'requests is not installed')
+class RateLimiterTest(unittest.TestCase):
+    def test_timeout(self):
+        # A server that accepts the connection but never answers.
+        server = socket.socket()
+        self.addCleanup(server.close)
+        server.bind(('127.0.0.1', 0))
+        server.listen(1)
+        host = '127.0.0.1:%d' % server.getsockname()[1]
+        limiter = getebook.fetch.RateLimiter(max_tries = 2, state_dir = None,
+                                             timeout = 0.2)
+        start = time.monotonic()
+        with self.assertRaises(requests.Timeout):
+            limiter.get('http://%s/' % host)
+        self.assertLess(time.monotonic() - start, 10)
+        # The connection slot was released.
+        self.assertTrue(limiter._semaphores[host].acquire(blocking = False))
+
+    @unittest.skipUnless(getebook.fetch.fcntl, 'no fcntl')
+    def test_state_dir_per_user(self):
+        limiter = getebook.fetch.RateLimiter()
+        self.assertEqual(limiter.state_dir,
+                         os.path.join(tempfile.gettempdir(),
+                                      'getebook-ratelimit-%d' % os.getuid()))
+
+@unittest.skipUnless(requests, 'requests is not installed')
+@unittest.skipUnless(getebook.fetch.fcntl, 'no fcntl')
+class StateDirTest(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.tmp = tmp.name
+        patch = unittest.mock.patch('tempfile.gettempdir',
+                                    lambda: self.tmp)
+        patch.start()
+        self.addCleanup(patch.stop)
+        self.name = os.path.join(self.tmp,
+                                 'getebook-ratelimit-%d' % os.getuid())
+
+    def test_created(self):
+        limiter = getebook.fetch.RateLimiter()
+        self.assertEqual(limiter.state_dir, self.name)
+        self.assertEqual(stat.S_IMODE(os.stat(self.name).st_mode), 0o700)
+        # It is used again.
+        self.assertEqual(getebook.fetch.RateLimiter().state_dir, self.name)
+
+    def check_not_private(self):
+        with self.assertWarns(UserWarning):
+            limiter = getebook.fetch.RateLimiter()
+        self.assertIsNone(limiter.state_dir)
+
+    def test_accessible(self):
+        os.mkdir(self.name)
+        os.chmod(self.name, 0o777)
+        self.check_not_private()
+
+    def test_symlink(self):
+        target = os.path.join(self.tmp, 'target')
+        os.mkdir(target, 0o700)
+        os.symlink(target, self.name)
+        self.check_not_private()
+
+    def test_file(self):
+        open(self.name, 'w').close()
+        self.check_not_private()
+
+    @unittest.skipUnless(hasattr(os, 'geteuid') and os.geteuid() == 0,
+                         'needs root to give the directory away')
+    def test_other_owner(self):
+        os.mkdir(self.name, 0o700)
+        os.chown(self.name, 65534, 65534)
+        self.check_not_private()
+
+@unittest.skipUnless(requests, 'requests is not installed')
+@unittest.skipUnless(getebook.fetch.fcntl, 'no fcntl')
+class SlotTest(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        # Waiting for a slot must block instead of polling.
+        patch = unittest.mock.patch('time.sleep', side_effect = AssertionError)
+        patch.start()
+        self.addCleanup(patch.stop)
+        self.limiters = [getebook.fetch.RateLimiter(max_concurrent = 2,
+                                                    state_dir = tmp.name)
+                         for i in range(2)]
+
+    def test_wait(self):
+        slots = [self.limiters[0]._acquire_slot('example.org')
+                 for i in range(2)]
+        got = []
+        def acquire():
+            got.append(self.limiters[1]._acquire_slot('example.org'))
+        t = threading.Thread(target = acquire)
+        t.start()
+        t.join(0.3)
+        self.assertTrue(t.is_alive())
+        # The waiting thread gets a slot once they are released.
+        self.limiters[0]._release_slot(slots[1])
+        self.limiters[0]._release_slot(slots[0])
+        t.join(5)
+        self.assertFalse(t.is_alive())
+        self.assertEqual(len(got), 1)
+        self.limiters[1]._release_slot(got[0])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,114 @@
+# Copyright (c) 2016, Max Fillinger <max@max-fillinger.net>
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES WITH
+# REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF MERCHANTABILITY
+# AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY SPECIAL, DIRECT,
+# INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES WHATSOEVER RESULTING FROM
+# LOSS OF USE, DATA OR PROFITS, WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR
+# OTHER TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR
+# PERFORMANCE OF THIS SOFTWARE.
+
+'''Tests for reproducible builds and build fingerprints. Books are built
+from a small mirror in a temporary directory.'''
+
+import getebook
+import getebook.epub
+import getebook.sources
+import os
+import os.path
+import tempfile
+import unittest
+import zipfile
+
+_pages = 3
+
+class FingerprintTest(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.dir = tmp.name
+        self.mirror = os.path.join(self.dir, 'mirror')
+        os.makedirs(os.path.join(self.mirror, 'example.org', 'book'))
+        for i in range(1, _pages + 1):
+            self.write_page(i, 'Text of page %d.' % i)
+        self.epub = os.path.join(self.dir, 'book.epub')
+
+    def write_page(self, i, text):
+        'Write page i of the book with text to the mirror.'
+        if i < _pages:
+            link = '<a href="/book/%d">Next</a>' % (i + 1)
+        else:
+            link = ''
+        with open(os.path.join(self.mirror, 'example.org', 'book', str(i)),
+                  'w') as f:
+            f.write('<html><body><div id="c"><h2>Chapter %d</h2><p>%s</p>'
+                    '</div>%s</body></html>' % (i, text, link))
+
+    def setup_build(self, link_next = 'Next'):
+        'Return a builder and parser for the book, set up like gutenb.'
+        bld = getebook.epub.EpubBuilder(self.epub, reproducible = True)
+        bld.title = 'Book'
+        bld.author = 'Alice Author'
+        bld.titlepage()
+        p = getebook.EbookParser(bld, link_next, root_tag = 'div',
+                                 root_id = 'c',
+                                 source = getebook.sources.MirrorSource(
+                                            self.mirror))
+        return (bld, p)
+
+    def build(self, **kwargs):
+        (bld, p) = self.setup_build()
+        p.getebook('http://example.org/', 'book/1', **kwargs)
+        bld.finalize()
+
+    def unchanged(self, link_next = 'Next'):
+        'Check if a new build would be unchanged, like gutenb does.'
+        (bld, p) = self.setup_build(link_next)
+        try:
+            return p.unchanged(getebook.epub.read_build_info(self.epub))
+        finally:
+            bld.discard()
+
+    def test_unchanged(self):
+        self.build()
+        self.assertTrue(self.unchanged())
+
+    def test_unchanged_parallel(self):
+        self.build(processes = 1)
+        self.assertTrue(self.unchanged())
+
+    def test_page_changed(self):
+        self.build()
+        self.write_page(2, 'New text.')
+        self.assertFalse(self.unchanged())
+
+    def test_settings_changed(self):
+        self.build()
+        self.assertFalse(self.unchanged('Next|Weiter'))
+
+    def test_reproducible(self):
+        self.build()
+        with open(self.epub, 'rb') as f:
+            first = f.read()
+        os.remove(self.epub)
+        self.build()
+        with open(self.epub, 'rb') as f:
+            self.assertEqual(f.read(), first)
+
+    def test_mimetype_stored(self):
+        # The mimetype file must be the first member and not compressed.
+        for reproducible in (False, True):
+            with self.subTest(reproducible = reproducible):
+                bld = getebook.epub.EpubBuilder(self.epub, reproducible)
+                bld.finalize()
+                with zipfile.ZipFile(self.epub) as zf:
+                    info = zf.infolist()[0]
+                self.assertEqual(info.filename, 'mimetype')
+                self.assertEqual(info.compress_type, zipfile.ZIP_STORED)
+
+if __name__ == '__main__':
+    unittest.main()
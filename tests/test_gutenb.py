@@ -0,0 +1,149 @@
+# Copyright (c) 2016, Max Fillinger <max@max-fillinger.net>
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES WITH
+# REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF MERCHANTABILITY
+# AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY SPECIAL, DIRECT,
+# INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES WHATSOEVER RESULTING FROM
+# LOSS OF USE, DATA OR PROFITS, WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR
+# OTHER TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR
+# PERFORMANCE OF THIS SOFTWARE.
+
+'''Tests for the catalog crawler of gutenb, on a small mirror of the
+catalog.'''
+
+import getebook.sources
+import importlib.machinery
+import importlib.util
+import json
+import os
+import os.path
+import subprocess
+import sys
+import tempfile
+import unittest
+
+_top_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+_gutenb = os.path.join(_top_dir, 'gutenb')
+
+def load_gutenb():
+    'Import the gutenb script as a module.'
+    loader = importlib.machinery.SourceFileLoader('gutenb', _gutenb)
+    spec = importlib.util.spec_from_loader('gutenb', loader)
+    gutenb = importlib.util.module_from_spec(spec)
+    loader.exec_module(gutenb)
+    return gutenb
+
+_host = 'http://gutenberg.spiegel.de'
+
+# Path -> page. The first link to a book is an image of its cover.
+_pages = {
+  'autoren': '''<html><body>
+    <a href="/autor/kafka-1">Kafka</a>
+    <a href="/autor/fontane-2">Fontane</a>
+    <a href="http://example.org/autor/other-3">Elsewhere</a>
+    </body></html>''',
+  'autor/kafka-1': '''<html><body>
+    <a href="/autoren">All authors</a>
+    <a href="/buch/der-prozess-157/1"><img src="cover.jpg"></a>
+    <a href="/buch/der-prozess-157/1">Der  Proze&szlig;</a>
+    <a href="/buch/der-prozess-157/3">Chapter 3</a>
+    <a href="/buch/das-schloss-158">  </a>
+    </body></html>''',
+  'autor/fontane-2': '''<html><body>
+    <a href="/buch/effi-briest-159/2">Effi Briest</a>
+    </body></html>''',
+  'buch/der-prozess-157/1': '''<html><head>
+    <meta charset="windows-1252"></head><body>
+    <h2 class="title">Der Proze\xdf</h2>
+    <h3 class="author">Franz Kafka</h3>
+    </body></html>''',
+  'buch/das-schloss-158/1': '''<html><body>
+    <h2 class="title">Das Schloss</h2>
+    <h3 class="author">Franz Kafka</h3>
+    <h4 class="subtitle">Roman</h4>
+    </body></html>''',
+}
+
+def write_mirror(directory):
+    'Write the catalog pages to a mirror in directory.'
+    for (path, page) in _pages.items():
+        name = os.path.join(directory, 'gutenberg.spiegel.de',
+                            *path.split('/'))
+        os.makedirs(os.path.dirname(name), exist_ok = True)
+        with open(name, 'wb') as f:
+            f.write(page.encode('cp1252'))
+
+class CrawlerTest(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.mirror = tmp.name
+        write_mirror(self.mirror)
+        self.source = getebook.sources.MirrorSource(self.mirror)
+        self.gutenb = load_gutenb()
+
+    def test_catalog_parser(self):
+        p = self.gutenb.GutenbCatalogParser(_host + '/autor/kafka-1')
+        p.feed(_pages['autor/kafka-1'])
+        p.close()
+        self.assertEqual(p.books, {
+          '157': (_host + '/buch/der-prozess-157/1', 'Der Prozeß'),
+          '158': (_host + '/buch/das-schloss-158/1', '')})
+        self.assertEqual(p.indexes, [_host + '/autoren'])
+
+    def test_crawl(self):
+        crawler = self.gutenb.GutenbCrawler(self.source)
+        # The first page of Effi Briest is missing from the mirror.
+        jobs = crawler.crawl([_host + '/autoren'])
+        self.assertEqual(crawler.pages, 3)
+        self.assertEqual(jobs, [
+          {'id': '157', 'url': _host + '/buch/der-prozess-157/1',
+           'title': 'Der Prozeß', 'author': 'Franz Kafka',
+           'subtitle': None},
+          {'id': '158', 'url': _host + '/buch/das-schloss-158/1',
+           'title': 'Das Schloss', 'author': 'Franz Kafka',
+           'subtitle': 'Roman'},
+          {'id': '159', 'url': _host + '/buch/effi-briest-159/1',
+           'title': 'Effi Briest', 'author': None, 'subtitle': None}])
+        self.assertEqual(crawler.known, {job['id']: job for job in jobs})
+        # Known books are not reported again.
+        self.assertEqual(crawler.crawl([_host + '/autoren']), [])
+
+    def test_no_meta(self):
+        crawler = self.gutenb.GutenbCrawler(self.source, fetch_meta = False)
+        jobs = crawler.crawl([_host + '/autoren'], depth = 0)
+        self.assertEqual(crawler.pages, 1)
+        self.assertEqual(jobs, [])
+        with self.assertWarns(UserWarning):
+            # The pages are counted over both crawls.
+            jobs = crawler.crawl([_host + '/autor/kafka-1'], max_pages = 2)
+        self.assertEqual([(job['id'], job['title']) for job in jobs],
+                         [('157', 'Der Prozeß'), ('158', None)])
+
+    def test_new_interpreter(self):
+        # The crawler must import what it needs itself, not rely on
+        # main() or other modules to do it.
+        prog = ('import sys\n'
+                'sys.path[:] = %r\n'
+                'import importlib.machinery, importlib.util\n'
+                'import getebook.sources\n'
+                'loader = importlib.machinery.SourceFileLoader("gutenb", %r)\n'
+                'spec = importlib.util.spec_from_loader("gutenb", loader)\n'
+                'gutenb = importlib.util.module_from_spec(spec)\n'
+                'loader.exec_module(gutenb)\n'
+                'source = getebook.sources.MirrorSource(%r)\n'
+                'crawler = gutenb.GutenbCrawler(source)\n'
+                'jobs = crawler.crawl([%r], 0)\n'
+                'print(sorted(job["id"] for job in jobs))\n'
+                % ([_top_dir] + sys.path, _gutenb, self.mirror,
+                   _host + '/autor/kafka-1'))
+        out = subprocess.run([sys.executable, '-S', '-c', prog],
+                             stdout = subprocess.PIPE, check = True)
+        self.assertEqual(out.stdout.decode().split(), ["['157',", "'158']"])
+
+if __name__ == '__main__':
+    unittest.main()
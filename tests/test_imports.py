@@ -0,0 +1,84 @@
+# Copyright (c) 2016, Max Fillinger <max@max-fillinger.net>
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES WITH
+# REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF MERCHANTABILITY
+# AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY SPECIAL, DIRECT,
+# INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES WHATSOEVER RESULTING FROM
+# LOSS OF USE, DATA OR PROFITS, WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR
+# OTHER TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR
+# PERFORMANCE OF THIS SOFTWARE.
+
+'''Checks that importing getebook stays cheap: the slow dependencies are
+only imported when they are needed.'''
+
+import json
+import os.path
+import subprocess
+import sys
+import unittest
+
+_top_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Imported when a page is downloaded, parsed or an epub is written
+_heavy = ['requests', 'html.parser', 'zipfile', 'lxml']
+
+def imported(code):
+    '''Run code in a new interpreter and return the names of the
+    modules it imported and the output of -X importtime. The interpreter
+    is started without the site module, which may import some of the
+    modules itself, but with the same path as this one.'''
+    prog = ('import sys\n'
+            'sys.path[:] = %r\n'
+            'before = set(sys.modules)\n'
+            '%s\n'
+            'import json\n'
+            'print(json.dumps(sorted(set(sys.modules) - before)))\n'
+            % ([_top_dir] + sys.path, code))
+    out = subprocess.run([sys.executable, '-S', '-X', 'importtime', '-c',
+                          prog], stdout = subprocess.PIPE,
+                         stderr = subprocess.PIPE, check = True)
+    return (json.loads(out.stdout.decode().splitlines()[-1]),
+            out.stderr.decode())
+
+class ImportTest(unittest.TestCase):
+    def assert_lazy(self, code, heavy = _heavy):
+        (modules, importtime) = imported(code)
+        for name in heavy:
+            if name in modules:
+                self.fail('%s imported by %r:\n%s' % (name, code,
+                                                      importtime))
+
+    def test_getebook(self):
+        self.assert_lazy('import getebook')
+
+    def test_submodules(self):
+        for name in ('epub', 'fetch', 'sources', 'search', 'parsecache',
+                     'events', 'parallel'):
+            with self.subTest(module = name):
+                self.assert_lazy('import getebook.%s' % name)
+
+    def test_search(self):
+        # Only the command line interface needs these.
+        self.assert_lazy('from getebook.search import Index',
+                         _heavy + ['argparse'])
+
+    def test_gutenb(self):
+        # gutenb needs html.parser for its own parsers, but its argument
+        # parser must not import the rest.
+        self.assert_lazy('import importlib.machinery, importlib.util\n'
+                         'loader = importlib.machinery.SourceFileLoader('
+                         '"gutenb", %r)\n'
+                         'spec = importlib.util.spec_from_loader("gutenb", '
+                         'loader)\n'
+                         'gutenb = importlib.util.module_from_spec(spec)\n'
+                         'loader.exec_module(gutenb)\n'
+                         'gutenb.make_argparser()'
+                         % os.path.join(_top_dir, 'gutenb'),
+                         ['requests', 'zipfile', 'lxml'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,89 @@
+# Copyright (c) 2016, Max Fillinger <max@max-fillinger.net>
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES WITH
+# REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF MERCHANTABILITY
+# AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY SPECIAL, DIRECT,
+# INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES WHATSOEVER RESULTING FROM
+# LOSS OF USE, DATA OR PROFITS, WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR
+# OTHER TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR
+# PERFORMANCE OF THIS SOFTWARE.
+
+'''Tests that building a book in several processes gives the same epub as
+the serial parser, also when the quick scan for the next link is wrong.'''
+
+import getebook
+import getebook.epub
+import getebook.sources
+import io
+import os
+import os.path
+import tempfile
+import unittest
+
+# Pages of the book, by number. The link to the next page is outside of
+# the book content; the decoys only fool the scan of the parallel
+# parser, which doesn't know where the content is.
+_pages = {
+  1: '<p>Plain page.</p>',
+  # A link in the content that matches link_next, to a page that exists
+  2: '<p>See <a href="/book/decoy">Next</a> for more.</p>',
+  # The same, to a page that doesn't exist
+  3: '<p>A <a href="/book/missing">Next</a> link to nowhere.</p>',
+  # A link in a comment
+  4: '<!-- <a href="/book/decoy">Next</a> --><p>Commented link.</p>',
+  5: '<p>Last page, with a decoy: <a href="/book/decoy">Next</a></p>',
+}
+
+class ParallelTest(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.mirror = tmp.name
+        book = os.path.join(self.mirror, 'example.org', 'book')
+        os.makedirs(book)
+        for (i, content) in _pages.items():
+            if i + 1 in _pages:
+                link = '<a href="/book/%d">Next</a>' % (i + 1)
+            else:
+                link = ''
+            with open(os.path.join(book, str(i)), 'w') as f:
+                f.write('<html><body><div id="c"><h2>Chapter %d</h2>%s'
+                        '</div>%s</body></html>' % (i, content, link))
+        with open(os.path.join(book, 'decoy'), 'w') as f:
+            f.write('<html><body><div id="c"><p>Decoy page.</p>'
+                    '<a href="/book/5">Next</a></div></body></html>')
+
+    def build(self, processes = None):
+        'Build the book and return the epub as bytes.'
+        out = io.BytesIO()
+        bld = getebook.epub.EpubBuilder(out, reproducible = True)
+        bld.title = 'Book'
+        p = getebook.EbookParser(bld, 'Next', root_tag = 'div',
+                                 root_id = 'c', diagnostics = None,
+                                 source = getebook.sources.MirrorSource(
+                                            self.mirror))
+        status = p.getebook('http://example.org/', 'book/1', processes)
+        self.assertEqual(status, 'complete')
+        bld.finalize()
+        return out.getvalue()
+
+    def test_same_as_serial(self):
+        serial = self.build()
+        self.assertEqual(self.build(processes = 2), serial)
+        self.assertEqual(self.build(processes = 1), serial)
+
+    def test_decoys_ignored(self):
+        import zipfile
+        with zipfile.ZipFile(io.BytesIO(self.build(processes = 2))) as zf:
+            text = b''.join(zf.read(n) for n in zf.namelist()
+                            if n.endswith('.html'))
+        for i in _pages:
+            self.assertIn(b'Chapter %d' % i, text)
+        self.assertNotIn(b'Decoy page', text)
+
+if __name__ == '__main__':
+    unittest.main()
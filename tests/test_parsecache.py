@@ -0,0 +1,158 @@
+# Copyright (c) 2016, Max Fillinger <max@max-fillinger.net>
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES WITH
+# REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF MERCHANTABILITY
+# AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY SPECIAL, DIRECT,
+# INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES WHATSOEVER RESULTING FROM
+# LOSS OF USE, DATA OR PROFITS, WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR
+# OTHER TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR
+# PERFORMANCE OF THIS SOFTWARE.
+
+'''Tests for the parse cache: replaying cached results must give the
+same epub as parsing, and damaged entries must not break a build.'''
+
+import getebook
+import getebook.epub
+import getebook.events
+import getebook.parsecache
+import getebook.sources
+import glob
+import io
+import os
+import os.path
+import pickle
+import tempfile
+import unittest
+import unittest.mock
+import warnings
+
+_pages = 3
+
+class ParseCacheTest(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.mirror = os.path.join(tmp.name, 'mirror')
+        self.cache_dir = os.path.join(tmp.name, 'cache')
+        book = os.path.join(self.mirror, 'example.org', 'book')
+        os.makedirs(book)
+        for i in range(1, _pages + 1):
+            if i < _pages:
+                link = '<a href="/book/%d">Next</a>' % (i + 1)
+            else:
+                link = ''
+            # The unclosed tags give diagnostics.
+            with open(os.path.join(book, str(i)), 'w') as f:
+                f.write('<html><body><div id="c"><h2>Chapter %d</h2>'
+                        '<p>Text <i>of page %d.<p>More.</div>%s'
+                        '</body></html>' % (i, i, link))
+
+    def parser(self, bld = None, link_next = 'Next', cache = None):
+        'Return a parser for the book.'
+        if not bld:
+            bld = getebook.epub.EpubBuilder(io.BytesIO())
+        return getebook.EbookParser(bld, link_next, root_tag = 'div',
+                                    root_id = 'c', parse_cache = cache,
+                                    source = getebook.sources.MirrorSource(
+                                               self.mirror))
+
+    def build(self, cache = None, processes = None):
+        '''Build the book and return the epub (as bytes) and the summary
+        of the diagnostics.'''
+        out = io.BytesIO()
+        bld = getebook.epub.EpubBuilder(out, reproducible = True)
+        bld.title = 'Book'
+        p = self.parser(bld, cache = cache)
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            p.getebook('http://example.org/', 'book/1', processes)
+        bld.finalize()
+        return (out.getvalue(), p.diagnostics.summary())
+
+    def test_replay(self):
+        expected = self.build()
+        cache = getebook.parsecache.ParseCache(self.cache_dir)
+        self.assertEqual(self.build(cache), expected)
+        self.assertEqual((cache.hits, cache.misses), (0, _pages))
+        # The second time, nothing is parsed.
+        with unittest.mock.patch('getebook.events.parse_page',
+                                 side_effect = AssertionError):
+            self.assertEqual(self.build(cache), expected)
+            self.assertEqual(self.build(cache, processes = 2), expected)
+        self.assertEqual((cache.hits, cache.misses), (2 * _pages, _pages))
+
+    def test_parser_key(self):
+        cache = getebook.parsecache.ParseCache(self.cache_dir)
+        key = cache.parser_key(self.parser())
+        self.assertEqual(cache.parser_key(self.parser()), key)
+        self.assertNotEqual(cache.parser_key(self.parser(
+                              link_next = 'Weiter')), key)
+        p = self.parser()
+        p.quirks.false_heading('note', None)
+        self.assertNotEqual(cache.parser_key(p), key)
+        p = self.parser()
+        p._streaming = False
+        self.assertNotEqual(cache.parser_key(p), key)
+        # The key of a page depends on all of its parts.
+        page_key = cache.key(key, 'utf-8', b'page')
+        self.assertNotEqual(cache.key(key, 'cp1252', b'page'), page_key)
+        self.assertNotEqual(cache.key(key, 'utf-8', b'page 2'), page_key)
+
+    def test_damaged(self):
+        expected = self.build()
+        cache = getebook.parsecache.ParseCache(self.cache_dir)
+        self.build(cache)
+        names = sorted(glob.glob(os.path.join(self.cache_dir, '*.pickle')))
+        self.assertEqual(len(names), _pages)
+        # Garbage, a truncated pickle and an empty file
+        with open(names[0], 'wb') as f:
+            f.write(b'not a pickle')
+        with open(names[1], 'r+b') as f:
+            f.truncate(os.path.getsize(names[1]) // 2)
+        open(names[2], 'wb').close()
+        cache = getebook.parsecache.ParseCache(self.cache_dir)
+        self.assertEqual(self.build(cache), expected)
+        self.assertEqual((cache.hits, cache.misses), (0, _pages))
+        # The damaged entries were replaced.
+        cache = getebook.parsecache.ParseCache(self.cache_dir)
+        self.assertEqual(self.build(cache), expected)
+        self.assertEqual((cache.hits, cache.misses), (_pages, 0))
+
+    def test_eviction(self):
+        result = getebook.events.PageResult(['x' * 1000], None, None, None)
+        size = len(pickle.dumps(result, pickle.HIGHEST_PROTOCOL))
+        cache = getebook.parsecache.ParseCache(self.cache_dir,
+                                               max_size = 4 * size)
+        for i in range(4):
+            cache.put('k%d' % i, result)
+            os.utime(cache.path('k%d' % i), (i, i))
+        # k0 is used again and becomes the most recently used entry.
+        self.assertTrue(cache.get('k0', 'http://example.org/'))
+        cache.put('k4', result)
+        names = sorted(os.path.basename(n) for n in
+                       glob.glob(os.path.join(self.cache_dir, '*')))
+        # Down to three quarters of max_size, oldest first.
+        self.assertEqual(names, ['k0.pickle', 'k3.pickle', 'k4.pickle'])
+        total = sum(os.path.getsize(os.path.join(self.cache_dir, n))
+                    for n in names)
+        self.assertLessEqual(total, cache.max_size)
+
+    def test_failed_put(self):
+        # A write that fails, even by KeyboardInterrupt, leaves neither
+        # an entry nor a temporary file behind.
+        cache = getebook.parsecache.ParseCache(self.cache_dir)
+        result = getebook.events.PageResult([], None, None, None)
+        for error in (OSError, KeyboardInterrupt):
+            with self.subTest(error = error.__name__):
+                with unittest.mock.patch('pickle.dump', side_effect = error):
+                    with self.assertRaises(error):
+                        cache.put('key', result)
+                self.assertEqual(os.listdir(self.cache_dir), [])
+                self.assertIsNone(cache.get('key', 'http://example.org/'))
+
+if __name__ == '__main__':
+    unittest.main()
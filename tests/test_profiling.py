@@ -0,0 +1,113 @@
+# Copyright (c) 2016, Max Fillinger <max@max-fillinger.net>
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES WITH
+# REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF MERCHANTABILITY
+# AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY SPECIAL, DIRECT,
+# INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES WHATSOEVER RESULTING FROM
+# LOSS OF USE, DATA OR PROFITS, WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR
+# OTHER TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR
+# PERFORMANCE OF THIS SOFTWARE.
+
+'''Tests for the profiler: it writes its results and leaves the parser
+and builder as they were, even if writing the results fails.'''
+
+import cProfile
+import getebook
+import getebook.epub
+import getebook.profiling
+import getebook.sources
+import io
+import json
+import os
+import os.path
+import tempfile
+import threading
+import tracemalloc
+import unittest
+import unittest.mock
+
+_pages = 3
+
+def page(i):
+    'Return page i of the book.'
+    if i < _pages:
+        link = '<a href="/book/%d">Next</a>' % (i + 1)
+    else:
+        link = ''
+    return ('<html><body><div id="c"><h2>Chapter %d</h2><p>Text.</p>'
+            '</div>%s</body></html>' % (i, link)).encode()
+
+def methods(p):
+    '''Return the methods set on the objects that the profiler
+    instruments (instead of those of their classes).'''
+    return [{name: val for (name, val) in vars(obj).items() if callable(val)}
+            for obj in (p, p.source, p.quirks, p.builder, p.builder.epub_f)]
+
+class ProfileTest(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.dir = os.path.join(tmp.name, 'prof')
+        mirror = os.path.join(tmp.name, 'mirror')
+        os.makedirs(os.path.join(mirror, 'example.org', 'book'))
+        for i in range(1, _pages + 1):
+            with open(os.path.join(mirror, 'example.org', 'book', str(i)),
+                      'wb') as f:
+                f.write(page(i))
+        self.bld = getebook.epub.EpubBuilder(io.BytesIO())
+        self.addCleanup(self.bld.discard)
+        self.p = getebook.EbookParser(self.bld, 'Next', root_tag = 'div',
+                                      root_id = 'c', diagnostics = None,
+                                      source = getebook.sources.MirrorSource(
+                                                 mirror))
+        self.before = methods(self.p)
+        self.threads = threading.active_count()
+
+    def check_restored(self):
+        'Check that the profiler stopped and restored all methods.'
+        self.assertEqual(methods(self.p), self.before)
+        self.assertEqual(threading.active_count(), self.threads)
+        self.assertFalse(tracemalloc.is_tracing())
+
+    def test_profile(self):
+        with getebook.profiling.Profile(self.p, self.dir,
+                                        sample_interval = 0.001) as prof:
+            self.p.getebook('http://example.org/', 'book/1')
+            self.assertNotEqual(methods(self.p), self.before)
+        self.check_restored()
+        self.assertEqual(sorted(os.listdir(self.dir)),
+                         ['part000.tracemalloc', 'part001.tracemalloc',
+                          'part002.tracemalloc', 'profile.pstats',
+                          'stacks.collapsed', 'stages.json'])
+        with open(os.path.join(self.dir, 'stages.json')) as f:
+            summary = json.load(f)
+        self.assertEqual(summary, prof.summary())
+        self.assertEqual(summary['fetch']['calls'], _pages)
+        self.assertGreater(summary['builder']['calls'], 0)
+
+    def test_failed_dump(self):
+        with unittest.mock.patch.object(cProfile.Profile, 'dump_stats',
+                                        side_effect = OSError('disk full')):
+            with self.assertRaises(OSError):
+                with getebook.profiling.Profile(self.p, self.dir,
+                                                sample_interval = 0.001):
+                    self.p.getebook('http://example.org/', 'book/1')
+        self.check_restored()
+
+    def test_failed_build(self):
+        # The exception from the build is not replaced.
+        with self.assertRaises(ZeroDivisionError):
+            with getebook.profiling.Profile(self.p, self.dir, memory = False,
+                                            sample_interval = None):
+                self.p.getebook('http://example.org/', 'book/1')
+                1 / 0
+        self.check_restored()
+        self.assertTrue(os.path.exists(os.path.join(self.dir,
+                                                    'stages.json')))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,73 @@
+# Copyright (c) 2016, Max Fillinger <max@max-fillinger.net>
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES WITH
+# REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF MERCHANTABILITY
+# AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY SPECIAL, DIRECT,
+# INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES WHATSOEVER RESULTING FROM
+# LOSS OF USE, DATA OR PROFITS, WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR
+# OTHER TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR
+# PERFORMANCE OF THIS SOFTWARE.
+
+'''Tests for the quirks of EbookParser: they must work the same whether
+the builder gets paragraphs out of wrapper elements as they are parsed
+(with start_elem) or only complete top-level elements.'''
+
+import getebook
+import getebook.epub
+import io
+import unittest
+import zipfile
+
+_page = '''<html><body><div id="c">
+<p class="big">Part One</p>
+<h2>Chapter 1</h2>
+<p>Text of chapter 1.</p>
+<h3 class="note">Just a note</h3>
+<div class="wrap">
+<p class="big">Wrapped part</p>
+<h2>Chapter 2</h2>
+<p>Text of chapter 2.</p>
+<h3 class="note">Wrapped note</h3>
+</div>
+<p>End.</p>
+</div></body></html>'''
+
+def build(stream):
+    '''Build an epub from _page with the quirks set. Returns the text of
+    the part and the text of the table of contents.'''
+    out = io.BytesIO()
+    bld = getebook.epub.EpubBuilder(out, reproducible = True)
+    p = getebook.EbookParser(bld, 'Next', root_tag = 'div', root_id = 'c')
+    p.quirks.par_heading('big', None)
+    p.quirks.false_heading('note', None)
+    p._streaming = stream
+    bld.new_part()
+    p.feed(_page)
+    p.close()
+    bld.finalize()
+    with zipfile.ZipFile(out) as zf:
+        parts = [n for n in zf.namelist() if n.startswith('part')]
+        return (''.join(zf.read(n).decode() for n in parts),
+                zf.read('toc.ncx').decode())
+
+class QuirksTest(unittest.TestCase):
+    def test_same_with_streaming(self):
+        self.assertEqual(build(True), build(False))
+
+    def test_top_level(self):
+        (text, toc) = build(True)
+        # The paragraph heading is merged with the next heading.
+        self.assertIn('Part One. Chapter 1', toc)
+        self.assertIn('<p class="getebook-false-h">Just a note</p>', text)
+        # Inside the wrapper, the elements are passed on unchanged.
+        self.assertNotIn('Wrapped part. Chapter 2', toc)
+        self.assertIn('<h1 class="getebook-chapter-h">Wrapped note</h1>',
+                      text)
+        self.assertIn('<p>End.</p>', text)
+
+if __name__ == '__main__':
+    unittest.main()
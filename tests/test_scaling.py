@@ -0,0 +1,36 @@
+# Copyright (c) 2016, Max Fillinger <max@max-fillinger.net>
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES WITH
+# REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF MERCHANTABILITY
+# AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY SPECIAL, DIRECT,
+# INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES WHATSOEVER RESULTING FROM
+# LOSS OF USE, DATA OR PROFITS, WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR
+# OTHER TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR
+# PERFORMANCE OF THIS SOFTWARE.
+
+'''Tests that parsing the pathological pages of bench_parser takes time
+linear in their size.'''
+
+import unittest
+from tests import bench_parser
+
+def best_time(html, tries = 3):
+    'Return the shortest of several times for parsing html.'
+    return min(bench_parser.parse(html) for i in range(tries))
+
+class ScalingTest(unittest.TestCase):
+    def test_linear(self):
+        # Four times the input should take about four times as long.
+        # Anything quadratic takes sixteen times as long.
+        for (name, make_body) in sorted(bench_parser.benchmarks.items()):
+            with self.subTest(benchmark = name):
+                small = best_time(bench_parser.page(make_body(500)))
+                large = best_time(bench_parser.page(make_body(2000)))
+                self.assertLess(large / small, 8)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,146 @@
+# Copyright (c) 2016, Max Fillinger <max@max-fillinger.net>
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES WITH
+# REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF MERCHANTABILITY
+# AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY SPECIAL, DIRECT,
+# INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES WHATSOEVER RESULTING FROM
+# LOSS OF USE, DATA OR PROFITS, WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR
+# OTHER TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR
+# PERFORMANCE OF THIS SOFTWARE.
+
+'''Tests for the full-text index: books are built with an index, which
+is read back from the epub, merged and queried.'''
+
+import contextlib
+import getebook
+import getebook.epub
+import getebook.search
+import io
+import json
+import os.path
+import tempfile
+import unittest
+
+_page = '''<html><body><div id="c">
+<p>Before the first chapter.</p>
+<h2>The Storm</h2>
+<p>It was a dark and stormy night. The night was DARK.</p>
+<h2>The Morning</h2>
+<p>The morning was bright.</p>
+</div></body></html>'''
+
+class SearchTest(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.dir = tmp.name
+
+    def build(self, name, uid, title, page = _page, index = True,
+              exploded = False):
+        'Build a book from page and return its filename.'
+        filename = os.path.join(self.dir, name)
+        with getebook.epub.EpubBuilder(filename, index = index,
+                                       exploded = exploded) as bld:
+            bld.uid = uid
+            bld.title = title
+            bld.author = 'Alice Author'
+            p = getebook.EbookParser(bld, 'Next', root_tag = 'div',
+                                     root_id = 'c', diagnostics = None)
+            bld.new_part()
+            p.feed(page)
+            p.close()
+        return filename
+
+    def test_book(self):
+        index = getebook.search.read_index(self.build('a.epub', 'a', 'A'))
+        (book,) = index['books']
+        self.assertEqual((book['uid'], book['title'], book['authors']),
+                         ('a', 'A', ['Alice Author']))
+        self.assertEqual([text for (text, part) in book['toc']],
+                         ['The Storm', 'The Morning'])
+        hits = getebook.search.search(index, 'Dark NIGHT')
+        self.assertEqual(len(hits), 1)
+        (hit_book, part, toc_text, positions) = hits[0]
+        self.assertEqual(hit_book, book)
+        self.assertIn(part, book['parts'])
+        self.assertEqual(toc_text, 'The Storm')
+        # The words of the entry: the storm it was a dark and stormy
+        # night the night was dark
+        self.assertEqual(positions, {'dark': [9, 16], 'night': [12, 14]})
+        self.assertIsNone(getebook.search.search(index, 'first')[0][2])
+        self.assertEqual(getebook.search.search(index, 'dark morning'), [])
+        self.assertEqual(getebook.search.search(index, 'unknown'), [])
+        self.assertEqual(getebook.search.search(index, '...'), [])
+
+    def test_read_index(self):
+        epub = getebook.search.read_index(self.build('a.epub', 'a', 'A'))
+        exploded = getebook.search.read_index(self.build('a', 'a', 'A',
+                                                         exploded = True))
+        self.assertEqual(exploded, epub)
+        name = os.path.join(self.dir, 'a.json')
+        with open(name, 'w') as f:
+            json.dump(epub, f)
+        self.assertEqual(getebook.search.read_index(name), epub)
+        self.assertIsNone(getebook.search.read_index(
+                            self.build('b.epub', 'b', 'B', index = False)))
+
+    def test_merge(self):
+        page_b = _page.replace('stormy', 'windy')
+        indexes = [getebook.search.read_index(self.build(*args))
+                   for args in (('a.epub', 'a', 'A'),
+                                ('b.epub', 'b', 'B', page_b),
+                                ('a2.epub', 'a', 'A2'))]
+        catalog = getebook.search.merge(indexes)
+        # The newer build of a replaces the older one.
+        self.assertEqual([b['title'] for b in catalog['books']],
+                         ['B', 'A2'])
+        hits = getebook.search.search(catalog, 'dark night')
+        self.assertEqual([h[0]['title'] for h in hits], ['B', 'A2'])
+        self.assertEqual([h[0]['title'] for h in
+                          getebook.search.search(catalog, 'windy')], ['B'])
+        # Merging catalogs gives the same as merging the books.
+        self.assertEqual(getebook.search.merge([catalog]), catalog)
+        self.assertEqual(getebook.search.merge([
+                           getebook.search.merge(indexes[:2]),
+                           indexes[2]]), catalog)
+        with self.assertRaises(ValueError):
+            getebook.search.merge([{'version': 2}])
+
+    def run_main(self, *argv):
+        'Run the command line interface and return its output.'
+        out = io.StringIO()
+        err = io.StringIO()
+        with contextlib.redirect_stdout(out), \
+             contextlib.redirect_stderr(err):
+            getebook.search.main(list(argv))
+        return (out.getvalue(), err.getvalue())
+
+    def test_main(self):
+        a = self.build('a.epub', 'a', 'A')
+        b = self.build('b.epub', 'b', 'B', _page.replace('dark', 'grim'))
+        c = self.build('c.epub', 'c', 'C', index = False)
+        catalog = os.path.join(self.dir, 'catalog.json')
+        (out, err) = self.run_main('merge', catalog, a, b, c)
+        self.assertEqual(err, '%s: no index\n' % c)
+        with open(catalog) as f:
+            self.assertEqual(json.load(f), getebook.search.merge(
+                               [getebook.search.read_index(a),
+                                getebook.search.read_index(b)]))
+        (out, err) = self.run_main('query', catalog, 'Stormy', 'night')
+        lines = out.splitlines()
+        self.assertEqual(len(lines), 2)
+        self.assertTrue(lines[0].startswith('A: '))
+        self.assertTrue(lines[0].endswith(', The Storm (night: 2, '
+                                          'stormy: 1)'))
+        self.assertTrue(lines[1].startswith('B: '))
+        (out, err) = self.run_main('query', a, 'grim')
+        self.assertEqual(out, '')
+        with self.assertRaises(SystemExit):
+            self.run_main('query', c, 'night')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,168 @@
+# Copyright (c) 2016, Max Fillinger <max@max-fillinger.net>
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES WITH
+# REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF MERCHANTABILITY
+# AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY SPECIAL, DIRECT,
+# INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES WHATSOEVER RESULTING FROM
+# LOSS OF USE, DATA OR PROFITS, WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR
+# OTHER TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR
+# PERFORMANCE OF THIS SOFTWARE.
+
+'''Tests for the cache of the build service. Builds are replaced by a
+function that writes a counter, so no pages are read.'''
+
+import getebook
+import getebook.service
+import http.server
+import os
+import socket
+import tempfile
+import threading
+import time
+import unittest
+import unittest.mock
+
+_config = {'url': 'http://example.org/book/1', 'link_next': 'Next'}
+
+class _Cache(getebook.service.BuildCache):
+    '''BuildCache whose next lookups can be made to miss (as if another
+    request had not put its epub in yet) or to lose the file right after
+    it was found (as if another request had evicted it).'''
+    misses = 0
+    evictions = 0
+
+    def get(self, key):
+        if self.misses:
+            self.misses -= 1
+            return None
+        path = super().get(key)
+        if path and self.evictions:
+            self.evictions -= 1
+            os.remove(path)
+        return path
+
+class BuildServiceTest(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.cache = _Cache(tmp.name)
+        self.service = getebook.service.BuildService(self.cache)
+        self.builds = 0
+        self.release = threading.Event()
+        self.release.set()
+        patch = unittest.mock.patch('getebook.service.build', self._build)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def _build(self, config, f, budget = None, parse_cache = None):
+        self.release.wait()
+        self.builds += 1
+        f.write(b'epub %d' % self.builds)
+        if self.error:
+            raise self.error
+
+    error = None
+
+    def test_cached(self):
+        self.service.get(_config)
+        with self.service.open_epub(_config) as f:
+            self.assertEqual(f.read(), b'epub 1')
+        self.assertEqual(self.builds, 1)
+
+    def test_evicted_before_open(self):
+        self.service.get(_config)
+        self.cache.evictions = 1
+        with self.service.open_epub(_config) as f:
+            self.assertEqual(f.read(), b'epub 2')
+
+    def test_finished_after_lookup(self):
+        # The first lookup misses because another build has not put its
+        # epub into the cache yet; when the lock is taken, it is there.
+        self.service.get(_config)
+        self.cache.misses = 1
+        self.service.get(_config)
+        self.assertEqual(self.builds, 1)
+
+    def test_concurrent(self):
+        self.release.clear()
+        paths = []
+        threads = [threading.Thread(target = lambda:
+                                    paths.append(self.service.get(_config)))
+                   for i in range(4)]
+        for t in threads:
+            t.start()
+        self.release.set()
+        for t in threads:
+            t.join()
+        self.assertEqual(self.builds, 1)
+        self.assertEqual(len(set(paths)), 1)
+
+    def test_failed(self):
+        self.error = getebook.BuildStopped('pages', 'too many pages')
+        with self.assertRaises(getebook.BuildStopped):
+            self.service.get(_config)
+        # Nothing is cached, not even the partial book.
+        self.assertEqual(os.listdir(self.cache.directory), [])
+
+    def test_leader_interrupted(self):
+        # Waiting requests get an error of their own, not the
+        # KeyboardInterrupt of the thread that ran the build.
+        self.error = KeyboardInterrupt()
+        self.release.clear()
+        errors = []
+        def get():
+            try:
+                self.service.get(_config)
+            except BaseException as e:
+                errors.append(e)
+        threads = [threading.Thread(target = get) for i in range(3)]
+        for t in threads:
+            t.start()
+        # Give the other threads time to start waiting for the build.
+        time.sleep(0.2)
+        self.release.set()
+        for t in threads:
+            t.join()
+        self.assertEqual(self.builds, 1)
+        self.assertEqual(sorted(type(e).__name__ for e in errors),
+                         ['KeyboardInterrupt', 'RuntimeError',
+                          'RuntimeError'])
+
+class HandlerTest(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.server = http.server.ThreadingHTTPServer(('localhost', 0),
+                        getebook.service._Handler)
+        self.server.service = getebook.service.BuildService(
+                                getebook.service.BuildCache(tmp.name))
+        t = threading.Thread(target = self.server.serve_forever)
+        t.start()
+        self.addCleanup(t.join)
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+    def post(self, length, body = b''):
+        'Send a build request and return the status line of the answer.'
+        with socket.create_connection(self.server.server_address,
+                                      timeout = 5) as s:
+            s.sendall(b'POST /build HTTP/1.0\r\n'
+                      b'Content-Length: %d\r\n\r\n' % length + body)
+            return s.makefile('rb').readline()
+
+    def test_negative_length(self):
+        # Reading -1 bytes would wait for the client to close.
+        self.assertIn(b' 400 ', self.post(-1))
+
+    def test_too_long(self):
+        self.assertIn(b' 413 ', self.post(10 << 20))
+
+    def test_invalid(self):
+        self.assertIn(b' 400 ', self.post(2, b'{}'))
+
+if __name__ == '__main__':
+    unittest.main()
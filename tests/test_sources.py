@@ -0,0 +1,217 @@
+# Copyright (c) 2016, Max Fillinger <max@max-fillinger.net>
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES WITH
+# REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF MERCHANTABILITY
+# AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY SPECIAL, DIRECT,
+# INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES WHATSOEVER RESULTING FROM
+# LOSS OF USE, DATA OR PROFITS, WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR
+# OTHER TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR
+# PERFORMANCE OF THIS SOFTWARE.
+
+'''Tests for the local sources of pages: MirrorSource and WarcSource.'''
+
+import getebook.sources
+import gzip
+import json
+import os
+import os.path
+import tempfile
+import unittest
+import unittest.mock
+import zlib
+
+def write(name, data):
+    'Write data (bytes) to the file name, creating its directory.'
+    os.makedirs(os.path.dirname(name), exist_ok = True)
+    with open(name, 'wb') as f:
+        f.write(data)
+
+class MirrorSourceTest(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.dir = tmp.name
+        mirror = os.path.join(self.dir, 'mirror')
+        host = os.path.join(mirror, 'example.org')
+        write(os.path.join(host, 'book', '1'), b'page 1')
+        # Saved with --adjust-extension
+        write(os.path.join(host, 'book', '2.html'), b'page 2')
+        write(os.path.join(host, 'book', 'index.html'), b'contents')
+        write(os.path.join(host, 'index.html'), b'home')
+        write(os.path.join(host, 'a b', 'c'), b'quoted')
+        write(os.path.join(host, 'page?id=3'), b'query')
+        write(os.path.join(self.dir, 'secret'), b'secret')
+        self.src = getebook.sources.MirrorSource(mirror)
+
+    def get(self, url):
+        'Return the content of the page for url, or None if not found.'
+        page = self.src.get(url)
+        self.assertEqual(page.url, url)
+        if not page:
+            self.assertEqual(page.status_code, 404)
+            return None
+        self.assertEqual(page.status_code, 200)
+        return page.content
+
+    def test_found(self):
+        self.assertEqual(self.get('http://example.org/book/1'), b'page 1')
+        self.assertEqual(self.get('http://example.org/book/1#top'),
+                         b'page 1')
+        self.assertEqual(self.get('http://example.org/book/2'), b'page 2')
+        self.assertEqual(self.get('http://example.org/book'), b'contents')
+        self.assertEqual(self.get('http://example.org/book/'), b'contents')
+        self.assertEqual(self.get('http://example.org/book/./1'), b'page 1')
+        self.assertEqual(self.get('http://example.org'), b'home')
+        self.assertEqual(self.get('http://example.org/a%20b/c'), b'quoted')
+        self.assertEqual(self.get('http://example.org/page?id=3'), b'query')
+
+    def test_not_found(self):
+        self.assertIsNone(self.get('http://example.org/book/3'))
+        self.assertIsNone(self.get('http://example.com/book/1'))
+
+    def test_outside(self):
+        # Without the checks, all of these would find the secret file
+        # next to the mirror.
+        for url in ('http://example.org/../../secret',
+                    'http://example.org/%2e%2e/%2e%2e/secret',
+                    'http://example.org/%2E%2E%2F%2E%2E%2Fsecret',
+                    'http://example.org/book/%2e%2e/%2e%2e/../secret',
+                    'http://../secret'):
+            with self.subTest(url = url):
+                self.assertIsNone(self.get(url))
+
+    @unittest.skipUnless(hasattr(os, 'symlink'), 'needs symbolic links')
+    def test_symlink_outside(self):
+        os.symlink(os.path.join(self.dir, 'secret'),
+                   os.path.join(self.dir, 'mirror', 'example.org', 'link'))
+        self.assertIsNone(self.get('http://example.org/link'))
+
+def record(url, block, warc_type = 'response'):
+    'Return a WARC record of warc_type for url with block (bytes).'
+    return (b'WARC/1.0\r\n'
+            b'WARC-Type: %s\r\n'
+            b'WARC-Target-URI: <%s>\r\n'
+            b'Content-Length: %d\r\n\r\n' % (warc_type.encode(),
+                                              url.encode(), len(block))
+            + block + b'\r\n\r\n')
+
+def response(body, *headers):
+    'Return an HTTP response with body and header lines.'
+    return (b'HTTP/1.1 200 OK\r\n' + b''.join(h + b'\r\n' for h in headers)
+            + b'\r\n' + body)
+
+_records = [
+  record('', b'software: test', 'warcinfo'),
+  record('http://example.org/1', b'GET /1 HTTP/1.1\r\n\r\n', 'request'),
+  record('http://example.org/1',
+         response(b'page 1', b'Content-Type: text/html; charset=utf-8')),
+  record('http://example.org/2',
+         response(b'6\r\npage 2\r\n0\r\n\r\n',
+                  b'Transfer-Encoding: chunked')),
+  record('http://example.org/3',
+         response(gzip.compress(b'page 3'), b'Content-Encoding: gzip')),
+  record('http://example.org/4',
+         response(zlib.compress(b'page 4'), b'Content-Encoding: deflate')),
+  record('http://example.org/gone',
+         b'HTTP/1.1 404 Not Found\r\n\r\nnot here'),
+  # Only the first capture counts.
+  record('http://example.org/1', response(b'later capture')),
+]
+
+class WarcSourceTest(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.dir = tmp.name
+
+    def write_warc(self, compressed, records = _records):
+        'Write a WARC file with the records and return its name.'
+        if compressed:
+            name = os.path.join(self.dir, 'crawl.warc.gz')
+            # Every record is a gzip member of its own.
+            data = b''.join(gzip.compress(r) for r in records)
+        else:
+            name = os.path.join(self.dir, 'crawl.warc')
+            data = b''.join(records)
+        write(name, data)
+        return name
+
+    def check(self, src):
+        pages = {'http://example.org/%d' % i: b'page %d' % i
+                 for i in range(1, 5)}
+        for (url, content) in pages.items():
+            with self.subTest(url = url):
+                page = src.get(url)
+                self.assertTrue(page)
+                self.assertEqual(page.content, content)
+        page = src.get('http://example.org/1#top')
+        self.assertEqual(page.content, b'page 1')
+        self.assertEqual(page.headers.get('content-type'),
+                         'text/html; charset=utf-8')
+        self.assertEqual(sorted(src.index), sorted(pages) +
+                         ['http://example.org/gone'])
+        page = src.get('http://example.org/gone')
+        self.assertFalse(page)
+        self.assertEqual(page.status_code, 404)
+        page = src.get('http://example.org/missing')
+        self.assertFalse(page)
+        self.assertEqual(page.status_code, 404)
+
+    def test_plain(self):
+        with getebook.sources.WarcSource(self.write_warc(False)) as src:
+            # Uncompressed records are read through a memory map.
+            self.assertIsNotNone(src._mmap)
+            self.check(src)
+
+    def test_gzip(self):
+        with getebook.sources.WarcSource(self.write_warc(True)) as src:
+            self.assertIsNone(src._mmap)
+            self.check(src)
+
+    def test_index_file(self):
+        for compressed in (False, True):
+            with self.subTest(compressed = compressed):
+                name = self.write_warc(compressed)
+                getebook.sources.WarcSource(name).close()
+                with open(name + '.idx') as f:
+                    saved = json.load(f)
+                self.assertIn('http://example.org/3', saved['index'])
+                # The saved index is used instead of reading the file.
+                with unittest.mock.patch.object(getebook.sources.WarcSource,
+                                                '_build_index') as build:
+                    with getebook.sources.WarcSource(name) as src:
+                        self.check(src)
+                    build.assert_not_called()
+
+    def test_stale_index(self):
+        name = self.write_warc(False)
+        getebook.sources.WarcSource(name).close()
+        self.write_warc(False, _records +
+                        [record('http://example.org/5', response(b'new'))])
+        os.utime(name, (0, 0))
+        with getebook.sources.WarcSource(name) as src:
+            self.assertEqual(src.get('http://example.org/5').content,
+                             b'new')
+
+    def test_no_index_file(self):
+        name = self.write_warc(False)
+        getebook.sources.WarcSource(name, save_index = False).close()
+        self.assertFalse(os.path.exists(name + '.idx'))
+
+    def test_empty(self):
+        with getebook.sources.WarcSource(self.write_warc(False, [])) as src:
+            self.assertEqual(src.index, {})
+            self.assertFalse(src.get('http://example.org/1'))
+
+    def test_not_warc(self):
+        name = os.path.join(self.dir, 'page.html')
+        write(name, b'<html></html>')
+        with self.assertRaises(ValueError):
+            getebook.sources.WarcSource(name)
+
+if __name__ == '__main__':
+    unittest.main()